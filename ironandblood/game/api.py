@@ -0,0 +1,380 @@
+"""
+JSON API for exchanges, bonds and orders.
+
+Listings and details answer conditional GETs: their ETag comes from the
+version of the requesting user (see `game.versions`), which changes
+whenever one of the user's exchanges or bonds does, so a client polling
+with If-None-Match gets a 304 without the exchange and bond tables being
+read.
+
+`offers` lists the public offers any player can claim; its ETag comes from
+the version of the feed (`versions.PUBLIC`).
+
+`events` is a long-poll endpoint: it answers as soon as an exchange or bond
+of the user changes (see `game.events`), so clients need not poll listings.
+
+Actions are POSTs (with the CSRF token in the X-CSRFToken header, as for any
+session authenticated request) and answer with the changed object, or with
+status 400 and an `error` message when the game refuses them.
+"""
+import json
+from functools import wraps
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import JsonResponse
+from django.utils.translation import ugettext as _
+from django.views.decorators.http import condition, require_GET, require_POST
+
+from . import events, orderbook, versions
+from .models import Bond, Exchange, Order, Resources, Territory
+from .pagination import paginate
+
+EXCHANGE_KEYS = ('offer_date', 'pk')
+BOND_KEYS = ('pk',)
+ORDER_KEYS = ('pk',)
+# Orders placed by one request.
+MAX_ORDERS = 1000
+
+def _error(message, status=400):
+  return JsonResponse({'error': message}, status=status)
+
+def _login_required(view):
+  """Answers 401 instead of redirecting to the login page."""
+  @wraps(view)
+  def wrapper(request, *args, **kwargs):
+    if not request.user.is_authenticated():
+      return _error(_("Authentication required."), status=401)
+    return view(request, *args, **kwargs)
+  return wrapper
+
+def _etag(request, *args, **kwargs):
+  return versions.etag(request.user.pk)
+
+def _versioned(view):
+  """Authenticated GET view answering conditional requests."""
+  return _login_required(require_GET(condition(etag_func=_etag)(view)))
+
+def _public_etag(request, *args, **kwargs):
+  return versions.etag(versions.PUBLIC)
+
+def _action(view):
+  """Authenticated POST view turning refusals into 400 responses."""
+  @wraps(view)
+  def wrapper(request, *args, **kwargs):
+    try:
+      return view(request, *args, **kwargs)
+    except ValidationError as e:
+      return _error(e.messages[0])
+  return _login_required(require_POST(wrapper))
+
+def _date(date):
+  return date.isoformat() if date is not None else None
+
+def _resources(resources):
+  return {name: getattr(resources, name) for name in Resources._list}
+
+def _name(obj):
+  return obj.name if obj is not None else None
+
+def _username(user):
+  return user.username if user is not None else None
+
+def exchange_data(exchange):
+  """JSON-able dictionary of `exchange`, with users and territories loaded."""
+  data = {
+    'id': exchange.pk,
+    'state': exchange.state,
+    'offer_date': _date(exchange.offer_date),
+    'answer_date': _date(exchange.answer_date),
+  }
+  for side in ['offeror', 'offeree']:
+    data.update({
+      side: _username(getattr(exchange, side)),
+      side + '_resources': _resources(getattr(exchange, side + '_resources')),
+      side + '_territory': _name(getattr(exchange, side + '_territory')),
+      side + '_bond': getattr(exchange, side + '_bond_id'),
+      side + '_as_bond': getattr(exchange, side + '_as_bond'),
+      side + '_as_bond_maturity': getattr(exchange,
+        side + '_as_bond_maturity'),
+    })
+  return data
+
+def bond_data(bond):
+  """JSON-able dictionary of `bond`, with users and territory loaded."""
+  return {
+    'id': bond.pk,
+    'state': bond.state,
+    'holder': bond.holder.username,
+    'borrower': bond.borrower.username,
+    'resources': _resources(bond.resources),
+    'territory': _name(bond.territory),
+    'maturity': bond.maturity,
+    'due_turn': bond.due_turn,
+    'delinquent': bond.delinquent,
+    'origin_exchange': bond.origin_exchange_id,
+    'payment_exchange': bond.payment_exchange_id,
+  }
+
+def order_data(order):
+  """JSON-able dictionary of `order`."""
+  return {
+    'id': order.pk,
+    'side': order.side,
+    'good': order.good,
+    'price': order.price,
+    'quantity': order.quantity,
+    'remaining': order.remaining,
+    'state': order.state,
+    'date': _date(order.date),
+  }
+
+def _exchanges(user):
+  return Exchange.objects.filter(Q(offeror=user) | Q(offeree=user)) \
+    .select_related('offeror', 'offeree', 'offeror_territory',
+      'offeree_territory')
+
+def _bonds(user):
+  return Bond.objects.filter(Q(holder=user) | Q(borrower=user)) \
+    .select_related('holder', 'borrower', 'territory')
+
+def _page(request, queryset, keys, serialize):
+  page = paginate(request, queryset, keys)
+  return JsonResponse({
+    'results': [serialize(obj) for obj in page],
+    'next': page.next_cursor,
+  })
+
+@_versioned
+def exchange_list(request):
+  """
+  Exchanges of the user, newest first, filtered by `state` (state codes,
+  default: waiting) and `role` ('offeror' or 'offeree', default: both).
+  """
+  listing = _exchanges(request.user).filter(
+    state__in=list(request.GET.get('state', Exchange.WAITING)))
+  role = request.GET.get('role')
+  if role in ['offeror', 'offeree']:
+    listing = listing.filter(**{role: request.user})
+  return _page(request, listing, EXCHANGE_KEYS, exchange_data)
+
+@_versioned
+def exchange_detail(request, exchange_pk):
+  exchange = _exchanges(request.user).filter(pk=exchange_pk).first()
+  if exchange is None:
+    return _error(_("Exchange not found."), status=404)
+  return JsonResponse(exchange_data(exchange))
+
+@_versioned
+def bond_list(request):
+  """
+  Bonds of the user, newest first, filtered by `state` (state codes,
+  default: pending) and `role` ('holder' or 'borrower', default: both).
+  """
+  listing = _bonds(request.user).filter(
+    state__in=list(request.GET.get('state', Bond.PENDING)))
+  role = request.GET.get('role')
+  if role in ['holder', 'borrower']:
+    listing = listing.filter(**{role: request.user})
+  return _page(request, listing, BOND_KEYS, bond_data)
+
+@_versioned
+def bond_detail(request, bond_pk):
+  bond = _bonds(request.user).filter(pk=bond_pk).first()
+  if bond is None:
+    return _error(_("Bond not found."), status=404)
+  return JsonResponse(bond_data(bond))
+
+@_login_required
+@require_GET
+def poll_events(request):
+  """
+  Events of the user after the event id `after`, waiting for one when there
+  is none yet (see `events.cursor` and `events.result`).  Served without a
+  thread by the ASGI application (see `game.asgi`).
+  """
+  after = events.cursor(request.GET.get('after'))
+  found = events.broker().wait(request.user.pk, after, events.timeout())
+  return JsonResponse(events.result(found, after))
+
+def _non_negative(data, name):
+  value = data.get(name, 0)
+  if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+    raise ValidationError(_("“%(name)s” must be a non-negative integer."),
+      params={'name': name})
+  return value
+
+def _build_exchange(user, data):
+  """
+  Unsaved exchange offered by `user`, described by the JSON `data`; a
+  public offer when `public` is true.
+  """
+  if data.get('public') is True:
+    offeree = None
+  else:
+    offeree = User.objects.filter(username=data.get('offeree')).first()
+    if offeree is None:
+      raise ValidationError(_("Unknown offeree."))
+  exchange = Exchange(offeror=user, offeree=offeree)
+  for side in ['offeror', 'offeree']:
+    resources = data.get(side + '_resources') or {}
+    if not isinstance(resources, dict):
+      raise ValidationError(_("“%(name)s” must be an object."),
+        params={'name': side + '_resources'})
+    setattr(exchange, side + '_resources', Resources(**{name:
+      _non_negative(resources, name) for name in Resources._list}))
+    territory = data.get(side + '_territory')
+    if territory is not None:
+      territory = Territory.objects.filter(name=territory).first()
+      if territory is None:
+        raise ValidationError(_("Unknown %(side)s territory."),
+          params={'side': side})
+      setattr(exchange, side + '_territory', territory)
+    bond = data.get(side + '_bond')
+    if bond is not None:
+      bond = Bond.objects.filter(pk=bond).first() \
+        if isinstance(bond, int) else None
+      if bond is None:
+        raise ValidationError(_("Unknown %(side)s bond."),
+          params={'side': side})
+      setattr(exchange, side + '_bond', bond)
+    setattr(exchange, side + '_as_bond', bool(data.get(side + '_as_bond')))
+    setattr(exchange, side + '_as_bond_maturity',
+      _non_negative(data, side + '_as_bond_maturity'))
+  return exchange
+
+def _json_body(request):
+  try:
+    return json.loads(request.body.decode('utf-8'))
+  except ValueError:
+    raise ValidationError(_("Invalid JSON."))
+
+def _object(data):
+  if not isinstance(data, dict):
+    raise ValidationError(_("Expected a JSON object."))
+  return data
+
+@_action
+def offer(request):
+  """Offers the exchange described by the JSON body; answers 201."""
+  data = _object(_json_body(request))
+  exchange = _build_exchange(request.user, data)
+  exchange.offer(user=request.user)
+  return JsonResponse(exchange_data(exchange), status=201)
+
+def exchanges(request):
+  """Lists exchanges on GET, offers one on POST."""
+  if request.method == 'POST':
+    return offer(request)
+  return exchange_list(request)
+
+EXCHANGE_ACTIONS = {
+  'accept': Exchange.accept,
+  'reject': Exchange.reject,
+  'cancel': Exchange.cancel,
+}
+
+@_action
+def update_exchange(request, exchange_pk, action):
+  exchange = _exchanges(request.user).filter(pk=exchange_pk).first()
+  if exchange is None:
+    return _error(_("Exchange not found."), status=404)
+  EXCHANGE_ACTIONS[action](exchange, user=request.user)
+  return JsonResponse(exchange_data(exchange))
+
+@_login_required
+@require_GET
+@condition(etag_func=_public_etag)
+def public_offers(request):
+  """Public offers waiting for a player to claim them, newest first."""
+  listing = Exchange.objects.public_offers().select_related('offeror',
+    'offeror_territory')
+  return _page(request, listing, EXCHANGE_KEYS, exchange_data)
+
+@_action
+def claim_offer(request, exchange_pk):
+  """Accepts the public offer, if no other player claimed it first."""
+  exchange = Exchange.objects.filter(pk=exchange_pk,
+    offeree__isnull=True).first()
+  if exchange is None:
+    return _error(_("Offer not found."), status=404)
+  exchange.claim(user=request.user)
+  return JsonResponse(exchange_data(exchange))
+
+BOND_ACTIONS = {
+  'pay': Bond.pay,
+  'forgive': Bond.forgive,
+}
+
+@_action
+def update_bond(request, bond_pk, action):
+  bond = _bonds(request.user).filter(pk=bond_pk).first()
+  if bond is None:
+    return _error(_("Bond not found."), status=404)
+  BOND_ACTIONS[action](bond, user=request.user)
+  return JsonResponse(bond_data(bond))
+
+@_versioned
+def order_list(request):
+  """
+  Orders of the user, newest first, filtered by `state` (state codes,
+  default: open).
+  """
+  listing = Order.objects.filter(user=request.user,
+    state__in=list(request.GET.get('state', Order.OPEN)))
+  return _page(request, listing, ORDER_KEYS, order_data)
+
+def _build_order(user, data):
+  """Unsaved order placed by `user`, described by the JSON `data`."""
+  data = _object(data)
+  return Order(user=user, side=data.get('side'), good=data.get('good'),
+    price=data.get('price'), quantity=data.get('quantity'))
+
+@_action
+def place_orders(request):
+  """
+  Places the order described by the JSON body, answering 201, or the list
+  of orders in the body (see `orderbook.place_many`), answering with the
+  placed orders and the errors by index of the refused ones.
+  """
+  data = _json_body(request)
+  if not isinstance(data, list):
+    order = orderbook.place(_build_order(request.user, data))
+    return JsonResponse(order_data(order), status=201)
+  if len(data) > MAX_ORDERS:
+    raise ValidationError(_("At most %(count)d orders per request."),
+      params={'count': MAX_ORDERS})
+  placed, failures = orderbook.place_many([_build_order(request.user, item)
+    for item in data])
+  return JsonResponse({
+    'results': [order_data(order) for order in placed],
+    'errors': {str(i): e.messages[0] for i, e in failures.items()},
+  })
+
+def orders(request):
+  """Lists orders on GET, places them on POST."""
+  if request.method == 'POST':
+    return place_orders(request)
+  return order_list(request)
+
+@_action
+def cancel_order(request, order_pk):
+  order = Order.objects.filter(user=request.user, pk=order_pk).first()
+  if order is None:
+    return _error(_("Order not found."), status=404)
+  order.cancel(user=request.user)
+  return JsonResponse(order_data(order))
+
+@_login_required
+@require_GET
+def book(request, good):
+  """Open quantity at the best prices to buy and to sell `good`."""
+  if good not in orderbook.GOODS:
+    return _error(_("Unknown good."), status=404)
+  bids, asks = orderbook.depth(good)
+  return JsonResponse({
+    'good': good,
+    'bids': [{'price': p, 'quantity': q} for p, q in bids],
+    'asks': [{'price': p, 'quantity': q} for p, q in asks],
+  })
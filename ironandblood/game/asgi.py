@@ -0,0 +1,167 @@
+"""
+ASGI application for the game.
+
+Django 1.9 predates ASGI, async views and an async ORM, so `GameApplication`
+serves the long-poll events endpoint itself, waiting on the event broker
+without a thread, and hands every other HTTP request to the Django WSGI
+application on a bounded pool of threads.  Read-only pages (`home`,
+`exchanges`, `bonds`, ...) only hold a thread while they render: reading the
+request and sending the response happen on the event loop, and clients
+waiting for events cost a coroutine each instead of a worker.
+"""
+import asyncio
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib import auth
+from django.core.urlresolvers import reverse
+from django.db import close_old_connections
+from django.utils.six.moves.urllib.parse import parse_qs
+from django.utils.translation import ugettext as _
+
+from . import events
+
+DEFAULT_THREADS = 8
+
+class _SessionRequest(object):
+  """Just enough of a request for `auth.get_user`."""
+  def __init__(self, session):
+    self.session = session
+
+def _header(scope, name):
+  values = [value.decode('latin-1') for key, value in scope['headers']
+    if key.lower() == name]
+  return ', '.join(values)
+
+def session_user_pk(cookies):
+  """Pk of the user logged in by the session cookie in `cookies`, or None."""
+  morsel = SimpleCookie(cookies).get(settings.SESSION_COOKIE_NAME)
+  if morsel is None:
+    return None
+  engine = import_module(settings.SESSION_ENGINE)
+  close_old_connections()
+  try:
+    user = auth.get_user(_SessionRequest(engine.SessionStore(morsel.value)))
+  finally:
+    close_old_connections()
+  return user.pk if user.is_authenticated() else None
+
+def wsgi_environ(scope, body):
+  """WSGI environ of the ASGI HTTP `scope` with request `body`."""
+  server = scope.get('server') or ('localhost', 80)
+  client = scope.get('client') or ('', 0)
+  environ = {
+    'REQUEST_METHOD': scope['method'],
+    'SCRIPT_NAME': scope.get('root_path', ''),
+    # WSGI strings are bytes decoded as latin-1.
+    'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+    'QUERY_STRING': scope['query_string'].decode('latin-1'),
+    'SERVER_NAME': server[0],
+    'SERVER_PORT': str(server[1]),
+    'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+    'REMOTE_ADDR': client[0],
+    'wsgi.version': (1, 0),
+    'wsgi.url_scheme': scope.get('scheme', 'http'),
+    'wsgi.input': io.BytesIO(body),
+    'wsgi.errors': sys.stderr,
+    'wsgi.multithread': True,
+    'wsgi.multiprocess': False,
+    'wsgi.run_once': False,
+  }
+  for name, value in scope['headers']:
+    name = name.decode('latin-1').upper().replace('-', '_')
+    value = value.decode('latin-1')
+    if name not in ['CONTENT_TYPE', 'CONTENT_LENGTH']:
+      name = 'HTTP_' + name
+    environ[name] = environ[name] + ',' + value if name in environ else value
+  return environ
+
+def call_wsgi(application, environ):
+  """(status, headers, body) of the response of a WSGI `application`."""
+  response = dict()
+  def start_response(status, headers, exc_info=None):
+    response['status'] = int(status.split(' ', 1)[0])
+    response['headers'] = headers
+  chunks = application(environ, start_response)
+  try:
+    body = b''.join(chunks)
+  finally:
+    if hasattr(chunks, 'close'):
+      chunks.close()
+  return response['status'], response['headers'], body
+
+def _json(data, status=200):
+  return status, [('Content-Type', 'application/json')], \
+    json.dumps(data).encode('utf-8')
+
+async def _read_body(receive):
+  body = b''
+  while True:
+    message = await receive()
+    if message['type'] == 'http.disconnect':
+      return body
+    body += message.get('body', b'')
+    if not message.get('more_body'):
+      return body
+
+class GameApplication(object):
+  """
+  ASGI 3 application serving the events endpoint asynchronously and the rest
+  of `wsgi_application` on `threads` threads.
+  """
+  def __init__(self, wsgi_application, threads=DEFAULT_THREADS):
+    self.wsgi_application = wsgi_application
+    self.executor = ThreadPoolExecutor(max_workers=threads)
+    self._events_path = None
+
+  def events_path(self):
+    if self._events_path is None:
+      self._events_path = reverse('game:api_events')
+    return self._events_path
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      return await self._lifespan(receive, send)
+    if scope['type'] != 'http':
+      raise ValueError('Unsupported scope type {}.'.format(scope['type']))
+    loop = asyncio.get_event_loop()
+    body = await _read_body(receive)
+    if scope['method'] == 'GET' and scope['path'] == self.events_path():
+      status, headers, content = await self._events(scope)
+    else:
+      status, headers, content = await loop.run_in_executor(self.executor,
+        call_wsgi, self.wsgi_application, wsgi_environ(scope, body))
+    await send({
+      'type': 'http.response.start',
+      'status': status,
+      'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+        for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': content})
+
+  async def _events(self, scope):
+    """`api.poll_events`, waiting on the event loop."""
+    loop = asyncio.get_event_loop()
+    user_pk = await loop.run_in_executor(self.executor, session_user_pk,
+      _header(scope, b'cookie'))
+    if user_pk is None:
+      return _json({'error': _("Authentication required.")}, status=401)
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    after = events.cursor(query.get('after', [None])[0])
+    found = await events.broker().wait_async(user_pk, after, events.timeout())
+    return _json(events.result(found, after))
+
+  async def _lifespan(self, receive, send):
+    while True:
+      message = await receive()
+      if message['type'] == 'lifespan.startup':
+        await send({'type': 'lifespan.startup.complete'})
+      elif message['type'] == 'lifespan.shutdown':
+        self.executor.shutdown(wait=False)
+        await send({'type': 'lifespan.shutdown.complete'})
+        return
@@ -0,0 +1,6 @@
+"""
+Performance benchmarks for the game.
+
+Benchmarks seed their own data on a scratch database and are run through
+the `benchmark` management command.
+"""
@@ -0,0 +1,98 @@
+"""
+Seeding and measurement helpers shared by the benchmark suites.
+"""
+import datetime
+import random
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ..models import Bond, Exchange, Player, Resources, Territory
+
+EXCHANGE_STATES = [Exchange.WAITING, Exchange.ACCEPTED, Exchange.REJECTED,
+  Exchange.CANCELED]
+BOND_STATES = [Bond.PENDING, Bond.PAID, Bond.FORGIVEN]
+
+def seed_game(players=100, territories=100, rows=1000, rng=None,
+  currency=10 ** 6):
+  """
+  Creates `players` players holding `currency` (and as many goods),
+  `territories` territories owned round-robin, and a history of `rows`
+  exchanges and `rows` bonds (with their originating and paying
+  exchanges) between random players.
+  Returns the list of users.
+  """
+  rng = rng or random.Random(0)
+  User.objects.bulk_create([User(username='bench{}'.format(i))
+    for i in range(players)])
+  users = list(User.objects.filter(username__startswith='bench'))
+  for user in users:
+    resources = Resources.objects.create(currency=currency,
+      manufactured=currency, agricultural=currency)
+    Player.objects.create(user=user, resources=resources)
+
+  Territory.objects.bulk_create([Territory(code='B{}'.format(i),
+    name='Bench {}'.format(i), owner=users[i % len(users)])
+    for i in range(territories)])
+
+  now = timezone.now()
+  exchanges = list()
+  for i in range(rows):
+    offeror, offeree = rng.sample(users, 2)
+    exchanges.append(Exchange(offeror=offeror, offeree=offeree,
+      state=rng.choice(EXCHANGE_STATES),
+      offer_date=now - datetime.timedelta(minutes=rows - i)))
+  Exchange.objects.bulk_create(exchanges)
+
+  # As in a real game, every bond originates from an accepted exchange and
+  # paid bonds also reference the exchange that paid them.
+  answered = list()
+  for i in range(rows):
+    holder, borrower = rng.sample(users, 2)
+    for j in range(2):
+      answered.append(Exchange(offeror=borrower, offeree=holder,
+        state=Exchange.ACCEPTED, offer_date=now, answer_date=now))
+  Exchange.objects.bulk_create(answered)
+  answered = list(Exchange.objects.filter(offer_date=now).order_by('pk'))
+  bonds = list()
+  for origin, payment in zip(answered[::2], answered[1::2]):
+    state = rng.choice(BOND_STATES)
+    bonds.append(Bond(holder_id=origin.offeree_id,
+      borrower_id=origin.offeror_id, state=state, origin_exchange=origin,
+      payment_exchange=payment if state == Bond.PAID else None))
+  Bond.objects.bulk_create(bonds)
+  return users
+
+def measure(label, operations, fn, batch=False):
+  """
+  Calls `fn(i)` for `i` in `range(operations)` (or `fn()` once if `batch`
+  processes all operations in one call) and returns its wall time, query
+  count and peak traced memory, in total and per operation.
+  """
+  tracemalloc.start()
+  try:
+    with CaptureQueriesContext(connection) as queries:
+      start = time.perf_counter()
+      if batch:
+        fn()
+      else:
+        for i in range(operations):
+          fn(i)
+      seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+  operations = max(operations, 1)
+  return {
+    'label': label,
+    'operations': operations,
+    'seconds': seconds,
+    'seconds_per_operation': seconds / operations,
+    'queries': len(queries),
+    'queries_per_operation': len(queries) / operations,
+    'peak_memory_kib': peak / 1024,
+  }
@@ -0,0 +1,194 @@
+"""
+Connection capacity of the WSGI and ASGI deployments.
+
+Each deployment is served on a local port with the same number of worker
+threads.  `held` clients open long-poll requests on the events endpoint and
+stay connected, then a probe client requests the home page.  Under WSGI
+every waiting client pins a worker, so once `held` reaches the number of
+workers the probe waits until the long polls time out; under ASGI waiting
+clients hold no thread and the probe is served right away.
+"""
+import asyncio
+import http.client
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.urlresolvers import reverse
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils.six.moves.urllib.parse import unquote
+
+from ..asgi import GameApplication
+from .base import seed_game
+
+HOST = '127.0.0.1'
+
+class _QuietHandler(WSGIRequestHandler):
+  def log_message(self, *args):
+    pass
+
+class _PooledWSGIServer(WSGIServer):
+  """WSGI server handling requests on `workers` threads, like gthread."""
+  def __init__(self, workers):
+    super(_PooledWSGIServer, self).__init__((HOST, 0), _QuietHandler)
+    self.pool = ThreadPoolExecutor(max_workers=workers)
+
+  def process_request(self, request, client_address):
+    self.pool.submit(self._process, request, client_address)
+
+  def _process(self, request, client_address):
+    try:
+      self.finish_request(request, client_address)
+    except ConnectionError:
+      # Held long polls are closed by the client before they are answered.
+      pass
+    except Exception:
+      self.handle_error(request, client_address)
+    finally:
+      self.shutdown_request(request)
+
+def _serve_wsgi(workers):
+  """Starts a WSGI server, returns (port, stop)."""
+  server = _PooledWSGIServer(workers)
+  server.set_app(WSGIHandler())
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  def stop():
+    server.shutdown()
+    server.server_close()
+    server.pool.shutdown(wait=False)
+  return server.server_address[1], stop
+
+async def _handle(application, reader, writer):
+  """Serves one HTTP/1.0 request with the ASGI `application`."""
+  try:
+    method, target, version = (await reader.readline()).decode(
+      'latin-1').split()
+    headers = list()
+    while True:
+      line = await reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      name, value = line.decode('latin-1').split(':', 1)
+      headers.append((name.strip().lower().encode('latin-1'),
+        value.strip().encode('latin-1')))
+    length = int(dict(headers).get(b'content-length', 0))
+    body = await reader.readexactly(length) if length else b''
+    path, _, query = target.partition('?')
+    scope = {
+      'type': 'http',
+      'http_version': version.split('/')[1],
+      'method': method,
+      'scheme': 'http',
+      'path': unquote(path),
+      'query_string': query.encode('latin-1'),
+      'root_path': '',
+      'headers': headers,
+      'server': writer.get_extra_info('sockname')[:2],
+      'client': writer.get_extra_info('peername')[:2],
+    }
+    async def receive():
+      return {'type': 'http.request', 'body': body, 'more_body': False}
+    async def send(message):
+      if message['type'] == 'http.response.start':
+        writer.write('HTTP/1.0 {} -\r\n'.format(message['status']).encode())
+        for name, value in message['headers']:
+          writer.write(name + b': ' + value + b'\r\n')
+        writer.write(b'\r\n')
+      else:
+        writer.write(message.get('body', b''))
+    await application(scope, receive, send)
+    await writer.drain()
+  except (ConnectionError, ValueError):
+    pass
+  finally:
+    writer.close()
+
+def _serve_asgi(workers):
+  """Starts a minimal ASGI server, returns (port, stop)."""
+  application = GameApplication(WSGIHandler(), threads=workers)
+  loop = asyncio.new_event_loop()
+  server = loop.run_until_complete(asyncio.start_server(
+    lambda reader, writer: _handle(application, reader, writer),
+    HOST, 0, loop=loop, backlog=1024))
+  thread = threading.Thread(target=loop.run_forever, daemon=True)
+  thread.start()
+  async def close():
+    server.close()
+    current = asyncio.Task.current_task(loop=loop)
+    tasks = [task for task in asyncio.Task.all_tasks(loop=loop)
+      if task is not current]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, loop=loop, return_exceptions=True)
+    loop.stop()
+  def stop():
+    asyncio.run_coroutine_threadsafe(close(), loop)
+    thread.join()
+    loop.close()
+    application.executor.shutdown(wait=False)
+  return server.sockets[0].getsockname()[1], stop
+
+def _hold(port, path, cookie):
+  """Opens a long-poll request and leaves it waiting."""
+  sock = socket.create_connection((HOST, port))
+  sock.sendall('GET {} HTTP/1.0\r\nHost: {}:{}\r\nCookie: {}\r\n\r\n'.format(
+    path, HOST, port, cookie).encode('latin-1'))
+  return sock
+
+def _probe(port, path, cookie, timeout):
+  """(status, seconds) of a request to `path`."""
+  start = time.perf_counter()
+  connection = http.client.HTTPConnection(HOST, port, timeout=timeout)
+  try:
+    connection.request('GET', path, headers={'Cookie': cookie})
+    status = connection.getresponse().status
+  except socket.timeout:
+    status = None
+  finally:
+    connection.close()
+  return status, time.perf_counter() - start
+
+def measure_deployment(label, serve, cookie, workers, held, hold):
+  port, stop = serve(workers)
+  sockets = list()
+  try:
+    sockets = [_hold(port, reverse('game:api_events'), cookie)
+      for i in range(held)]
+    # Let the server pick the waiting requests up.
+    time.sleep(min(0.2, hold / 4))
+    status, seconds = _probe(port, reverse('game:home'), cookie, hold * 4)
+  finally:
+    for sock in sockets:
+      sock.close()
+    stop()
+  return {
+    'label': label,
+    'workers': workers,
+    'held_connections': held,
+    'probe_status': status,
+    'probe_seconds': seconds,
+    # The probe was served before the long polls timed out.
+    'served_while_held': status == 200 and seconds < hold / 2,
+  }
+
+def run(players=100, territories=100, rows=1000, workers=4, held=16,
+  hold=2):
+  """
+  Compares both deployments with `workers` threads and `held` waiting
+  clients whose long polls time out after `hold` seconds.  The database must
+  be visible to other threads (a file-backed SQLite database or a server).
+  """
+  users = seed_game(players, territories, rows)
+  client = Client()
+  client.force_login(users[0])
+  cookie = '{}={}'.format(settings.SESSION_COOKIE_NAME,
+    client.cookies[settings.SESSION_COOKIE_NAME].value)
+  with override_settings(GAME_EVENT_TIMEOUT=hold, ALLOWED_HOSTS=['*']):
+    return [measure_deployment(label, serve, cookie, workers, held, hold)
+      for label, serve in [('wsgi', _serve_wsgi), ('asgi', _serve_asgi)]]
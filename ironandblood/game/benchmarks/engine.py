@@ -0,0 +1,81 @@
+"""
+Cost of the exchange engine: offers, accepts, bond payments, charter grants
+and order book placements (one by one and in bulk) on top of a seeded game.
+"""
+import random
+
+from .. import orderbook
+from ..models import Bond, Charter, Exchange, Order, Resources, Territory
+from .base import measure, seed_game
+
+def _exchanges(users, count, rng, **kwargs):
+  """Unsaved exchanges of currency for agricultural goods."""
+  exchanges = list()
+  for i in range(count):
+    offeror, offeree = rng.sample(users, 2)
+    exchanges.append(Exchange(offeror=offeror,
+      offeror_resources=Resources(currency=rng.randint(1, 100)),
+      offeree=offeree,
+      offeree_resources=Resources(agricultural=rng.randint(1, 10)),
+      **kwargs))
+  return exchanges
+
+def _orders(users, count, rng):
+  """Unsaved orders around a price of 100, half of them crossing."""
+  return [Order(user=rng.choice(users), side=rng.choice([Order.BUY,
+    Order.SELL]), good=rng.choice(orderbook.GOODS),
+    price=rng.randint(95, 105), quantity=rng.randint(1, 10))
+    for i in range(count)]
+
+def run(players=100, territories=100, rows=1000, operations=100):
+  rng = random.Random(0)
+  users = seed_game(players, territories, rows, rng)
+  results = list()
+
+  offered = _exchanges(users, operations, rng)
+  results.append(measure('Exchange.offer', operations,
+    lambda i: offered[i].offer(user=offered[i].offeror)))
+
+  waiting = list(Exchange.objects.filter(pk__in=[e.pk for e in offered]))
+  results.append(measure('Exchange.accept', operations,
+    lambda i: waiting[i].accept(user=waiting[i].offeree)))
+
+  offeree = users[0]
+  batch = _exchanges(users[1:], operations, rng)
+  for exchange in batch:
+    exchange.offeree = offeree
+    exchange.offer(user=exchange.offeror)
+  results.append(measure('Exchange.objects.accept_many', operations,
+    lambda: Exchange.objects.accept_many(batch, offeree), batch=True))
+
+  for exchange in _exchanges(users, operations, rng, offeror_as_bond=True):
+    exchange.offer(user=exchange.offeror)
+    exchange.accept(user=exchange.offeree)
+  bonds = list(Bond.objects.filter(state=Bond.PENDING).exclude(currency=0,
+    manufactured=0, agricultural=0))
+  results.append(measure('Bond.pay', len(bonds),
+    lambda i: bonds[i].pay(user=bonds[i].borrower)))
+
+  # Distinct (territory, member) pairs of 1% each.
+  territory_list = list(Territory.objects.select_related('owner'))
+  grants = list()
+  for i in range(2 * operations):
+    rounds, index = divmod(i, len(territory_list))
+    grants.append((territory_list[index],
+      users[(index + rounds + 1) % len(users)]))
+  results.append(measure('Charter.grant', operations,
+    lambda i: Charter.grant(leaser=grants[i][0].owner,
+      territory=grants[i][0], member=grants[i][1], size=1).save()))
+
+  charters = [Charter(territory=territory, member=member, size=1)
+    for territory, member in grants[operations:]]
+  results.append(measure('Charter.grant_many', operations,
+    lambda: Charter.grant_many(charters), batch=True))
+
+  placed = _orders(users, operations, rng)
+  results.append(measure('orderbook.place', operations,
+    lambda i: orderbook.place(placed[i])))
+  batch = _orders(users, operations, rng)
+  results.append(measure('orderbook.place_many', operations,
+    lambda: orderbook.place_many(batch), batch=True))
+  return results
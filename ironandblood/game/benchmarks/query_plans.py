@@ -0,0 +1,127 @@
+"""
+Query plans of the listing hot paths.
+
+Seeds a large exchange and bond history and asks SQLite which plan it picks
+for every query `build_context` and the listing views issue, checking that
+the composite indexes on Exchange and Bond are used.  Later pages of the
+listings are explained as the views run them (`for_listing` rows after a
+cursor), checking that the index seeks the page instead of walking every
+newer row.
+
+Listings filtered on several states still sort the matching rows on every
+page (USE TEMP B-TREE FOR ORDER BY), see `pagination.paginate`.
+"""
+import time
+
+from django.db import connection
+
+from ..models import Bond, Exchange
+from ..pagination import PAGE_SIZE, encode, seek
+from ..views import BOND_KEYS, EXCHANGE_KEYS
+from .base import seed_game
+
+def explain(queryset):
+  """Lines of SQLite's EXPLAIN QUERY PLAN for `queryset`."""
+  sql, params = queryset.query.sql_with_params()
+  with connection.cursor() as cursor:
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+def index_name(model, columns):
+  """Name of the index of `model` over exactly `columns`."""
+  table = model._meta.db_table
+  with connection.cursor() as cursor:
+    constraints = connection.introspection.get_constraints(cursor, table)
+  for name, info in constraints.items():
+    if info['index'] and info['columns'] == list(columns):
+      return name
+  return None
+
+def later_page(queryset, keys, depth=2):
+  """Query of the page after the first `depth` pages of a listing."""
+  rows = list(seek(queryset, keys)[:depth * PAGE_SIZE])
+  cursor = encode(rows[-1], keys) if rows else None
+  return seek(queryset, keys, cursor)[:PAGE_SIZE + 1]
+
+def hot_paths(user, other):
+  """
+  (label, queryset, model, acceptable index columns, column the index must
+  bound or None) for each query issued by `build_context` and the listing
+  views, as seen by `user`.
+  """
+  states = [Exchange.WAITING, Exchange.ACCEPTED]
+  offeree = ['offeree_id', 'state', 'offer_date']
+  offeror = ['offeror_id', 'state', 'offer_date']
+  holder = ['holder_id', 'state']
+  borrower = ['borrower_id', 'state']
+  exchanges = Exchange.objects.order_by('-offer_date', '-pk')
+  bonds = Bond.objects.order_by('-pk')
+  return [
+    ('build_context waiting_exchanges',
+      Exchange.objects.filter(offeree=user, state=Exchange.WAITING),
+      Exchange, [offeree], None),
+    ('build_context pending_bonds',
+      Bond.objects.filter(borrower=user, state=Bond.PENDING),
+      Bond, [borrower], None),
+    ('exchanges received',
+      exchanges.filter(offeree=user, state__in=states)[:26],
+      Exchange, [offeree], None),
+    ('exchanges sent',
+      exchanges.filter(offeror=user, state__in=states)[:26],
+      Exchange, [offeror], None),
+    ('new_exchange history',
+      exchanges.filter(offeror__in=[user, other], offeree__in=[user, other],
+        state__in=states)[:26],
+      Exchange, [offeror, offeree], None),
+    ('bonds as holder',
+      bonds.filter(holder=user, state__in=[Bond.PENDING])[:26],
+      Bond, [holder], None),
+    ('bonds as borrower',
+      bonds.filter(borrower=user, state__in=[Bond.PENDING])[:26],
+      Bond, [borrower], None),
+    ('public offers',
+      Exchange.objects.public_offers()[:26],
+      Exchange, [offeree], None),
+    ('exchanges received, page 3',
+      later_page(Exchange.objects.for_listing().filter(offeree=user,
+        state__in=[Exchange.WAITING]), EXCHANGE_KEYS),
+      Exchange, [offeree], 'offer_date'),
+    ('exchanges sent, page 3',
+      later_page(Exchange.objects.for_listing().filter(offeror=user,
+        state__in=[Exchange.WAITING]), EXCHANGE_KEYS),
+      Exchange, [offeror], 'offer_date'),
+    ('bonds as holder, page 3',
+      later_page(Bond.objects.for_listing().filter(holder=user,
+        state__in=[Bond.PENDING]), BOND_KEYS),
+      Bond, [holder], 'rowid'),
+  ]
+
+def run(rows=100000, players=100):
+  """
+  Seeds `rows` exchanges and bonds and returns, for each hot path, its
+  plan, the composite index it uses (if any) and the query time.
+  """
+  users = seed_game(players=players, territories=0, rows=rows)
+  with connection.cursor() as cursor:
+    cursor.execute('ANALYZE')
+  results = list()
+  for label, queryset, model, indexes, bound in hot_paths(users[0],
+    users[1]):
+    indexes = [index_name(model, columns) for columns in indexes]
+    plan = explain(queryset)
+    index = next((i for i in indexes if any(i in l for l in plan)), None)
+    # SQLite shows the range of an index search as `column<?`.
+    bounded = bound is None or any(index in l and bound + '<' in l
+      for l in plan if index is not None)
+    start = time.perf_counter()
+    list(queryset)
+    seconds = time.perf_counter() - start
+    results.append({
+      'label': label,
+      'index': index,
+      'uses_index': index is not None,
+      'bounded': bounded,
+      'plan': plan,
+      'seconds': seconds,
+    })
+  return results
@@ -0,0 +1,45 @@
+"""
+Cost of each page in `game.urls`, requested by a logged in player on top of
+a seeded game.  Views that change state on POST (`update_exchange`,
+`update_bond`) are covered by the engine suite, and `logout` is left out.
+"""
+import random
+
+from django.core.urlresolvers import reverse
+from django.test import Client
+
+from .. import counters
+from .base import measure, seed_game
+
+def pages(users):
+  """(url name, args) of every page a player can GET."""
+  other = users[1].username
+  return [
+    ('game:home', []),
+    ('game:map_colors', []),
+    ('game:exchanges', []),
+    ('game:filter_exchanges', ['WARC']),
+    ('game:exchange', [other]),
+    ('game:filter_exchanges_offer', [other, 'WARC']),
+    ('game:bonds', []),
+    ('game:filter_bonds', ['WPF']),
+    ('game:bond', [other]),
+    ('game:filter_bonds_offer', [other, 'WPF']),
+    ('game:profile', []),
+    ('game:login', []),
+  ]
+
+def run(players=100, territories=100, rows=1000, operations=100):
+  users = seed_game(players, territories, rows, random.Random(0))
+  client = Client()
+  client.force_login(users[0])
+  results = list()
+  for name, args in pages(users):
+    url = reverse(name, args=args)
+    # Cold header cache on the first request, warm afterwards.
+    counters.cache().clear()
+    result = measure(name, operations, lambda i: client.get(url))
+    result['url'] = url
+    result['status_code'] = client.get(url).status_code
+    results.append(result)
+  return results
@@ -19,3 +19,15 @@ class Config:
     seconds = (date - Config.start_date).total_seconds()
     norm = 0.004224537037037037 # 1s / (60s * 60m) / 24h * 365d
     return Config.start_epoch + datetime.timedelta(days = seconds * norm)
+
+  @staticmethod
+  def current_turn():
+    return Config.to_turn(datetime.datetime.now())
+
+  @staticmethod
+  def to_turn(date):
+    """
+    Returns the turn `date` falls in, counted from `start_date`.
+    1 turn = 1 real-time day.
+    """
+    return int((date - Config.start_date).total_seconds() // (24 * 60 * 60))
@@ -0,0 +1,59 @@
+"""
+Per-player counters shown in the header of every page.
+
+Counters are kept in the cache named by the `GAME_CACHE` setting and are
+invalidated by every exchange and bond state transition, so a page view
+costs no query for the header while the cache is warm.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+DEFAULT_TIMEOUT = 300
+
+def cache():
+  return caches[getattr(settings, 'GAME_CACHE', 'default')]
+
+def _key(user_pk):
+  return 'game:header:{}'.format(user_pk)
+
+def _compute(user):
+  from .models import Bond, Exchange, Resources
+
+  # Users without a player (e.g. administrators) hold nothing.
+  resources = Resources.objects.filter(player__user=user).first() or \
+    Resources()
+  return {
+    'waiting_exchanges': Exchange.objects.filter(offeree=user,
+      state=Exchange.WAITING).count(),
+    'pending_bonds': Bond.objects.filter(borrower=user,
+      state=Bond.PENDING).count(),
+    'currency': resources.currency,
+    'manufactured': resources.manufactured,
+    'agricultural': resources.agricultural,
+  }
+
+def header(user):
+  """
+  Dictionary with `user`'s waiting exchanges, pending bonds and resources.
+  """
+  key = _key(user.pk)
+  counters = cache().get(key)
+  if counters is None:
+    counters = _compute(user)
+    cache().set(key, counters,
+      getattr(settings, 'GAME_HEADER_TIMEOUT', DEFAULT_TIMEOUT))
+  return counters
+
+def invalidate(*users):
+  """
+  Drops the counters of `users`.  Inside a transaction they are dropped
+  again on commit, so that a concurrent request cannot cache values read
+  before the commit.
+  """
+  keys = [_key(user.pk) for user in users if user is not None]
+  if not keys:
+    return
+  cache().delete_many(keys)
+  if transaction.get_connection().in_atomic_block:
+    transaction.on_commit(lambda: cache().delete_many(keys))
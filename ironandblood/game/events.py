@@ -0,0 +1,167 @@
+"""
+Change notifications for players.
+
+Exchange, bond and order transitions publish a small event (kind, pk and new
+state) to the players taking part, once the transaction commits.  Clients wait for
+them on the long-poll endpoint of the JSON API instead of polling listings,
+and fetch the objects they are told about.
+
+Events go through the broker named by the `GAME_EVENT_BROKER` setting.  The
+default `LocalBroker` keeps the last events of each player in memory, which
+only works with a single server process; a broker backed by a shared store
+(e.g. Redis pub/sub) implementing the same `last`, `publish`, `wait` and
+`wait_async` methods can replace it.  Event ids are only meaningful to the
+broker that issued them: a client that missed events (its `after` id is
+unknown or older than the backlog kept) should resynchronize through the
+listings.
+"""
+import asyncio
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+BACKLOG = 100
+DEFAULT_TIMEOUT = 25
+
+class LocalBroker(object):
+  """In-process broker keeping the last `backlog` events of each player."""
+  def __init__(self, backlog=BACKLOG):
+    self._backlog = backlog
+    self._condition = threading.Condition()
+    self._last = 0
+    self._events = dict()
+    self._listeners = dict()
+
+  def last(self):
+    """Id of the last event published."""
+    return self._last
+
+  def publish(self, messages):
+    """Publishes `messages`, a list of (user pks, event dictionary)."""
+    with self._condition:
+      for user_pks, event in messages:
+        self._last += 1
+        event = dict(event, id=self._last)
+        for user_pk in user_pks:
+          if user_pk not in self._events:
+            self._events[user_pk] = collections.deque(maxlen=self._backlog)
+          self._events[user_pk].append(event)
+          for listener in self._listeners.get(user_pk, ()):
+            listener()
+      self._condition.notify_all()
+
+  def _after(self, user_pk, after):
+    return [event for event in self._events.get(user_pk, ())
+      if event['id'] > after]
+
+  def wait(self, user_pk, after, timeout):
+    """
+    Events of `user_pk` with an id greater than `after`, waiting up to
+    `timeout` seconds for one when there is none yet.
+    """
+    deadline = time.monotonic() + timeout
+    with self._condition:
+      # Ids from before a restart of the broker would hide every new event.
+      after = min(after, self._last)
+      while True:
+        events = self._after(user_pk, after)
+        remaining = deadline - time.monotonic()
+        if events or remaining <= 0:
+          return events
+        self._condition.wait(remaining)
+
+  async def wait_async(self, user_pk, after, timeout):
+    """`wait` for event loops: waits without holding a thread."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    ready = asyncio.Event()
+    def listener():
+      loop.call_soon_threadsafe(ready.set)
+    with self._condition:
+      after = min(after, self._last)
+      self._listeners.setdefault(user_pk, set()).add(listener)
+    try:
+      while True:
+        ready.clear()
+        with self._condition:
+          events = self._after(user_pk, after)
+        remaining = deadline - loop.time()
+        if events or remaining <= 0:
+          return events
+        try:
+          await asyncio.wait_for(ready.wait(), remaining)
+        except asyncio.TimeoutError:
+          pass
+    finally:
+      with self._condition:
+        listeners = self._listeners[user_pk]
+        listeners.discard(listener)
+        if not listeners:
+          del self._listeners[user_pk]
+
+_broker = None
+_broker_lock = threading.Lock()
+
+def broker():
+  global _broker
+  with _broker_lock:
+    if _broker is None:
+      _broker = import_string(getattr(settings, 'GAME_EVENT_BROKER',
+        'game.events.LocalBroker'))()
+    return _broker
+
+def timeout():
+  """Seconds a long-poll request waits for events."""
+  return getattr(settings, 'GAME_EVENT_TIMEOUT', DEFAULT_TIMEOUT)
+
+def cursor(after):
+  """
+  Event id to wait after, from the `after` request parameter (default: the
+  last event, to wait for events from now on).
+  """
+  try:
+    return int(after)
+  except (TypeError, ValueError):
+    return broker().last()
+
+def result(events, after):
+  """
+  Long-poll response of `events` found after `after`; `last` is the id to
+  pass as `after` in the next request.
+  """
+  return {
+    'events': events,
+    'last': events[-1]['id'] if events else min(after, broker().last()),
+  }
+
+def _publish(messages):
+  messages = [(set(user_pks) - set([None]), event)
+    for user_pks, event in messages]
+  if not messages:
+    return
+  # Listeners fetch what they are notified about, so never before the commit.
+  if transaction.get_connection().in_atomic_block:
+    transaction.on_commit(lambda: broker().publish(messages))
+  else:
+    broker().publish(messages)
+
+def _message(kind, obj, *users):
+  return users, {'type': kind, 'object': obj.pk, 'state': obj.state}
+
+def exchanges_changed(exchanges):
+  """Notifies the offerors and offerees of `exchanges` of their state."""
+  _publish([_message('exchange', exchange, exchange.offeror_id,
+    exchange.offeree_id) for exchange in exchanges])
+
+def bonds_changed(bonds):
+  """Notifies the holders and borrowers of `bonds` of their state."""
+  _publish([_message('bond', bond, bond.holder_id, bond.borrower_id)
+    for bond in bonds])
+
+def orders_changed(orders):
+  """Notifies the players of `orders` of their state."""
+  _publish([_message('order', order, order.user_id) for order in orders])
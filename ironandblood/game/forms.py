@@ -1,5 +1,6 @@
 from django import forms
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.utils.translation import ugettext_lazy as _
 
 from .models import Exchange, Resources, Territory, Bond
@@ -69,18 +70,25 @@ class ExchangeForm(forms.Form):
   def update(self, field_name, attr, value):
     self.fields[field_name].widget.attrs[attr] = value
 
+  def build_resources(self, side):
+    """
+    Unsaved `Resources` offered by `side` ('offeror' or 'offeree'); the
+    exchange stores their values in its own columns.
+    """
+    return Resources(
+        currency = self.cleaned_data[side + '_currency'],
+        agricultural = self.cleaned_data[side + '_agricultural'],
+        manufactured = self.cleaned_data[side + '_manufactured'])
+
+  @transaction.atomic
   def build_and_offer(self, offeror, offeree, id_offeror_territory,
     id_offeree_territory):
-    offeror_res = Resources(
-        currency = self.cleaned_data['offeror_currency'],
-        agricultural = self.cleaned_data['offeror_agricultural'],
-        manufactured = self.cleaned_data['offeror_manufactured'])
-    offeror_res.save()
-    offeree_res = Resources(
-        currency = self.cleaned_data['offeree_currency'],
-        agricultural = self.cleaned_data['offeree_agricultural'],
-        manufactured = self.cleaned_data['offeree_manufactured'])
-    offeree_res.save()
+    """
+    Creates and offers the exchange; nothing is left behind if the offer
+    fails.
+    """
+    offeror_res = self.build_resources('offeror')
+    offeree_res = self.build_resources('offeree')
 
     offeror_territory = None
     if id_offeror_territory:
@@ -104,23 +112,18 @@ class ExchangeForm(forms.Form):
       except Bond.DoesNotExist:
         raise ValidationError(_("Invalid Bond number."))
 
-    try:
-      exch = Exchange(
-        offeror = offeror,
-        offeror_resources = offeror_res,
-        offeror_territory = offeror_territory,
-        offeror_bond = offeror_bond,
-        offeror_as_bond = self.cleaned_data['offeror_as_bond'],
-        offeror_as_bond_maturity = 0,
-        offeree = offeree,
-        offeree_resources = offeree_res,
-        offeree_territory = offeree_territory,
-        offeree_bond = offeree_bond,
-        offeree_as_bond = self.cleaned_data['offeree_as_bond'],
-        offeree_as_bond_maturity = 0
-        )
-      exch.offer(user = offeror)
-    except Exception as e:
-      offeror_res.delete()
-      offeree_res.delete()
-      raise e
+    exch = Exchange(
+      offeror = offeror,
+      offeror_resources = offeror_res,
+      offeror_territory = offeror_territory,
+      offeror_bond = offeror_bond,
+      offeror_as_bond = self.cleaned_data['offeror_as_bond'],
+      offeror_as_bond_maturity = 0,
+      offeree = offeree,
+      offeree_resources = offeree_res,
+      offeree_territory = offeree_territory,
+      offeree_bond = offeree_bond,
+      offeree_as_bond = self.cleaned_data['offeree_as_bond'],
+      offeree_as_bond_maturity = 0
+      )
+    exch.offer(user = offeror)
@@ -0,0 +1,120 @@
+"""
+Resource ledger queries.
+
+Every change to a player's resources made by an exchange (and thus by bond
+payments) is appended to `ResourceLedger`.  `take_snapshot` periodically
+stores every player's balance in `ResourceSnapshot`, so the balance at any
+time is the last snapshot before it plus the few ledger entries after the
+snapshot, found through indexes instead of by replaying the whole ledger.
+
+Each snapshot is the previous one plus the entries since, never a copy of
+the live rows, so a balance changed outside of the ledger keeps showing in
+`verify` instead of being absorbed by the next snapshot.  Only the first
+snapshot of a player takes the live balance, as the opening balance of
+resources set before the ledger knew them (e.g. seeding).
+"""
+from django.db import transaction
+from django.db.models import Max, Sum
+
+from .models import (Player, ResourceLedger, ResourceSnapshot, Resources,
+  ResourceVector)
+
+CHUNK_SIZE = 500
+
+def _player_resources_chunks(chunk_size):
+  """Pks of players' resources rows, in ascending chunks."""
+  after = 0
+  while True:
+    chunk = list(Player.objects.filter(resources_id__gt=after)
+      .order_by('resources_id').values_list('resources_id', flat=True)
+      [:chunk_size])
+    if not chunk:
+      return
+    yield chunk
+    after = chunk[-1]
+
+def _latest_snapshots(resources_pks):
+  pks = ResourceSnapshot.objects.filter(resources__in=resources_pks) \
+    .values('resources').annotate(last=Max('pk')).values_list('last',
+    flat=True)
+  return {snapshot.resources_id: snapshot
+    for snapshot in ResourceSnapshot.objects.filter(pk__in=list(pks))}
+
+def _replay(resources_pks, snapshots):
+  """
+  `(balances, last entries)` of the `resources_pks` rows: value lists of
+  their latest snapshot plus the ledger entries after it, streamed, and the
+  pk of the last entry included (0 if none).
+  """
+  balances, last_entries = dict(), dict()
+  for pk in resources_pks:
+    snapshot = snapshots.get(pk, ResourceSnapshot())
+    balances[pk] = [getattr(snapshot, name) for name in Resources._list]
+    last_entries[pk] = snapshot.last_entry
+  since = dict(last_entries)
+  entries = ResourceLedger.objects.filter(resources__in=resources_pks,
+    pk__gt=min(since.values())).values_list('resources', 'pk',
+    *Resources._list)
+  for pk, entry_pk, *values in entries.iterator():
+    if entry_pk > since[pk]:
+      balances[pk] = [a + b for a, b in zip(balances[pk], values)]
+      last_entries[pk] = max(last_entries[pk], entry_pk)
+  return balances, last_entries
+
+def take_snapshot(chunk_size=CHUNK_SIZE):
+  """
+  Stores the balance of every player: its previous snapshot plus the ledger
+  entries since, or the live balance for a player's first snapshot.  Each
+  chunk of players locks its resources rows, so in-flight exchanges commit
+  their ledger entries first and each snapshot matches its `last_entry`.
+  Returns the number of snapshots taken.
+  """
+  taken = 0
+  for chunk in _player_resources_chunks(chunk_size):
+    with transaction.atomic():
+      live = {row[0]: list(row[1:]) for row in Resources.objects
+        .select_for_update().filter(pk__in=chunk).values_list('pk',
+        *Resources._list)}
+      snapshots = _latest_snapshots(chunk)
+      balances, last_entries = _replay(chunk, snapshots)
+      ResourceSnapshot.objects.bulk_create([ResourceSnapshot(
+        resources_id=pk, last_entry=last_entries[pk],
+        **dict(zip(Resources._list,
+          balances[pk] if pk in snapshots else live[pk])))
+        for pk in chunk])
+    taken += len(chunk)
+  return taken
+
+def balance_at(resources, date):
+  """
+  `Resources` (unsaved) with the balance of the `resources` row at `date`.
+  """
+  snapshot = ResourceSnapshot.objects.filter(resources=resources,
+    date__lte=date).order_by('-date', '-pk').first()
+  entries = ResourceLedger.objects.filter(resources=resources,
+    date__lte=date)
+  balance = ResourceVector.ZERO
+  if snapshot is not None:
+    balance = ResourceVector.of(snapshot)
+    entries = entries.filter(pk__gt=snapshot.last_entry)
+  sums = entries.aggregate(*[Sum(name) for name in Resources._list])
+  balance += ResourceVector(*[sums[name + '__sum'] or 0
+    for name in Resources._list])
+  return balance.to_resources()
+
+def verify(chunk_size=CHUNK_SIZE):
+  """
+  Recomputes the balance of every player from its latest snapshot and the
+  ledger entries after it, streaming the entries chunk by chunk, and yields
+  (resources pk, expected, actual) value lists for each mismatch.  Since
+  snapshots are derived from the ledger, a mismatch stays reported until
+  the balance is corrected.
+  """
+  for chunk in _player_resources_chunks(chunk_size):
+    with transaction.atomic():
+      actual = {row[0]: list(row[1:]) for row in Resources.objects.filter(
+        pk__in=chunk).values_list('pk', *Resources._list)}
+      expected, _last_entries = _replay(chunk, _latest_snapshots(chunk))
+    for pk in chunk:
+      if expected[pk] != actual[pk]:
+        yield pk, expected[pk], actual[pk]
@@ -0,0 +1,113 @@
+import datetime
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from game.benchmarks import connections, engine, query_plans, views
+
+SUITES = ['engine', 'views', 'query_plans', 'connections']
+
+class Command(BaseCommand):
+  help = ("Runs performance benchmarks, each suite on a fresh scratch test "
+    "database. Available suites: {}.".format(', '.join(SUITES)))
+
+  def add_arguments(self, parser):
+    parser.add_argument('suites', nargs='*', default=SUITES,
+      help='Suites to run (default: all).')
+    parser.add_argument('--players', type=int, default=100,
+      help='Number of players to seed.')
+    parser.add_argument('--territories', type=int, default=100,
+      help='Number of territories to seed (engine and views).')
+    parser.add_argument('--rows', type=int, default=100000,
+      help='Number of historical exchanges and bonds to seed.')
+    parser.add_argument('--operations', type=int, default=100,
+      help='Operations or requests measured per benchmark (waiting clients '
+      'for connections).')
+    parser.add_argument('--workers', type=int, default=4,
+      help='Worker threads of each deployment (connections).')
+    parser.add_argument('--json', action='store_true',
+      help='Print results as a JSON document.')
+    parser.add_argument('--output',
+      help='Write the JSON document to this file instead of stdout.')
+
+  def handle(self, *args, **options):
+    unknown = set(options['suites']) - set(SUITES)
+    if unknown:
+      raise CommandError('Unknown suites: {}.'.format(', '.join(unknown)))
+    if 'query_plans' in options['suites'] and connection.vendor != 'sqlite':
+      raise CommandError('Query plans are only available on SQLite.')
+
+    params = {name: options[name]
+      for name in ['players', 'territories', 'rows', 'operations', 'workers']}
+    results = dict()
+    setup_test_environment()
+    try:
+      for suite in options['suites']:
+        results[suite] = self.run_suite(suite, params)
+    finally:
+      teardown_test_environment()
+
+    if options['json'] or options['output']:
+      document = json.dumps({
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'parameters': params,
+        'results': results,
+      }, indent=2, sort_keys=True)
+      if options['output']:
+        with open(options['output'], 'w') as output:
+          output.write(document + '\n')
+      else:
+        self.stdout.write(document)
+    else:
+      for suite in options['suites']:
+        self.write_text(suite, results[suite], params)
+
+  def run_suite(self, suite, params):
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+      if suite == 'query_plans':
+        return query_plans.run(rows=params['rows'],
+          players=params['players'])
+      if suite == 'connections':
+        return connections.run(players=params['players'],
+          territories=params['territories'], rows=params['rows'],
+          workers=params['workers'], held=params['operations'])
+      return {'engine': engine, 'views': views}[suite].run(
+        players=params['players'], territories=params['territories'],
+        rows=params['rows'], operations=params['operations'])
+    finally:
+      connection.creation.destroy_test_db(old_name, verbosity=0)
+
+  def write_text(self, suite, results, params):
+    if suite == 'query_plans':
+      self.stdout.write('Query plans at {} rows'.format(params['rows']))
+      for result in results:
+        status = 'ok' if result['uses_index'] else 'NO INDEX'
+        if not result['bounded']:
+          status += ', NO SEEK'
+        self.stdout.write('{label}: {status} ({seconds:.4f}s)'.format(
+          status=status, **result))
+        for line in result['plan']:
+          self.stdout.write('    ' + line)
+      return
+    if suite == 'connections':
+      self.stdout.write('Home page with {} waiting long polls'.format(
+        params['operations']))
+      for result in results:
+        self.stdout.write(('{label} ({workers} workers): status '
+          '{probe_status} in {probe_seconds:.3f}s').format(**result))
+      return
+    self.stdout.write('{} ({} operations)'.format(suite,
+      params['operations']))
+    for result in results:
+      self.stdout.write(('{label}: {seconds_per_operation:.5f}s, '
+        '{queries_per_operation:.1f} queries, '
+        '{peak_memory_kib:.0f} KiB peak').format(**result))
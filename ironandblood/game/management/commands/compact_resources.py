@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from game.models import Resources
+
+class Command(BaseCommand):
+  help = "Deletes Resources rows nothing references, in batches."
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=500,
+      help='Rows deleted per transaction.')
+    parser.add_argument('--dry-run', action='store_true',
+      help='Only count the rows that would be deleted.')
+
+  def handle(self, *args, **options):
+    if options['dry_run']:
+      self.stdout.write('{} unreferenced row(s).'.format(
+        Resources.unreferenced().count()))
+      return
+    deleted = Resources.compact(batch_size=options['batch_size'])
+    self.stdout.write('Deleted {} unreferenced row(s).'.format(deleted))
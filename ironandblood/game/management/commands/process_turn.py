@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from game import turns
+
+class Command(BaseCommand):
+  help = ("Processes a turn: pending bonds past their due turn are marked "
+    "delinquent and their borrowers' delinquency is increased.")
+
+  def add_arguments(self, parser):
+    parser.add_argument('--turn', type=int,
+      help='Turn to process (default: the current turn).')
+    parser.add_argument('--chunk-size', type=int, default=turns.CHUNK_SIZE,
+      help='Bonds processed per transaction.')
+
+  def handle(self, *args, **options):
+    log = turns.process_turn(turn=options['turn'],
+      chunk_size=options['chunk_size'])
+    self.stdout.write(('Turn {}: {} bond(s) of {} player(s) marked '
+      'delinquent in {:.2f}s.').format(log.number, log.delinquent_bonds,
+      log.delinquent_players, log.seconds))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from game import stats
+
+class Command(BaseCommand):
+  help = ("Recomputes the player and pair market statistics from the "
+    "accepted exchanges.")
+
+  def add_arguments(self, parser):
+    parser.add_argument('--chunk-size', type=int, default=stats.CHUNK_SIZE,
+      help='Exchanges replayed per batch.')
+
+  def handle(self, *args, **options):
+    replayed = stats.rebuild(chunk_size=options['chunk_size'])
+    self.stdout.write('Replayed {} exchange(s).'.format(replayed))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from game.models import Player
+
+class Command(BaseCommand):
+  help = ("Recounts the territories and charters of every player and repairs "
+    "the denormalized role and counts that drifted.")
+
+  def handle(self, *args, **options):
+    fixed = Player.recompute_counts()
+    self.stdout.write('Fixed {} player(s).'.format(fixed))
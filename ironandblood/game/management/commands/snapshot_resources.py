@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from game import ledger
+
+class Command(BaseCommand):
+  help = ("Stores the ledger balance of every player, bounding the "
+    "ledger entries balance queries have to sum.")
+
+  def add_arguments(self, parser):
+    parser.add_argument('--chunk-size', type=int, default=ledger.CHUNK_SIZE,
+      help='Players snapshotted per transaction.')
+
+  def handle(self, *args, **options):
+    taken = ledger.take_snapshot(chunk_size=options['chunk_size'])
+    self.stdout.write('Took {} snapshot(s).'.format(taken))
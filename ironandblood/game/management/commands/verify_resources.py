@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from game import ledger
+
+class Command(BaseCommand):
+  help = ("Recomputes every player's resources from the latest snapshot and "
+    "the resource ledger, and reports the balances that do not match.")
+
+  def add_arguments(self, parser):
+    parser.add_argument('--chunk-size', type=int, default=ledger.CHUNK_SIZE,
+      help='Players verified per chunk.')
+
+  def handle(self, *args, **options):
+    mismatches = 0
+    for pk, expected, actual in ledger.verify(
+      chunk_size=options['chunk_size']):
+      mismatches += 1
+      self.stdout.write('Resources {}: ledger {}, balance {}.'.format(pk,
+        expected, actual))
+    if mismatches:
+      raise CommandError('{} balance(s) do not match the ledger.'.format(
+        mismatches))
+    self.stdout.write('All balances match the ledger.')
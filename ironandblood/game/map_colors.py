@@ -0,0 +1,70 @@
+"""
+Territory colors of the home page map.
+
+The territory code -> color mapping only changes when a territory changes
+owner, so it is kept as a versioned snapshot in the game cache.  Ownership
+transfers bump the version, and the next read rebuilds the snapshot with a
+single query.
+"""
+import time
+
+from django.db import transaction
+
+from .counters import cache
+
+COLORS = ['#659BA3', '#725E54', '#FFEBB5', '#996982', '#01704B']
+
+VERSION_KEY = 'game:map:version'
+
+def player_color(user_pk):
+  return COLORS[user_pk % len(COLORS)]
+
+def _snapshot_key(version):
+  return 'game:map:{}'.format(version)
+
+def version():
+  """Current snapshot version."""
+  current = cache().get(VERSION_KEY)
+  if current is None:
+    # Start from the clock so a lost version never reuses an old snapshot.
+    cache().add(VERSION_KEY, int(time.time() * 1000), None)
+    current = cache().get(VERSION_KEY)
+  return current
+
+def _bump():
+  try:
+    current = cache().incr(VERSION_KEY)
+  except ValueError:
+    version()
+  else:
+    cache().delete(_snapshot_key(current - 1))
+
+def territories_changed():
+  """
+  Invalidates the snapshot.  Called whenever a territory changes owner;
+  inside a transaction the version is bumped again on commit.
+  """
+  _bump()
+  if transaction.get_connection().in_atomic_block:
+    transaction.on_commit(_bump)
+
+def _build():
+  from .models import Territory
+
+  colors = dict()
+  for code, owner_pk in Territory.objects.values_list('code', 'owner_id'):
+    if owner_pk is not None:
+      colors[code] = player_color(owner_pk)
+  return colors
+
+def snapshot():
+  """
+  Dictionary with the snapshot `version` and the territory `colors`.
+  """
+  current = version()
+  key = _snapshot_key(current)
+  colors = cache().get(key)
+  if colors is None:
+    colors = _build()
+    cache().set(key, colors, None)
+  return {'version': current, 'colors': colors}
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 13:44
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='bond',
+            index_together=set([('borrower', 'state'), ('holder', 'state')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='exchange',
+            index_together=set([('offeree', 'state', 'offer_date'), ('offeror', 'state', 'offer_date')]),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 13:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_territories_and_charters(apps, schema_editor):
+    Player = apps.get_model('game', 'Player')
+    Territory = apps.get_model('game', 'Territory')
+    Charter = apps.get_model('game', 'Charter')
+    territories = dict(Territory.objects.filter(owner__isnull=False)
+        .values_list('owner').annotate(Count('pk')).order_by())
+    charters = dict(Charter.objects.values_list('member')
+        .annotate(Count('pk')).order_by())
+    for user_pk in set(territories) | set(charters):
+        territory_count = territories.get(user_pk, 0)
+        charter_count = charters.get(user_pk, 0)
+        if territory_count:
+            role = 'H'
+        elif charter_count:
+            role = 'C'
+        else:
+            role = 'P'
+        Player.objects.filter(user_id=user_pk).update(role=role,
+            territory_count=territory_count, charter_count=charter_count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0002_exchange_bond_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='charter_count',
+            field=models.IntegerField(default=0, verbose_name='Charters'),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='role',
+            field=models.CharField(choices=[('P', 'Privateer'), ('C', 'Chartered company'), ('H', 'Head of State')], db_index=True, default='P', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='territory_count',
+            field=models.IntegerField(default=0, verbose_name='Territories'),
+        ),
+        migrations.RunPython(count_territories_and_charters,
+            migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 14:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def sum_charter_sizes(apps, schema_editor):
+    Territory = apps.get_model('game', 'Territory')
+    Charter = apps.get_model('game', 'Charter')
+    allotted = Charter.objects.values_list('territory').annotate(
+        Sum('size')).order_by()
+    for territory_pk, size in allotted:
+        Territory.objects.filter(pk=territory_pk).update(allotted=size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0003_player_role_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='territory',
+            name='allotted',
+            field=models.IntegerField(default=0, help_text="Sum of the sizes of the territory's charters, maintained by Charter saves and deletes.", verbose_name='Land area percentage under charters'),
+        ),
+        migrations.RunPython(sum_charter_sizes, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='charter',
+            unique_together=set([('territory', 'member')]),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 14:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+from game.config import Config
+
+
+def schedule_pending_bonds(apps, schema_editor):
+    """Due turns of pending bonds, counted from their origin exchange."""
+    Bond = apps.get_model('game', 'Bond')
+    bonds = Bond.objects.filter(state='W', maturity__gt=0,
+        origin_exchange__answer_date__isnull=False).values_list('pk',
+        'maturity', 'origin_exchange__answer_date')
+    by_due_turn = dict()
+    for pk, maturity, answer_date in bonds.iterator():
+        due_turn = Config.to_turn(answer_date) + maturity
+        by_due_turn.setdefault(due_turn, []).append(pk)
+    for due_turn, pks in by_due_turn.items():
+        for i in range(0, len(pks), 500):
+            Bond.objects.filter(pk__in=pks[i:i + 500]).update(
+                due_turn=due_turn)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0004_territory_allotted'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Turn',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField(unique=True)),
+                ('processed_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('delinquent_bonds', models.IntegerField(default=0, verbose_name='Bonds marked delinquent')),
+                ('delinquent_players', models.IntegerField(default=0, verbose_name='Players with new delinquent bonds')),
+                ('seconds', models.FloatField(default=0, verbose_name='Processing time')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='bond',
+            name='delinquent',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='bond',
+            name='due_turn',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='bond',
+            index_together=set([('state', 'delinquent', 'due_turn'), ('holder', 'state'), ('borrower', 'state')]),
+        ),
+        migrations.RunPython(schedule_pending_bonds,
+            migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 14:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0005_turn_engine'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResourceLedger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('currency', models.IntegerField(default=0, verbose_name='Currency')),
+                ('manufactured', models.IntegerField(default=0, verbose_name='Manufactured Goods')),
+                ('agricultural', models.IntegerField(default=0, verbose_name='Agricultural Goods')),
+                ('exchange', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='game.Exchange')),
+                ('resources', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='game.Resources')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ResourceSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_entry', models.IntegerField(default=0)),
+                ('currency', models.IntegerField(default=0, verbose_name='Currency')),
+                ('manufactured', models.IntegerField(default=0, verbose_name='Manufactured Goods')),
+                ('agricultural', models.IntegerField(default=0, verbose_name='Agricultural Goods')),
+                ('resources', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='game.Resources')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='resourcesnapshot',
+            index_together=set([('resources', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='resourceledger',
+            index_together=set([('resources', 'id')]),
+        ),
+    ]
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 14:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Case, IntegerField, Value, When
+
+# 13 bound parameters per row stay under SQLite's default limit of 999.
+CHUNK_SIZE = 75
+NAMES = ['currency', 'manufactured', 'agricultural']
+
+
+def copy_chunked(model, sides):
+    """
+    Copies the values of the resources rows referenced by the `sides`
+    (foreign key, column prefix) of `model` into its columns, one UPDATE
+    per chunk of `CHUNK_SIZE` rows.
+    """
+    fields = [fk + '__' + name for fk, _prefix in sides for name in NAMES]
+    columns = [prefix + name for _fk, prefix in sides for name in NAMES]
+    after = 0
+    while True:
+        rows = list(model.objects.filter(pk__gt=after).order_by('pk')
+            .values_list('pk', *fields)[:CHUNK_SIZE])
+        if not rows:
+            return
+        model.objects.filter(pk__in=[row[0] for row in rows]).update(**{
+            column: Case(*[When(pk=row[0], then=Value(row[i + 1] or 0))
+                for row in rows], default=Value(0),
+                output_field=IntegerField())
+            for i, column in enumerate(columns)})
+        after = rows[-1][0]
+
+
+def embed_resources(apps, schema_editor):
+    copy_chunked(apps.get_model('game', 'Exchange'),
+        [('offeror_resources', 'offeror_'), ('offeree_resources', 'offeree_')])
+    copy_chunked(apps.get_model('game', 'Bond'), [('resources', '')])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0006_resource_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bond',
+            name='agricultural',
+            field=models.IntegerField(default=0, verbose_name='Agricultural Goods'),
+        ),
+        migrations.AddField(
+            model_name='bond',
+            name='currency',
+            field=models.IntegerField(default=0, verbose_name='Currency'),
+        ),
+        migrations.AddField(
+            model_name='bond',
+            name='manufactured',
+            field=models.IntegerField(default=0, verbose_name='Manufactured Goods'),
+        ),
+        migrations.AddField(
+            model_name='exchange',
+            name='offeree_agricultural',
+            field=models.IntegerField(default=0, verbose_name='Agricultural Goods'),
+        ),
+        migrations.AddField(
+            model_name='exchange',
+            name='offeree_currency',
+            field=models.IntegerField(default=0, verbose_name='Currency'),
+        ),
+        migrations.AddField(
+            model_name='exchange',
+            name='offeree_manufactured',
+            field=models.IntegerField(default=0, verbose_name='Manufactured Goods'),
+        ),
+        migrations.AddField(
+            model_name='exchange',
+            name='offeror_agricultural',
+            field=models.IntegerField(default=0, verbose_name='Agricultural Goods'),
+        ),
+        migrations.AddField(
+            model_name='exchange',
+            name='offeror_currency',
+            field=models.IntegerField(default=0, verbose_name='Currency'),
+        ),
+        migrations.AddField(
+            model_name='exchange',
+            name='offeror_manufactured',
+            field=models.IntegerField(default=0, verbose_name='Manufactured Goods'),
+        ),
+        migrations.RunPython(embed_resources, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='bond',
+            name='resources',
+        ),
+        migrations.RemoveField(
+            model_name='exchange',
+            name='offeree_resources',
+        ),
+        migrations.RemoveField(
+            model_name='exchange',
+            name='offeror_resources',
+        ),
+    ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 14:33
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import game.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('game', '0007_embedded_resources'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PairStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_turn', models.IntegerField()),
+                ('exchanges', models.IntegerField(default=0, verbose_name='Exchanges')),
+                ('currency_given', models.IntegerField(default=0, verbose_name='Currency given')),
+                ('manufactured_given', models.IntegerField(default=0, verbose_name='Manufactured Goods given')),
+                ('agricultural_given', models.IntegerField(default=0, verbose_name='Agricultural Goods given')),
+                ('currency_received', models.IntegerField(default=0, verbose_name='Currency received')),
+                ('manufactured_received', models.IntegerField(default=0, verbose_name='Manufactured Goods received')),
+                ('agricultural_received', models.IntegerField(default=0, verbose_name='Agricultural Goods received')),
+                ('partner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            bases=(game.models.MarketStatsMixin, models.Model),
+        ),
+        migrations.CreateModel(
+            name='PlayerTurnStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('turn', models.IntegerField()),
+                ('exchanges', models.IntegerField(default=0, verbose_name='Exchanges')),
+                ('currency_given', models.IntegerField(default=0, verbose_name='Currency given')),
+                ('manufactured_given', models.IntegerField(default=0, verbose_name='Manufactured Goods given')),
+                ('agricultural_given', models.IntegerField(default=0, verbose_name='Agricultural Goods given')),
+                ('currency_received', models.IntegerField(default=0, verbose_name='Currency received')),
+                ('manufactured_received', models.IntegerField(default=0, verbose_name='Manufactured Goods received')),
+                ('agricultural_received', models.IntegerField(default=0, verbose_name='Agricultural Goods received')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            bases=(game.models.MarketStatsMixin, models.Model),
+        ),
+        migrations.AlterUniqueTogether(
+            name='playerturnstats',
+            unique_together=set([('user', 'turn')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='pairstats',
+            unique_together=set([('user', 'partner')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='pairstats',
+            index_together=set([('user', 'exchanges')]),
+        ),
+    ]
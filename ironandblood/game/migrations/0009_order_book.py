@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 14:46
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('game', '0008_market_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('side', models.CharField(choices=[('B', 'Buy'), ('S', 'Sell')], max_length=1)),
+                ('good', models.CharField(choices=[('manufactured', 'Manufactured Goods'), ('agricultural', 'Agricultural Goods')], max_length=12)),
+                ('price', models.PositiveIntegerField()),
+                ('quantity', models.PositiveIntegerField()),
+                ('remaining', models.PositiveIntegerField()),
+                ('state', models.CharField(choices=[('O', 'Open'), ('F', 'Filled'), ('C', 'Canceled')], default='O', max_length=1)),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='orders', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='order',
+            index_together=set([('good', 'side', 'state', 'price', 'id'), ('user', 'state', 'id')]),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 15:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0010_public_offers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderBook',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('good', models.CharField(choices=[('manufactured', 'Manufactured Goods'), ('agricultural', 'Agricultural Goods')], max_length=12, unique=True)),
+            ],
+        ),
+    ]
@@ -1,58 +1,162 @@
+from operator import itemgetter
+
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
-from django.db.models import Sum
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, Max, Q, Value, When
 from django.utils import timezone
 from django.utils.translation import ugettext as _
 
-class Resources(models.Model):
-  currency = models.IntegerField('Currency', default=0)
-  manufactured = models.IntegerField('Manufactured Goods', default=0)
-  agricultural = models.IntegerField('Agricultural Goods', default=0)
+from . import counters, events, map_colors, validation, versions
+from .config import Config
 
-  _list = ['currency', 'manufactured', 'agricultural']
+def _loaded(instance, name):
+  """
+  The object related by foreign key `name` if it is already loaded, otherwise
+  its pk, so callers do not query the database just to pass it along.
+  """
+  field = instance._meta.get_field(name)
+  return getattr(instance, field.get_cache_name(),
+    getattr(instance, field.attname))
 
-  _colors = {
-    'currency': '#c2a91b',
-    'manufactured': '#34495E',
-    'agricultural': '#007733'
-  }
-  _sparkline_colors = {
-    'currency': '#18ff00',
-    'manufactured': '#0096ff',
-    'agricultural': '#ffea00'
-  }
-  # ['#18ff00', '#0096ff', '#ffea00']
-  # ['#c2a91b', '#34495E', '#007733']
+def _changed(*users):
+  """
+  Drops the header counters of `users` and changes their versions (see
+  `game.versions`), after exchanges or bonds they take part in changed.
+  """
+  counters.invalidate(*users)
+  versions.changed(*[user.pk for user in users if user is not None])
+
+def _lock_rows(instances):
+  """
+  Locks the rows of `instances` (all of the same model) with
+  SELECT ... FOR UPDATE, in pk order, and copies the locked values into the
+  instances so validations see the current state.  Must run inside a
+  transaction.
+
+  State transitions lock Resources, then Exchange, then Bond, then Territory
+  rows, so concurrent transitions always acquire locks in the same order.
+  Order placement locks the `OrderBook` rows of its goods before Resources.
+  """
+  instances = [i for i in instances if i is not None and i.pk is not None]
+  if not instances:
+    return
+  model = type(instances[0])
+  locked = model.objects.select_for_update().filter(
+    pk__in=set(i.pk for i in instances)).order_by('pk')
+  rows = {row.pk: row for row in locked}
+  for instance in instances:
+    row = rows[instance.pk]
+    for field in model._meta.concrete_fields:
+      value = getattr(row, field.attname)
+      if field.is_relation and getattr(instance, field.attname) != value:
+        # Drop the cached related object, it belongs to the old value.
+        instance.__dict__.pop(field.get_cache_name(), None)
+      setattr(instance, field.attname, value)
+
+class ResourceVector(tuple):
+  """
+  Immutable (currency, manufactured, agricultural) quantities for arithmetic
+  and checks that need no database row, e.g. validations.  `+` and `-` work
+  element-wise (not as tuple concatenation), `*` scales by an integer.
+  """
+  __slots__ = ()
+
+  def __new__(cls, currency=0, manufactured=0, agricultural=0):
+    return tuple.__new__(cls, (currency, manufactured, agricultural))
+
+  currency = property(itemgetter(0))
+  manufactured = property(itemgetter(1))
+  agricultural = property(itemgetter(2))
+
+  @classmethod
+  def of(cls, resources):
+    """Vector of anything with resource attributes; None is empty."""
+    if resources is None:
+      return cls.ZERO
+    if isinstance(resources, cls):
+      return resources
+    return tuple.__new__(cls, (resources.currency, resources.manufactured,
+      resources.agricultural))
+
+  def __add__(self, other):
+    return tuple.__new__(ResourceVector, (self[0] + other[0],
+      self[1] + other[1], self[2] + other[2]))
+
+  def __sub__(self, other):
+    return tuple.__new__(ResourceVector, (self[0] - other[0],
+      self[1] - other[1], self[2] - other[2]))
+
+  def __neg__(self):
+    return tuple.__new__(ResourceVector, (-self[0], -self[1], -self[2]))
+
+  def __mul__(self, factor):
+    return tuple.__new__(ResourceVector, (self[0] * factor,
+      self[1] * factor, self[2] * factor))
+
+  __rmul__ = __mul__
 
   def __str__(self):
     """
     Returns a list of nonzero resource quantities.
     """
-    nonzero = list()
-    for name in self._list:
-      quantity = getattr(self, name)
-      if quantity != 0:
-        nonzero.append('{}={}'.format(name, quantity))
-    return ', '.join(nonzero)
+    return ', '.join('{}={}'.format(name, quantity)
+      for name, quantity in zip(ResourcesMixin._list, self) if quantity != 0)
 
-  def _update(self, other, fn):
+  def __repr__(self):
+    return 'ResourceVector({}, {}, {})'.format(*self)
+
+  def covers(self, other):
     """
-    Update all fields calling self.field = fn(self.field, other.field)
+    True if `self` has at least the same amount of resources in `other`.
     """
-    for name in self._list:
-      setattr(self, name, fn(getattr(self, name), getattr(other, name)))
+    return self[0] >= other[0] and self[1] >= other[1] and \
+      self[2] >= other[2]
 
-  def as_list(self):
-    return [getattr(self, name) for name in self._list]
+  def is_empty(self):
+    """Return if all values are zero"""
+    return self == ResourceVector.ZERO
 
-  @staticmethod
-  def color(name):
-    return Resources._colors[name]
+  def is_zero_or_positive(self):
+    """Return if all values are zero or positive"""
+    return self[0] >= 0 and self[1] >= 0 and self[2] >= 0
 
-  @staticmethod
-  def colors_as_str_list():
-    return list(map(str, Resources._sparkline_colors.values()))
+  def as_dict(self):
+    return dict(zip(ResourcesMixin._list, self))
+
+  def to_resources(self):
+    """Unsaved `Resources` with these values."""
+    return Resources(**self.as_dict())
+
+ResourceVector.ZERO = ResourceVector()
+
+class ResourcesMixin(object):
+  """
+  Arithmetic and predicates shared by `Resources` rows and the resources
+  embedded in exchanges and bonds: anything with `currency`, `manufactured`
+  and `agricultural` attributes.  Computations go through `vector()`.
+  """
+  __slots__ = ()
+
+  _list = ['currency', 'manufactured', 'agricultural']
+
+  def __str__(self):
+    """
+    Returns a list of nonzero resource quantities.
+    """
+    return str(self.vector())
+
+  def vector(self):
+    """Current values as a `ResourceVector`."""
+    return ResourceVector.of(self)
+
+  def assign(self, vector):
+    """Sets all values from `vector` (or any resources)."""
+    self.currency, self.manufactured, self.agricultural = \
+      ResourceVector.of(vector)
+
+  def as_list(self):
+    return list(self.vector())
 
   def has_currency(self):
     return self.currency > 0
@@ -67,27 +171,237 @@ class Resources(models.Model):
     """
     Changes `self` by adding values from `other`.
     """
-    self._update(other, lambda a, b: a + b)
+    self.assign(self.vector() + ResourceVector.of(other))
 
   def covers(self, other):
     """
     True if `self` has at least the same amount of resources in `other`.
     """
-    return all([getattr(self, i) >= getattr(other, i) for i in self._list])
+    return self.vector().covers(ResourceVector.of(other))
 
   def subtract(self, other):
     """
     Changes `self` by subtracting values from `other`.
     """
-    self._update(other, lambda a, b: a - b)
+    self.assign(self.vector() - ResourceVector.of(other))
 
   def is_empty(self):
     """Return if all values are zero"""
-    return all([getattr(self, i) == 0 for i in self._list])
+    return self.vector().is_empty()
 
   def is_zero_or_positive(self):
     """Return if all values are zero or positive"""
-    return all([getattr(self, i) >= 0 for i in self._list])
+    return self.vector().is_zero_or_positive()
+
+class Resources(ResourcesMixin, models.Model):
+  currency = models.IntegerField('Currency', default=0)
+  manufactured = models.IntegerField('Manufactured Goods', default=0)
+  agricultural = models.IntegerField('Agricultural Goods', default=0)
+
+  _colors = {
+    'currency': '#c2a91b',
+    'manufactured': '#34495E',
+    'agricultural': '#007733'
+  }
+  _sparkline_colors = {
+    'currency': '#18ff00',
+    'manufactured': '#0096ff',
+    'agricultural': '#ffea00'
+  }
+  # ['#18ff00', '#0096ff', '#ffea00']
+  # ['#c2a91b', '#34495E', '#007733']
+
+  @staticmethod
+  def color(name):
+    return Resources._colors[name]
+
+  @staticmethod
+  def colors_as_str_list():
+    return list(map(str, Resources._sparkline_colors.values()))
+
+  def apply_delta(self, other, sign=1, guard=False, exchange=None):
+    """
+    Adds `sign` times the values of `other` to the database row with a single
+    UPDATE ... SET field = field + value, touching only the changed columns.
+    With `guard`, the row is only updated if no value becomes negative.
+    Returns whether the row was updated; if so, in-memory values are moved
+    by the same amounts.  With `exchange`, the change is also recorded in the
+    `ResourceLedger` against it.
+    """
+    vector = ResourceVector.of(other) * sign
+    delta = vector.as_dict()
+    changes = {name: F(name) + value for name, value in delta.items()
+      if value != 0}
+    if not changes:
+      return True
+    rows = Resources.objects.filter(pk=self.pk)
+    if guard:
+      rows = rows.filter(**{name + '__gte': -value
+        for name, value in delta.items() if value < 0})
+    if rows.update(**changes) == 0:
+      return False
+    if exchange is not None:
+      ResourceLedger.record(self, other, sign, exchange)
+    self.add(vector)
+    return True
+
+  @staticmethod
+  def _references():
+    """(model, field) of every foreign key to Resources, except Player's."""
+    return [(ResourceLedger, 'resources'), (ResourceSnapshot, 'resources')]
+
+  @classmethod
+  def unreferenced(cls):
+    """
+    Rows no player, ledger entry nor snapshot uses, such as the rows
+    exchanges and bonds used before their resources were embedded.
+    """
+    rows = cls.objects.filter(player__isnull=True)
+    for model, field in cls._references():
+      # NOT IN (subquery) anti-join; NULLs would make it match nothing.
+      rows = rows.exclude(pk__in=model.objects.filter(
+        **{field + '__isnull': False}).values(field))
+    return rows
+
+  @classmethod
+  def compact(cls, batch_size=500):
+    """
+    Deletes unreferenced rows in batches of `batch_size`.  Each batch is
+    checked again when deleted, so rows that got referenced meanwhile are
+    kept.  Returns the number of rows deleted.
+    """
+    deleted = 0
+    after = 0
+    while True:
+      pks = list(cls.unreferenced().filter(pk__gt=after).order_by('pk')
+        .values_list('pk', flat=True)[:batch_size])
+      if not pks:
+        return deleted
+      with transaction.atomic():
+        batch = cls.unreferenced().filter(pk__in=pks)
+        deleted += batch.delete()[1].get(cls._meta.label, 0)
+      after = pks[-1]
+
+def _embedded_column(name):
+  def get(self):
+    return getattr(self._instance, self._prefix + name)
+
+  def set(self, value):
+    setattr(self._instance, self._prefix + name, value)
+  return property(get, set)
+
+class EmbeddedResources(ResourcesMixin):
+  """
+  Resources stored as the `<prefix>currency`, `<prefix>manufactured` and
+  `<prefix>agricultural` columns of a model instance.  A view: reads and
+  changes go straight to the instance, which must be saved as usual.
+  """
+  __slots__ = ('_instance', '_prefix')
+
+  def __init__(self, instance, prefix):
+    self._instance = instance
+    self._prefix = prefix
+
+  currency = _embedded_column('currency')
+  manufactured = _embedded_column('manufactured')
+  agricultural = _embedded_column('agricultural')
+
+  @staticmethod
+  def accessor(prefix=''):
+    """
+    Property exposing the columns with `prefix` as `EmbeddedResources`.
+    Assigning any resources (or None, meaning none) copies their values.
+    """
+    def get(self):
+      return EmbeddedResources(self, prefix)
+
+    def set(self, value):
+      for name in ResourcesMixin._list:
+        setattr(self, prefix + name, 0 if value is None else
+          getattr(value, name))
+    return property(get, set)
+
+# Resources rows per grouped UPDATE, which binds seven parameters per row.
+RESOURCES_CHUNK = 100
+# Keeps IN (...) lists under the bound parameter limit of every backend.
+MAX_IN = 500
+
+def apply_resource_deltas(deltas):
+  """
+  Adds the `ResourceVector`s of `deltas`, a dictionary by Resources pk, to
+  their rows with one grouped UPDATE per `RESOURCES_CHUNK` rows.
+  """
+  pks = sorted(deltas)
+  for i in range(0, len(pks), RESOURCES_CHUNK):
+    chunk = pks[i:i + RESOURCES_CHUNK]
+    Resources.objects.filter(pk__in=chunk).update(**{
+      name: Case(*[When(pk=pk, then=F(name) + deltas[pk][j])
+        for pk in chunk], default=F(name))
+      for j, name in enumerate(Resources._list)})
+
+def lock_users(user_pks):
+  """
+  Users of `user_pks` by pk, with their players' resources locked like
+  `Exchange._lock` does: the Resources rows alone, in pk order and in
+  chunks of `MAX_IN`.  Users and players are read without a lock, so that
+  `Player.adjust_counts` never waits on a batch holding their rows.
+  """
+  user_pks = list(user_pks)
+  users = dict()
+  for i in range(0, len(user_pks), MAX_IN):
+    users.update((user.pk, user) for user in User.objects.select_related(
+      'player').filter(pk__in=user_pks[i:i + MAX_IN]))
+  # Ascending chunks keep the whole batch in pk order.
+  resources_pks = sorted(user.player.resources_id for user in users.values())
+  resources = dict()
+  for i in range(0, len(resources_pks), MAX_IN):
+    resources.update((row.pk, row) for row in Resources.objects
+      .select_for_update().filter(pk__in=resources_pks[i:i + MAX_IN])
+      .order_by('pk'))
+  for user in users.values():
+    user.player.resources = resources[user.player.resources_id]
+  return users
+
+class ResourceLedger(models.Model):
+  """
+  Append-only log of the signed changes to players' resources, one entry per
+  exchange and player.  Entries are never updated nor deleted; together with
+  `ResourceSnapshot` they give the balance of a player at any time (see
+  `game.ledger`).
+  """
+  resources = models.ForeignKey(Resources, related_name='+')
+  exchange = models.ForeignKey('game.Exchange', null=True, blank=True,
+    related_name='+', on_delete=models.SET_NULL)
+  date = models.DateTimeField(default=timezone.now)
+  currency = models.IntegerField('Currency', default=0)
+  manufactured = models.IntegerField('Manufactured Goods', default=0)
+  agricultural = models.IntegerField('Agricultural Goods', default=0)
+
+  class Meta:
+    # Balance queries sum the entries of one resources row after a pk.
+    index_together = [('resources', 'id')]
+
+  @classmethod
+  def record(cls, resources, other, sign, exchange):
+    """Records that `sign` times `other` was added to `resources`."""
+    return cls.objects.create(resources=resources, exchange=exchange,
+      **(ResourceVector.of(other) * sign).as_dict())
+
+class ResourceSnapshot(models.Model):
+  """
+  Balance of a player's resources at `date`, including every ledger entry
+  up to `last_entry` (the pk of the last included `ResourceLedger` entry, 0
+  if none).
+  """
+  resources = models.ForeignKey(Resources, related_name='+')
+  date = models.DateTimeField(default=timezone.now)
+  last_entry = models.IntegerField(default=0)
+  currency = models.IntegerField('Currency', default=0)
+  manufactured = models.IntegerField('Manufactured Goods', default=0)
+  agricultural = models.IntegerField('Agricultural Goods', default=0)
+
+  class Meta:
+    index_together = [('resources', 'date')]
 
 class Player(models.Model):
   """
@@ -117,7 +431,25 @@ class Player(models.Model):
 
   Note: in real life, the credit quality is determined by the other way around,
   and here we use the performance of a player to determine those features.
+
+  Summary
+  =======
+
+  `role`, `territory_count` and `charter_count` are kept up to date by
+  `Territory` and `Charter` saves and deletes, and by
+  `Exchange.objects.accept_many`, so roles can be read without counting.
+  Bulk changes made through querysets bypass them; `recompute_counts` (and
+  the `recompute_player_counts` command) repairs any drift.
   """
+  PRIVATEER = 'P'
+  CHARTERED_COMPANY = 'C'
+  HEAD_OF_STATE = 'H'
+  ROLE = (
+    (PRIVATEER, 'Privateer'),
+    (CHARTERED_COMPANY, 'Chartered company'),
+    (HEAD_OF_STATE, 'Head of State'),
+  )
+
   user = models.OneToOneField(User, on_delete=models.CASCADE,
     related_name='player')
 
@@ -130,12 +462,85 @@ class Player(models.Model):
       "delinquency (delinquent bonds over total paid bonds) affects the "
       "credit quality of the player."))
 
+  role = models.CharField(max_length=1, choices=ROLE, default=PRIVATEER,
+    db_index=True)
+  territory_count = models.IntegerField('Territories', default=0)
+  charter_count = models.IntegerField('Charters', default=0)
+
   @classmethod
   def create_player(cls, user):
     res = Resources()
     res.save()
     return cls(user=user, resources=res)
 
+  @classmethod
+  def role_for(cls, territory_count, charter_count):
+    if territory_count >= 1:
+      return cls.HEAD_OF_STATE
+    if charter_count >= 1:
+      return cls.CHARTERED_COMPANY
+    return cls.PRIVATEER
+
+  @classmethod
+  def adjust_counts(cls, user, territories=0, charters=0):
+    """
+    Adds `territories` and `charters` to the counts of `user` (a User or its
+    pk) and updates its role, in a single UPDATE.  If `user` has its player
+    cached, the cached values are moved by the same amounts.
+    """
+    cls.adjust_counts_many([user], territories, charters)
+
+  @classmethod
+  def adjust_counts_many(cls, users, territories=0, charters=0):
+    """`adjust_counts` of each of `users`, in a single UPDATE."""
+    users = [user for user in users if user is not None]
+    if not users or (territories == 0 and charters == 0):
+      return
+    # SET expressions read the values from before the update.
+    cls.objects.filter(user_id__in=[getattr(user, 'pk', user)
+      for user in users]).update(
+      territory_count=F('territory_count') + territories,
+      charter_count=F('charter_count') + charters,
+      role=Case(
+        When(territory_count__gte=1 - territories,
+          then=Value(cls.HEAD_OF_STATE)),
+        When(charter_count__gte=1 - charters,
+          then=Value(cls.CHARTERED_COMPANY)),
+        default=Value(cls.PRIVATEER),
+        output_field=models.CharField()))
+    for user in users:
+      player = getattr(user, '_player_cache', None)
+      if player is not None:
+        player.territory_count += territories
+        player.charter_count += charters
+        player.role = cls.role_for(player.territory_count,
+          player.charter_count)
+
+  @classmethod
+  def recompute_counts(cls):
+    """
+    Recounts territories and charters of every player and fixes the rows
+    that drifted, with one UPDATE per distinct (territories, charters) pair.
+    Returns the number of players fixed.
+    """
+    territories = dict(Territory.objects.filter(owner__isnull=False)
+      .values_list('owner').annotate(Count('pk')).order_by())
+    charters = dict(Charter.objects.values_list('member')
+      .annotate(Count('pk')).order_by())
+    stale = dict()
+    rows = cls.objects.values_list('user_id', 'role', 'territory_count',
+      'charter_count')
+    for user_pk, role, territory_count, charter_count in rows.iterator():
+      counts = (territories.get(user_pk, 0), charters.get(user_pk, 0))
+      expected = (cls.role_for(*counts),) + counts
+      if (role, territory_count, charter_count) != expected:
+        stale.setdefault(expected, []).append(user_pk)
+    with transaction.atomic():
+      for (role, territory_count, charter_count), pks in stale.items():
+        cls.objects.filter(user_id__in=pks).update(role=role,
+          territory_count=territory_count, charter_count=charter_count)
+    return sum(len(pks) for pks in stale.values())
+
   def territories(self):
     """List of territories controlled by the player"""
     return Territory.objects.filter(owner=self.user)
@@ -146,15 +551,15 @@ class Player(models.Model):
 
   def is_privateer(self):
     """True if the player is currently a Privateer"""
-    return len(self.territories()) == 0 and len(self.charter()) == 0
+    return self.role == self.PRIVATEER
 
   def is_chartered_company(self):
     """True if the player is currently a Chartered Company"""
-    return len(self.territories()) == 0 and len(self.charter()) >= 1
+    return self.role == self.CHARTERED_COMPANY
 
   def is_head_of_state(self):
     """True if the player is currently a Head of State"""
-    return len(self.territories()) >= 1
+    return self.role == self.HEAD_OF_STATE
 
 class Territory(models.Model):
   """Territory information"""
@@ -162,15 +567,100 @@ class Territory(models.Model):
   code = models.CharField(max_length=16, blank=False)
   name = models.CharField(max_length=32, blank=False)
   land_area = models.IntegerField('Land area', default=100)
+  allotted = models.IntegerField('Land area percentage under charters',
+    default=0,
+    help_text=("Sum of the sizes of the territory's charters, maintained by "
+      "Charter saves and deletes."))
 
   def __str__(self):
     return 'name={}, area={}'.format(self.name, self.land_area)
 
+  @transaction.atomic
+  def save(self, *args, **kwargs):
+    previous = None
+    row = None
+    if self.pk is not None:
+      row = Territory.objects.select_for_update().filter(
+        pk=self.pk).values_list('owner_id', 'allotted').first()
+    if row is not None:
+      # `allotted` belongs to Charter, never overwrite it with a stale value.
+      previous, self.allotted = row
+    super(Territory, self).save(*args, **kwargs)
+    if previous != self.owner_id:
+      Player.adjust_counts(previous, territories=-1)
+      Player.adjust_counts(_loaded(self, 'owner'), territories=1)
+
+  @transaction.atomic
+  def delete(self, *args, **kwargs):
+    owner = _loaded(self, 'owner')
+    members = list(self.charter_set.values_list('member_id', flat=True))
+    result = super(Territory, self).delete(*args, **kwargs)
+    Player.adjust_counts(owner, territories=-1)
+    for member_pk in members:
+      Player.adjust_counts(member_pk, charters=-1)
+    return result
+
 class Charter(models.Model):
   territory = models.ForeignKey(Territory, blank=False)
   member = models.ForeignKey(User, blank=False)
   size = models.IntegerField('Land area percentage', default=10)
 
+  class Meta:
+    unique_together = [('territory', 'member')]
+
+  @transaction.atomic
+  def save(self, *args, **kwargs):
+    """
+    Saves the charter and allots its size in the territory with a single
+    guarded UPDATE, so concurrent grants can never pass 100% nor give a
+    member two charters in the same territory.  A charter moved to another
+    territory releases its previous size there.
+    """
+    previous_territory, previous, previous_size = None, None, 0
+    if self.pk is not None:
+      row = Charter.objects.select_for_update().filter(
+        pk=self.pk).values_list('territory_id', 'member_id', 'size').first()
+      if row is not None:
+        previous_territory, previous, previous_size = row
+    if previous_territory not in (None, self.territory_id):
+      self._allot(previous_territory, -previous_size)
+      previous_size = 0
+    self._allot(_loaded(self, 'territory'), self.size - previous_size)
+    try:
+      with transaction.atomic():
+        super(Charter, self).save(*args, **kwargs)
+    except IntegrityError:
+      raise self._member_already_has_charter(self.territory, self.member)
+    if previous != self.member_id:
+      Player.adjust_counts(previous, charters=-1)
+      Player.adjust_counts(_loaded(self, 'member'), charters=1)
+
+  @transaction.atomic
+  def delete(self, *args, **kwargs):
+    member = _loaded(self, 'member')
+    self._allot(_loaded(self, 'territory'), -self.size)
+    result = super(Charter, self).delete(*args, **kwargs)
+    Player.adjust_counts(member, charters=-1)
+    return result
+
+  @classmethod
+  def _allot(cls, territory, size):
+    """
+    Adds `size` to the allotted percentage of `territory` (a Territory or
+    its pk) only if the result does not pass 100%.
+    """
+    if size == 0:
+      return
+    territory_pk = getattr(territory, 'pk', territory)
+    rows = Territory.objects.filter(pk=territory_pk)
+    if size > 0:
+      rows = rows.filter(allotted__lte=100 - size)
+    if rows.update(allotted=F('allotted') + size) == 0:
+      territory = Territory.objects.get(pk=territory_pk)
+      raise cls._territory_full(territory, 100 - territory.allotted, size)
+    if isinstance(territory, Territory):
+      territory.allotted += size
+
   @staticmethod
   def _validate_size(size):
     if size <= 0 or size > 100:
@@ -190,32 +680,36 @@ class Charter(models.Model):
         'territory': territory.name
         })
 
+  @staticmethod
+  def _member_already_has_charter(territory, member):
+    return ValidationError(
+      _("%(player)s already has a charter in “%(territory)s”."),
+      params={
+      'player': member.username,
+      'territory': territory.name
+      })
+
+  @staticmethod
+  def _territory_full(territory, free, size):
+    return ValidationError(
+      _("“%(territory)s” has %(free)d%% of its land area available. "
+        "Trying to grant %(grant_size)d%% of land."),
+      params={
+      'territory': territory.name,
+      'free': free,
+      'grant_size': size
+      })
+
   @staticmethod
   def _check_if_member_already_has_charter(territory, member):
-    if Charter.objects.filter(territory=territory, member=member):
-      raise ValidationError(
-        _("%(player)s already has a charter in “%(territory)s”."),
-        params={
-        'player': member.username,
-        'territory': territory.name
-        })
+    if Charter.objects.filter(territory=territory, member=member).exists():
+      raise Charter._member_already_has_charter(territory, member)
 
   @staticmethod
   def _check_territory_not_full(territory, member, size):
-    allotted = Charter.objects.filter(territory=territory)
-    allotted = allotted.aggregate(Sum('size'))['size__sum']
-    if allotted is None:
-      allotted = 0
-    free = 100 - allotted
+    free = 100 - territory.allotted
     if free < size:
-      raise ValidationError(
-        _("“%(territory)s” has %(free)d%% of its land area available. "
-          "Trying to grant %(grant_size)d%% of land."),
-        params={
-        'territory': territory.name,
-        'free': free,
-        'grant_size': size
-        })
+      raise Charter._territory_full(territory, free, size)
 
   @classmethod
   def grant(cls, leaser, territory, member, size):
@@ -224,6 +718,9 @@ class Charter(models.Model):
     * `leaser` must control `territory`
     * The sum of all charters in the `territory` cannot pass 100%
     * `member` cannot already have a charter in the territory.
+
+    The checks read `territory` as loaded; `save` enforces the last two
+    again with a guarded write, in case of concurrent grants.
     """
     cls._validate_size(size=size)
     cls._check_leaser_controls_territory(territory=territory, leaser=leaser)
@@ -231,11 +728,90 @@ class Charter(models.Model):
     cls._check_territory_not_full(territory=territory, member=member, size=size)
     return cls(territory=territory, member=member, size=size)
 
+  @classmethod
+  @transaction.atomic
+  def grant_many(cls, charters):
+    """
+    Saves the unsaved `charters`, each granted by the current owner of its
+    territory, with one UPDATE of the territories' allotments, one INSERT
+    and one UPDATE of the members' counts per number of new charters.
+    Meant for seeding large charter sets: if any charter is invalid a
+    ValidationError is raised and nothing is saved.
+    """
+    charters = list(charters)
+    territories = Territory.objects.select_for_update().filter(
+      pk__in=set(c.territory_id for c in charters)).order_by('pk')
+    territories = {t.pk: t for t in territories}
+    pairs = set()
+    allotments = dict()
+    for charter in charters:
+      territory = territories[charter.territory_id]
+      charter.territory = territory
+      cls._validate_size(size=charter.size)
+      if territory.owner_id is None:
+        raise ValidationError(_("Nobody controls “%(territory)s”."),
+          params={'territory': territory.name})
+      pair = (charter.territory_id, charter.member_id)
+      if pair in pairs:
+        raise cls._member_already_has_charter(territory, charter.member)
+      pairs.add(pair)
+      allotments[territory.pk] = allotments.get(territory.pk, 0) + charter.size
+
+    existing = cls.objects.filter(territory__in=territories,
+      member__in=set(member for _territory, member in pairs))
+    for pair in existing.values_list('territory_id', 'member_id'):
+      if pair in pairs:
+        raise cls._member_already_has_charter(territories[pair[0]],
+          User.objects.get(pk=pair[1]))
+    for territory_pk, size in allotments.items():
+      territory = territories[territory_pk]
+      if territory.allotted + size > 100:
+        raise cls._territory_full(territory, 100 - territory.allotted, size)
+
+    if allotments:
+      Territory.objects.filter(pk__in=allotments).update(allotted=Case(
+        *[When(pk=pk, then=F('allotted') + size)
+          for pk, size in allotments.items()], default=F('allotted')))
+    for territory_pk, size in allotments.items():
+      territories[territory_pk].allotted += size
+    cls.objects.bulk_create(charters)
+
+    by_count = dict()
+    for charter in charters:
+      by_count[charter.member_id] = by_count.get(charter.member_id, 0) + 1
+    members = dict()
+    for member_pk, count in by_count.items():
+      members.setdefault(count, []).append(member_pk)
+    for count, member_pks in members.items():
+      Player.adjust_counts_many(member_pks, charters=count)
+    return charters
+
+class BondQuerySet(models.QuerySet):
+  def for_listing(self):
+    """
+    Join everything the bond listings dereference per row (resources,
+    players, territory and its owner, and the origin and payment exchanges
+    used by `get_creation_date` and `get_payment_date`), so rendering a
+    listing costs a constant number of queries.
+    """
+    return self.select_related('holder', 'borrower', 'territory__owner',
+      'origin_exchange', 'payment_exchange').with_flags()
+
+  def with_flags(self):
+    """
+    Annotates `payable`, the value of `Bond.is_payable()` computed in the
+    same query.
+    """
+    return self.annotate(payable=validation.flag(validation.payable_q()))
+
 class Bond(models.Model):
   """Bond is a debt investment in which an `issuer` loans `resource` to a
   `creditor`.  The creditor agrees to pay the debt in up to `maturity_date`
   turns, except if the bond is a Perpetual Bond (`maturity_date` == 0).
-  If not paid, `creditor` increases his delinquency."""
+  If not paid, `creditor` increases his delinquency.
+
+  Bonds are due on `due_turn`, set from `maturity` when they are created;
+  `game.turns.process_turn` marks pending bonds past it as `delinquent`."""
   PENDING = 'W'
   PAID = 'P'
   FORGIVEN = 'F'
@@ -250,8 +826,10 @@ class Bond(models.Model):
   # exchange the bond with a third player.
   borrower = models.ForeignKey(User, related_name='+')
 
-  resources = models.ForeignKey(Resources, null=True, blank=True,
-    related_name='+')
+  currency = models.IntegerField('Currency', default=0)
+  manufactured = models.IntegerField('Manufactured Goods', default=0)
+  agricultural = models.IntegerField('Agricultural Goods', default=0)
+  resources = EmbeddedResources.accessor()
   territory = models.ForeignKey(Territory, null=True, blank=True,
     related_name='+')
 
@@ -261,18 +839,47 @@ class Bond(models.Model):
     related_name='+')
 
   maturity = models.IntegerField(default=0)
+  due_turn = models.IntegerField(null=True, blank=True)
+  delinquent = models.BooleanField(default=False)
 
   state = models.CharField(max_length=1, choices=BOND_STATE, default=PENDING)
 
+  objects = BondQuerySet.as_manager()
+
+  class Meta:
+    # Listings filter by (holder|borrower, state) and order by pk, which
+    # every index carries implicitly.  The turn engine seeks pending, not
+    # yet delinquent bonds by due turn.
+    index_together = [
+      ('holder', 'state'),
+      ('borrower', 'state'),
+      ('state', 'delinquent', 'due_turn'),
+    ]
+
   def __str__(self):
     ret = ["pk={}, state={}, holder={}, borrower={}".format(self.pk,
       self.get_state_display(), self.holder, self.borrower)]
-    if self.resources:
+    if self.includes_resources():
       ret.append(", resources=<{}>".format(self.resources))
     if self.territory:
       ret.append(", territory=<{}>").format(self.territory)
     return ''.join(ret)
 
+  def save(self, *args, **kwargs):
+    if self.pk is None and self.due_turn is None:
+      self.schedule()
+    super(Bond, self).save(*args, **kwargs)
+
+  def schedule(self, turn=None):
+    """
+    Sets `due_turn` to `maturity` turns after `turn` (default: the current
+    turn).  Perpetual bonds are never due.
+    """
+    if self.maturity > 0:
+      if turn is None:
+        turn = Config.current_turn()
+      self.due_turn = turn + self.maturity
+
   def _check_user_is_holder(self, user):
     if self.holder and user != self.holder:
       raise ValidationError(_("“%(player)s” is not the holder of this bond."),
@@ -292,14 +899,21 @@ class Bond(models.Model):
     if self.state != self.PENDING:
       raise ValidationError(_("This bond is not pending."))
 
+  @transaction.atomic
   def forgive(self, user):
+    _lock_rows([self])
     self._check_user_is_holder(user=user)
     self._check_state_pending()
     self.state = self.FORGIVEN
     self.save()
+    _changed(self.holder, self.borrower)
+    events.bonds_changed([self])
     return True
 
+  @transaction.atomic
   def pay(self, user):
+    _lock_rows([self.borrower.player.resources, self.holder.player.resources])
+    _lock_rows([self])
     self._check_user_is_borrower(user=user)
     self._check_state_pending()
     exchange = Exchange(offeror=self.borrower,
@@ -311,17 +925,22 @@ class Bond(models.Model):
     self.payment_exchange = exchange
     self.state = self.PAID
     self.save()
+    _changed(self.holder, self.borrower)
+    events.bonds_changed([self])
     return True
 
   def is_payable(self, borrower=None):
+    """
+    Whether the payment exchange `pay` would offer (the bond's resources and
+    territory from `borrower` to the holder) is acceptable.  The holder
+    gives nothing and the borrower's resources are checked when the payment
+    is offered, so only the territory ownership is left to check.
+    """
     if borrower is None:
       borrower = self.borrower
-    exchange = Exchange(offeror=borrower,
-                        offeror_resources=self.resources,
-                        offeror_territory=self.territory,
-                        offeree=self.holder)
-    exchange.state = Exchange.WAITING
-    return exchange.is_acceptable()
+    if self.territory_id is None:
+      return True
+    return self.territory.owner_id == borrower.pk
 
   def is_pending(self):
     return self.state == self.PENDING
@@ -342,7 +961,7 @@ class Bond(models.Model):
     return self.includes_resources() and self.resources.has_manufactured()
 
   def includes_resources(self):
-    return self.resources and not self.resources.is_empty()
+    return not self.resources.is_empty()
 
   def includes_territory(self):
     return self.territory is not None
@@ -353,6 +972,189 @@ class Bond(models.Model):
   def get_payment_date(self):
     return self.payment_exchange.answer_date
 
+class ExchangeQuerySet(models.QuerySet):
+  def for_listing(self):
+    """
+    Join everything the exchange listings dereference per row (players and
+    their resources, offered resources, territories and their owners) and
+    prefetch offered bonds with their own relations, so rendering a listing
+    costs a constant number of queries.
+    """
+    bonds = Bond.objects.for_listing()
+    return self.select_related(
+      'offeror__player__resources', 'offeree__player__resources',
+      'offeror_territory__owner', 'offeree_territory__owner'
+    ).prefetch_related(
+      models.Prefetch('offeror_bond', queryset=bonds),
+      models.Prefetch('offeree_bond', queryset=bonds)).with_flags()
+
+  def with_flags(self):
+    """
+    Annotates the values of `Exchange.is_acceptable()` (`acceptable`),
+    `could_offeror_pay_offeree_bond()` (`offeror_can_pay_offeree_bond`) and
+    `could_offeree_pay_offeror_bond()` (`offeree_can_pay_offeror_bond`),
+    computed in the same query from current balances, owners and bonds.
+    """
+    return self.annotate(
+      acceptable=validation.flag(validation.acceptable_q()),
+      offeror_can_pay_offeree_bond=validation.flag(
+        validation.payable_q('offeree_bond__', 'offeror')),
+      offeree_can_pay_offeror_bond=validation.flag(
+        validation.payable_q('offeror_bond__', 'offeree')))
+
+  def public_offers(self):
+    """
+    Waiting public offers, newest first; served by the (offeree, state,
+    offer_date) index with a NULL offeree.
+    """
+    return self.filter(offeree__isnull=True, state=Exchange.WAITING) \
+      .order_by('-offer_date', '-pk')
+
+  @transaction.atomic
+  def accept_many(self, exchanges, user):
+    """
+    Offeree `user` accepts many `exchanges` at once, with the semantics of
+    `Exchange.accept` applied one exchange after the other.
+
+    Players are loaded, and resources, exchanges, bonds and territories
+    locked, in a handful of queries; exchanges are validated against the
+    running balances and owners of the batch, and all changes are written with a
+    few set-based UPDATEs and one bulk INSERT of the resulting bonds.
+
+    Returns `(accepted, failures)`: the accepted exchanges and a dictionary
+    mapping the pk of each refused exchange to its `ValidationError`.
+    """
+    exchanges = list(exchanges)
+    failures = dict()
+    # Public offers are claimed one by one (see `Exchange.claim`), and lock
+    # their row before the players' resources.
+    for exchange in exchanges:
+      if exchange.offeree_id is None:
+        failures[exchange.pk] = validation.public_offer()
+    exchanges = [e for e in exchanges if e.pk not in failures]
+    user_pks = set()
+    for exchange in exchanges:
+      user_pks.update([exchange.offeror_id, exchange.offeree_id])
+
+    # Same lock order as Exchange._lock: resources, exchanges, bonds and
+    # territories.
+    users = lock_users(user_pks)
+    exchanges = self.model.objects.select_for_update().filter(
+      pk__in=[e.pk for e in exchanges]).order_by('pk')
+    exchanges = list(exchanges)
+
+    def lock(model, pks, *related):
+      pks = set(pks) - set([None])
+      if not pks:
+        return {}
+      # FOR UPDATE locks every joined table: lock the rows of `model` alone,
+      # then read their related rows without a lock.
+      rows = model.objects.select_for_update().filter(pk__in=pks).order_by(
+        'pk')
+      if related:
+        list(rows.values_list('pk', flat=True))
+        rows = model.objects.select_related(*related).filter(pk__in=pks)
+      return {row.pk: row for row in rows}
+    bonds = lock(Bond, [pk for e in exchanges
+      for pk in (e.offeror_bond_id, e.offeree_bond_id)], 'holder', 'borrower')
+    territories = lock(Territory, [pk for e in exchanges
+      for pk in (e.offeror_territory_id, e.offeree_territory_id)])
+
+    deltas = dict()
+    entries = list()
+    def move(player_user, resources, sign, exchange):
+      vector = resources.vector() * sign
+      player_user.player.resources.add(vector)
+      pk = player_user.player.resources.pk
+      deltas[pk] = deltas.get(pk, ResourceVector.ZERO) + vector
+      entries.append(ResourceLedger(resources=player_user.player.resources,
+        exchange=exchange, **vector.as_dict()))
+
+    accepted = list()
+    new_bonds = list()
+    moved_bonds = set()
+    moved_territories = set()
+    territory_deltas = dict()
+    now = timezone.now()
+    for exchange in exchanges:
+      exchange.offeror = users[exchange.offeror_id]
+      exchange.offeree = users[exchange.offeree_id]
+      exchange.offeror_bond = bonds.get(exchange.offeror_bond_id)
+      exchange.offeree_bond = bonds.get(exchange.offeree_bond_id)
+      exchange.offeror_territory = territories.get(
+        exchange.offeror_territory_id)
+      exchange.offeree_territory = territories.get(
+        exchange.offeree_territory_id)
+      try:
+        exchange._validate_user_as_offeree(user=user)
+        if exchange.state != exchange.WAITING:
+          raise validation.not_waiting()
+        exchange._validate_bond()
+        exchange._validate_territory_ownership()
+        exchange._validate_resource_sufficiency()
+      except ValidationError as e:
+        failures[exchange.pk] = e
+        continue
+
+      sides = [(exchange.offeror, exchange.offeree, 'offeror'),
+               (exchange.offeree, exchange.offeror, 'offeree')]
+      for giver, taker, side in sides:
+        resources = getattr(exchange, side + '_resources')
+        territory = getattr(exchange, side + '_territory')
+        bond = getattr(exchange, side + '_bond')
+        if getattr(exchange, side + '_as_bond'):
+          new_bonds.append(Bond(borrower=giver, holder=taker,
+            resources=resources, territory=territory,
+            origin_exchange=exchange,
+            maturity=getattr(exchange, side + '_as_bond_maturity')))
+          continue
+        if not resources.is_empty():
+          # Offeror resources were already collected by `offer`.
+          if side == 'offeree':
+            move(giver, resources, -1, exchange)
+          move(taker, resources, 1, exchange)
+        if territory:
+          territory.owner = taker
+          moved_territories.add(territory)
+          territory_deltas[giver.pk] = territory_deltas.get(giver.pk, 0) - 1
+          territory_deltas[taker.pk] = territory_deltas.get(taker.pk, 0) + 1
+        if bond:
+          bond.borrower = taker
+          moved_bonds.add(bond)
+
+      exchange.state = exchange.ACCEPTED
+      exchange.answer_date = now
+      accepted.append(exchange)
+
+    if deltas:
+      apply_resource_deltas(deltas)
+      ResourceLedger.objects.bulk_create(entries)
+    for model, rows, field in [(Territory, moved_territories, 'owner'),
+                               (Bond, moved_bonds, 'borrower')]:
+      by_user = dict()
+      for row in rows:
+        by_user.setdefault(getattr(row, field + '_id'), []).append(row.pk)
+      for user_pk, pks in by_user.items():
+        model.objects.filter(pk__in=pks).update(**{field: user_pk})
+    for user_pk, delta in territory_deltas.items():
+      Player.adjust_counts(users[user_pk], territories=delta)
+    turn = Config.current_turn()
+    for bond in new_bonds:
+      bond.schedule(turn)
+    Bond.objects.bulk_create(new_bonds)
+    if accepted:
+      self.model.objects.filter(pk__in=[e.pk for e in accepted]).update(
+        state=self.model.ACCEPTED, answer_date=now)
+      record_market_stats(accepted)
+
+    _changed(*users.values())
+    versions.changed(*[bond.holder_id for bond in moved_bonds])
+    events.exchanges_changed(accepted)
+    events.bonds_changed(moved_bonds)
+    if moved_territories:
+      map_colors.territories_changed()
+    return accepted, failures
+
 class Exchange(models.Model):
   """
   Exchange Trading System
@@ -406,6 +1208,11 @@ class Exchange(models.Model):
 
   Offeror cancels
     Offeror cancels the exchange proposal and his resources and released.
+
+  Public offers
+    An exchange offered without offeree can be accepted by any player
+    (`claim`); the first one to accept becomes the offeree.  Public offers
+    cannot ask for a territory or a bond, since the offeree is unknown.
   """
   UNKNOWN = 'U'
   WAITING = 'W'
@@ -420,8 +1227,10 @@ class Exchange(models.Model):
     (CANCELED, 'Canceled'),
   )
   offeror = models.ForeignKey(User, related_name='+')
-  offeror_resources = models.ForeignKey(Resources, null=True,
-    related_name='+')
+  offeror_currency = models.IntegerField('Currency', default=0)
+  offeror_manufactured = models.IntegerField('Manufactured Goods', default=0)
+  offeror_agricultural = models.IntegerField('Agricultural Goods', default=0)
+  offeror_resources = EmbeddedResources.accessor('offeror_')
   offeror_territory = models.ForeignKey(Territory, null=True, blank=True,
     related_name='+')
   offeror_bond = models.ForeignKey(Bond, null=True, blank=True,
@@ -429,9 +1238,12 @@ class Exchange(models.Model):
   offeror_as_bond = models.BooleanField(default=False)
   offeror_as_bond_maturity = models.IntegerField(default=0)
 
-  offeree = models.ForeignKey(User, related_name='+')
-  offeree_resources = models.ForeignKey(Resources, null=True,
-    related_name='+')
+  # None for public offers until accepted.
+  offeree = models.ForeignKey(User, null=True, blank=True, related_name='+')
+  offeree_currency = models.IntegerField('Currency', default=0)
+  offeree_manufactured = models.IntegerField('Manufactured Goods', default=0)
+  offeree_agricultural = models.IntegerField('Agricultural Goods', default=0)
+  offeree_resources = EmbeddedResources.accessor('offeree_')
   offeree_territory = models.ForeignKey(Territory, null=True, blank=True,
     related_name='+')
   offeree_bond = models.ForeignKey(Bond, null=True, blank=True,
@@ -445,11 +1257,21 @@ class Exchange(models.Model):
   offer_date = models.DateTimeField(null = True, blank = True)
   answer_date = models.DateTimeField(null = True, blank = True)
 
+  objects = ExchangeQuerySet.as_manager()
+
+  class Meta:
+    # Listings filter by (offeror|offeree, state) and order by
+    # (offer_date, pk); the header counts waiting (offeree, state).
+    index_together = [
+      ('offeror', 'state', 'offer_date'),
+      ('offeree', 'state', 'offer_date'),
+    ]
+
   def __str__(self):
     ret = ["pk={}, state={}".format(self.pk, self.get_state_display())]
     if self.offeror:
       ret.append(", (offeror={}".format(self.offeror))
-      if self.offeror_resources:
+      if self._offeror_has_resources():
         ret.append(", resources=<{}>".format(self.offeror_resources))
       if self.offeror_territory:
         ret.append(", territory=<{}>".format(self.offeror_territory))
@@ -462,7 +1284,7 @@ class Exchange(models.Model):
       ret.append(", no offeror")
     if self.offeree:
       ret.append(", (offeree={}".format(self.offeree))
-      if self.offeree_resources:
+      if self._offeree_has_resources():
         ret.append(", resources=<{}>".format(self.offeree_resources))
       if self.offeree_territory:
         ret.append(", territory=<{}>".format(self.offeree_territory))
@@ -475,94 +1297,48 @@ class Exchange(models.Model):
       ret.append(", no offeree")
     return ''.join(ret)
 
-  def save(self, *args, **kwargs):
-    if self.offeror_resources:
-      self.offeror_resources.save()
-    if self.offeree_resources:
-      self.offeree_resources.save()
-    super(Exchange, self).save(*args, **kwargs)
+  def _lock(self):
+    """
+    Locks and reloads the rows read or written by a state transition:
+    players' resources, the exchange itself, offered bonds and territories.
+    """
+    _lock_rows([self.offeror.player.resources,
+      self.offeree.player.resources if self.offeree_id else None])
+    _lock_rows([self])
+    _lock_rows([self.offeror_bond, self.offeree_bond])
+    _lock_rows([self.offeror_territory, self.offeree_territory])
 
   def _offeror_has_resources(self):
-    return not (self.offeror_resources is None or \
-      self.offeror_resources.is_empty())
+    return not self.offeror_resources.is_empty()
 
   def _offeree_has_resources(self):
-    return not (self.offeree_resources is None or \
-      self.offeree_resources.is_empty())
+    return not self.offeree_resources.is_empty()
+
+  def _validation_state(self):
+    return validation.GameState.of([self])
 
   def _validate_bond(self):
-    # We must refuse Bond exchanges with their holders, because currently
-    # there is no way to perform a safe transaction.
-    # Example: offeror Bond payment would be ok, but if offeree Bond, then
-    # we would have to undo the first payment.
-    if (self.offeror_bond is not None and self.offeror_as_bond) or \
-      (self.offeree_bond is not None and self.offeree_as_bond):
-      raise ValidationError(_("Cannot build a Bond of Bond."))
-
-    if self.offeror_bond:
-      if self.offeror_bond.borrower != self.offeror:
-        raise ValidationError(
-          _("“%(player)s” is not the borrower of this Bond."),
-          params={
-          'player': self.offeror.username
-          })
-      if self.offeror_bond.holder == self.offeree:
-        raise ValidationError(
-          _("Cannot exchange a Bond with its holder. "
-            "To pay the bond, use the payment section."))
-      if self.offeror_bond.state != self.offeror_bond.PENDING:
-        raise ValidationError(_("This Bond is not pending."))
-
-    if self.offeree_bond:
-      if self.offeree_bond.borrower != self.offeree:
-        raise ValidationError(
-          _("“%(player)s” is not the holder of this Bond."),
-          params={
-          'player': self.offeree.username
-          })
-      if self.offeree_bond.holder == self.offeror:
-        raise ValidationError(
-          _("Cannot exchange a Bond with its holder."))
-      if self.offeree_bond.state != self.offeree_bond.PENDING:
-        raise ValidationError(_("This Bond is not pending."))
+    validation.raise_first(validation.bond_problems(self,
+      self._validation_state()))
 
   def _validate_territory_ownership(self):
     """Applicable before accept"""
-    if not self.offeror_as_bond and self.offeror_territory:
-      if self.offeror_territory.owner != self.offeror:
-        raise ValidationError(
-          _("Offeror “%(player)s” does not control “%(territory)s”."),
-          params={
-          'player': self.offeror.username,
-          'territory': self.offeror_territory.name
-          })
-
-    if not self.offeree_as_bond and self.offeree_territory:
-      if self.offeree_territory.owner != self.offeree:
-        raise ValidationError(
-          _("Offeree “%(player)s” does not control “%(territory)s”."),
-          params={
-          'player': self.offeree.username,
-          'territory': self.offeree_territory.name
-          })
+    validation.raise_first(validation.territory_problems(self,
+      self._validation_state()))
+
+  def _offeree_lacks_resources(self):
+    return validation.offeree_lacks_resources(self.offeree.username)
+
+  def _offeror_lacks_resources(self):
+    return validation.offeror_lacks_resources(self.offeror.username)
 
   def _validate_resource_sufficiency(self):
-    if not self.offeree_as_bond and self._offeree_has_resources():
-      if not self.offeree.player.resources.covers(self.offeree_resources):
-        raise ValidationError(
-          _("Offeree “%(player)s” lack resources to accept this exchange."),
-          params={
-          'player': self.offeree.username
-          })
-
-    if self.state == self.UNKNOWN:
-      if not self.offeror_as_bond and self._offeror_has_resources():
-        if not self.offeror.player.resources.covers(self.offeror_resources):
-          raise ValidationError(
-            _("Offeror “%(player)s” lack resources to offer this exchange."),
-            params={
-            'player': self.offeror.username
-            })
+    """
+    Offeree sufficiency.  Offeror resources are checked when collected by
+    `offer`, with a guarded update.
+    """
+    validation.raise_first(validation.resource_problems(self,
+      self._validation_state()))
 
   def _check_if_empty(self):
     if not self._offeror_has_resources() and \
@@ -589,6 +1365,7 @@ class Exchange(models.Model):
         'player': user.username
         })
 
+  @transaction.atomic
   def offer(self, user):
     """
     Offeror `user` sends the exchange proposal.
@@ -597,6 +1374,7 @@ class Exchange(models.Model):
     of this exchange.
     """
     self._validate_user_as_offeror(user=user)
+    self._lock()
 
     if self.state != self.UNKNOWN:
       raise ValidationError(_("This exchange cannot be offered."))
@@ -604,30 +1382,44 @@ class Exchange(models.Model):
     if self.offeror == self.offeree:
       raise ValidationError(_("Offeror and offeree cannot be the same."))
 
+    if self.is_public() and (self.offeree_territory_id is not None or
+      self.offeree_bond_id is not None):
+      raise ValidationError(
+        _("Public offers cannot ask for a territory or a bond."))
+
     self._check_if_empty()
     self._validate_bond()
     #self._validate_territory_ownership()
     self._validate_resource_sufficiency()
 
-    if not self.offeror_as_bond and self._offeror_has_resources():
-      self.offeror.player.resources.subtract(self.offeror_resources)
+    collect = not self.offeror_as_bond and self._offeror_has_resources()
+    if collect:
+      if not self.offeror.player.resources.apply_delta(self.offeror_resources,
+        sign=-1, guard=True):
+        raise self._offeror_lacks_resources()
 
     self.state = self.WAITING
     self.offer_date = timezone.now()
     self.save()
+    if collect:
+      # Recorded once the exchange has a pk.
+      ResourceLedger.record(self.offeror.player.resources,
+        self.offeror_resources, -1, self)
+    _changed(self.offeror, self.offeree)
+    if self.is_public():
+      versions.changed(versions.PUBLIC)
+    events.exchanges_changed([self])
     return True
 
-  def is_acceptable(self):
-    try:
-      if self.state != self.WAITING:
-        raise ValidationError(_("This exchange is not waiting for response."))
-
-      self._validate_bond()
-      self._validate_territory_ownership()
-      self._validate_resource_sufficiency()
-    except:
-      return False
-    return True
+  def is_acceptable(self, state=None):
+    """
+    Whether `accept` would accept the exchange now, checked against `state`
+    (a `validation.GameState`, by default read from the related objects)
+    without side effects.
+    """
+    if state is None:
+      state = self._validation_state()
+    return not validation.acceptance_problems(self, state)
 
   def could_offeror_pay_offeree_bond(self):
     return self.offeree_bond.is_payable(borrower = self.offeror)
@@ -635,15 +1427,45 @@ class Exchange(models.Model):
   def could_offeree_pay_offeror_bond(self):
     return self.offeror_bond.is_payable(borrower = self.offeree)
 
+  @transaction.atomic
+  def claim(self, user):
+    """
+    Player `user` accepts the public offer and becomes its offeree.
+
+    The offer is claimed with one conditional UPDATE on its state and
+    offeree before anything else is locked: when many players accept at
+    once, the first claim wins and the others fail as soon as it commits,
+    without queueing for the players' resources.  Transitions of public
+    offers lock the exchange row first (see `cancel`) for the same reason.
+    """
+    if user.pk == self.offeror_id:
+      raise ValidationError(_("Offeror and offeree cannot be the same."))
+    claimed = Exchange.objects.filter(pk=self.pk, state=self.WAITING,
+      offeree__isnull=True).update(offeree=user)
+    if not claimed:
+      raise ValidationError(_("This offer was already taken or withdrawn."))
+    self.offeree = user
+    versions.changed(versions.PUBLIC)
+    try:
+      return self.accept(user=user)
+    except ValidationError:
+      # The refused acceptance rolls the claim back.
+      self.offeree = None
+      raise
+
   @transaction.atomic
   def accept(self, user):
     """
     Offeree `user` accepts the exchange. Resources are finally exchanged.
+    Public offers are claimed first.
     """
+    if self.is_public():
+      return self.claim(user=user)
     self._validate_user_as_offeree(user=user)
+    self._lock()
 
     if self.state != self.WAITING:
-      raise ValidationError(_("This exchange is not waiting for response."))
+      raise validation.not_waiting()
 
     self._validate_bond()
     self._validate_territory_ownership()
@@ -659,15 +1481,19 @@ class Exchange(models.Model):
       bond.save()
     else:
       if self._offeror_has_resources():
-        self.offeree.player.resources.add(self.offeror_resources)
+        self.offeree.player.resources.apply_delta(self.offeror_resources,
+          exchange=self)
 
       if self.offeror_territory:
         self.offeror_territory.owner = self.offeree
         self.offeror_territory.save()
+        map_colors.territories_changed()
 
       if self.offeror_bond:
         self.offeror_bond.borrower = self.offeree
         self.offeror_bond.save()
+        versions.changed(self.offeror_bond.holder_id)
+        events.bonds_changed([self.offeror_bond])
 
     if self.offeree_as_bond:
       bond = Bond(borrower=self.offeree, holder=self.offeror,
@@ -678,53 +1504,81 @@ class Exchange(models.Model):
       bond.save()
     else:
       if self._offeree_has_resources():
-        self.offeree.player.resources.subtract(self.offeree_resources)
-        self.offeror.player.resources.add(self.offeree_resources)
+        if not self.offeree.player.resources.apply_delta(
+          self.offeree_resources, sign=-1, guard=True, exchange=self):
+          raise self._offeree_lacks_resources()
+        self.offeror.player.resources.apply_delta(self.offeree_resources,
+          exchange=self)
 
       if self.offeree_territory:
         self.offeree_territory.owner = self.offeror
         self.offeree_territory.save()
+        map_colors.territories_changed()
 
       if self.offeree_bond:
         self.offeree_bond.borrower = self.offeror
         self.offeree_bond.save()
+        versions.changed(self.offeree_bond.holder_id)
+        events.bonds_changed([self.offeree_bond])
 
-    self.offeree.player.resources.save()
-    self.offeror.player.resources.save()
     self.state = self.ACCEPTED
     self.answer_date = timezone.now()
     self.save()
+    record_market_stats([self])
+    _changed(self.offeror, self.offeree)
+    events.exchanges_changed([self])
     return True
 
   def _undo_offer(self):
+    self._lock()
     if self.state != self.WAITING:
-      raise ValidationError(_("This exchange is not waiting for response."))
+      raise validation.not_waiting()
 
-    if self._offeror_has_resources():
-      self.offeror.player.resources.add(self.offeror_resources)
+    # Resources offered as bond were never collected
+    if not self.offeror_as_bond and self._offeror_has_resources():
+      self.offeror.player.resources.apply_delta(self.offeror_resources,
+        exchange=self)
 
+  @transaction.atomic
   def reject(self, user):
     """
     Offeree `user` rejects the exchange.
     """
+    if self.is_public():
+      raise ValidationError(_("Public offers cannot be rejected."))
     self._validate_user_as_offeree(user=user)
     self._undo_offer()
     self.state = self.REJECTED
     self.answer_date = timezone.now()
     self.save()
+    _changed(self.offeror, self.offeree)
+    events.exchanges_changed([self])
     return True
 
+  @transaction.atomic
   def cancel(self, user):
     """
     Offeror `user` cancels the exchange. Operation identical to rejection.
     """
     self._validate_user_as_offeror(user=user)
+    public = self.is_public()
+    if public:
+      # Same lock order as `claim`.
+      _lock_rows([self])
     self._undo_offer()
     self.state = self.CANCELED
     self.answer_date = timezone.now()
     self.save()
+    _changed(self.offeror, self.offeree)
+    if public:
+      versions.changed(versions.PUBLIC)
+    events.exchanges_changed([self])
     return True
 
+  def is_public(self):
+    """Whether any player may accept the exchange (no offeree yet)."""
+    return self.offeree_id is None
+
   def is_waiting(self):
     return self.state == self.WAITING
 
@@ -767,3 +1621,274 @@ class Exchange(models.Model):
     offeree = (self._offeree_has_resources() or self.offeree_territory is not None or \
       self.offeree_bond is not None) or False
     return offeror ^ offeree
+
+class Order(models.Model):
+  """
+  Standing limit order to buy or sell goods for currency.
+
+  Orders are matched by `game.orderbook`, best price first and then oldest
+  first, at the price of the order that was waiting in the book.  Nothing
+  is held while an order waits: each fill is settled as an accepted
+  exchange from the seller (the goods) to the buyer (the currency), checked
+  against both players' resources at that time like `Exchange.accept`.
+  """
+  BUY = 'B'
+  SELL = 'S'
+  SIDES = (
+    (BUY, 'Buy'),
+    (SELL, 'Sell'),
+  )
+  GOODS = (
+    ('manufactured', 'Manufactured Goods'),
+    ('agricultural', 'Agricultural Goods'),
+  )
+  OPEN = 'O'
+  FILLED = 'F'
+  CANCELED = 'C'
+  STATES = (
+    (OPEN, 'Open'),
+    (FILLED, 'Filled'),
+    (CANCELED, 'Canceled'),
+  )
+  user = models.ForeignKey(User, related_name='orders')
+  side = models.CharField(max_length=1, choices=SIDES)
+  good = models.CharField(max_length=12, choices=GOODS)
+  # Currency per unit of the good.
+  price = models.PositiveIntegerField()
+  quantity = models.PositiveIntegerField()
+  remaining = models.PositiveIntegerField()
+  state = models.CharField(max_length=1, choices=STATES, default=OPEN)
+  date = models.DateTimeField(default=timezone.now)
+
+  class Meta:
+    # The book reads open orders of one good and side by price, oldest
+    # first; players list their own orders by state.
+    index_together = [
+      ('good', 'side', 'state', 'price', 'id'),
+      ('user', 'state', 'id'),
+    ]
+
+  def __str__(self):
+    return "pk={}, {} {} {} at {}, {} left ({})".format(self.pk,
+      self.get_side_display(), self.quantity, self.good, self.price,
+      self.remaining, self.get_state_display())
+
+  def save(self, *args, **kwargs):
+    if self.remaining is None:
+      self.remaining = self.quantity
+    super(Order, self).save(*args, **kwargs)
+
+  @transaction.atomic
+  def cancel(self, user):
+    """Player `user` withdraws what is left of the order from the book."""
+    _lock_rows([self])
+    if user.pk != self.user_id:
+      raise ValidationError(_("“%(player)s” did not place this order."),
+        params={'player': user.username})
+    if not self.is_open():
+      raise ValidationError(_("This order is not open."))
+    self.state = self.CANCELED
+    self.save()
+    versions.changed(self.user_id)
+    events.orders_changed([self])
+    return True
+
+  def is_buy(self):
+    return self.side == self.BUY
+
+  def is_open(self):
+    return self.state == self.OPEN
+
+  def crosses(self, other):
+    """Whether `self` and the opposite order `other` agree on a price."""
+    buy, sell = (self, other) if self.is_buy() else (other, self)
+    return buy.price >= sell.price
+
+  def needs(self, quantity=None):
+    """`ResourceVector` the player gives when `quantity` units are filled."""
+    quantity = self.remaining if quantity is None else quantity
+    if self.is_buy():
+      return ResourceVector(currency=self.price * quantity)
+    return ResourceVector(**{self.good: quantity})
+
+class OrderBook(models.Model):
+  """
+  One row per good, locked by `game.orderbook.place_many` before it reads
+  the book, so that batches of the same good are matched one after the
+  other and never miss each other's orders.  Rows are created on first use.
+  """
+  good = models.CharField(max_length=12, choices=Order.GOODS, unique=True)
+
+  def __str__(self):
+    return self.good
+
+class Turn(models.Model):
+  """Log of the turns processed by `game.turns.process_turn`."""
+  number = models.IntegerField(unique=True)
+  processed_date = models.DateTimeField(default=timezone.now)
+  delinquent_bonds = models.IntegerField('Bonds marked delinquent', default=0)
+  delinquent_players = models.IntegerField(
+    'Players with new delinquent bonds', default=0)
+  seconds = models.FloatField('Processing time', default=0)
+
+  def __str__(self):
+    return 'number={}, delinquent_bonds={}'.format(self.number,
+      self.delinquent_bonds)
+
+class MarketStatsMixin(object):
+  """
+  Columns and arithmetic shared by the market statistics tables: accepted
+  exchanges and the resources given and received in them.
+  """
+  # Order of the values in `as_tuple` and in the deltas of `record`.
+  _stats = ['exchanges',
+    'currency_given', 'manufactured_given', 'agricultural_given',
+    'currency_received', 'manufactured_received', 'agricultural_received']
+
+  def as_tuple(self):
+    return tuple(getattr(self, name) for name in self._stats)
+
+  def given(self):
+    return ResourceVector(self.currency_given, self.manufactured_given,
+      self.agricultural_given)
+
+  def received(self):
+    return ResourceVector(self.currency_received, self.manufactured_received,
+      self.agricultural_received)
+
+  @classmethod
+  def _increments(cls, deltas, key):
+    """
+    UPDATE arguments adding to each row the delta of its key, where `key`
+    maps a key of `deltas` to the When() lookups of its row.
+    """
+    return {name: Case(*[When(then=F(name) + delta[i], **key(k))
+      for k, delta in deltas.items()], default=F(name))
+      for i, name in enumerate(cls._stats)}
+
+def _stats_field(name):
+  return models.IntegerField(name, default=0)
+
+class PlayerTurnStats(MarketStatsMixin, models.Model):
+  """
+  Market totals of a player from the first turn up to and including `turn`.
+  Rows are cumulative and only exist for turns the player traded in, so the
+  activity over turns (a, b] is the last row at or before b minus the last
+  row at or before a: two index lookups however long the history.  See
+  `game.stats`.
+  """
+  user = models.ForeignKey(User, related_name='+')
+  turn = models.IntegerField()
+  exchanges = _stats_field('Exchanges')
+  currency_given = _stats_field('Currency given')
+  manufactured_given = _stats_field('Manufactured Goods given')
+  agricultural_given = _stats_field('Agricultural Goods given')
+  currency_received = _stats_field('Currency received')
+  manufactured_received = _stats_field('Manufactured Goods received')
+  agricultural_received = _stats_field('Agricultural Goods received')
+
+  class Meta:
+    # Also the index of "last row of a user at or before a turn".
+    unique_together = [('user', 'turn')]
+
+  @classmethod
+  def record(cls, deltas, turn):
+    """
+    Adds `deltas` (user pk -> values in `_stats` order) to the totals of
+    each user at `turn` and at any later turn already recorded.
+    """
+    rows = cls.objects.filter(user__in=deltas, turn__gte=turn)
+    present = set(rows.filter(turn=turn).values_list('user', flat=True))
+    rows.update(**cls._increments(deltas, lambda pk: {'user': pk}))
+
+    missing = [pk for pk in deltas if pk not in present]
+    if not missing:
+      return
+    last = dict(cls.objects.filter(user__in=missing, turn__lt=turn)
+      .values_list('user').annotate(Max('turn')).order_by())
+    bases = {row.user_id: row.as_tuple() for row in cls.objects.filter(
+      user__in=list(last), turn__in=set(last.values()))
+      if row.turn == last[row.user_id]}
+    zero = (0,) * len(cls._stats)
+    cls.objects.bulk_create([cls(user_id=pk, turn=turn,
+      **dict(zip(cls._stats, [a + b for a, b in zip(bases.get(pk, zero),
+        deltas[pk])]))) for pk in missing])
+
+class PairStats(MarketStatsMixin, models.Model):
+  """
+  Market totals of `user` with `partner`: exchanges accepted between them,
+  resources `user` gave to and received from `partner`, and the last turn
+  they traded.  Every pair has a row per direction, so the top partners of
+  a player are read from one index.  See `game.stats`.
+  """
+  user = models.ForeignKey(User, related_name='+')
+  partner = models.ForeignKey(User, related_name='+')
+  last_turn = models.IntegerField()
+  exchanges = _stats_field('Exchanges')
+  currency_given = _stats_field('Currency given')
+  manufactured_given = _stats_field('Manufactured Goods given')
+  agricultural_given = _stats_field('Agricultural Goods given')
+  currency_received = _stats_field('Currency received')
+  manufactured_received = _stats_field('Manufactured Goods received')
+  agricultural_received = _stats_field('Agricultural Goods received')
+
+  class Meta:
+    unique_together = [('user', 'partner')]
+    index_together = [('user', 'exchanges')]
+
+  @classmethod
+  def record(cls, deltas, turn):
+    """
+    Adds `deltas` ((user pk, partner pk) -> values in `_stats` order) to the
+    totals of each pair, traded at `turn`.
+    """
+    users = set(user_pk for user_pk, _partner_pk in deltas)
+    partners = set(partner_pk for _user_pk, partner_pk in deltas)
+    # Rows are updated by pk: one lookup per row instead of two.
+    present = {(user_pk, partner_pk): pk for pk, user_pk, partner_pk
+      in cls.objects.filter(user__in=users, partner__in=partners)
+      .values_list('pk', 'user', 'partner')
+      if (user_pk, partner_pk) in deltas}
+    if present:
+      updates = cls._increments({pk: deltas[pair]
+        for pair, pk in present.items()}, lambda pk: {'pk': pk})
+      updates['last_turn'] = Case(When(last_turn__lt=turn, then=Value(turn)),
+        default=F('last_turn'))
+      cls.objects.filter(pk__in=present.values()).update(**updates)
+    cls.objects.bulk_create([cls(user_id=pair[0], partner_id=pair[1],
+      last_turn=turn, **dict(zip(cls._stats, deltas[pair])))
+      for pair in deltas if pair not in present])
+
+# Users or pairs per statistics UPDATE, which binds two parameters per value.
+STATS_CHUNK = 50
+
+def record_market_stats(exchanges):
+  """
+  Adds accepted `exchanges` to `PlayerTurnStats` and `PairStats`, in the
+  turn of their `answer_date`.  Resources turned into bonds are counted
+  when the bond is paid, by its payment exchange.
+
+  Callers lock the resources of both players of each exchange first (see
+  `Exchange._lock`), which serializes the updates of their rows.
+  """
+  by_turn = dict()
+  for exchange in exchanges:
+    turn = Config.to_turn(exchange.answer_date)
+    players, pairs = by_turn.setdefault(turn, (dict(), dict()))
+    gave = dict()
+    for side in ['offeror', 'offeree']:
+      gave[side] = ResourceVector.ZERO if getattr(exchange, side + '_as_bond') \
+        else getattr(exchange, side + '_resources').vector()
+    for side, other in [('offeror', 'offeree'), ('offeree', 'offeror')]:
+      user_pk = getattr(exchange, side + '_id')
+      delta = (1,) + tuple(gave[side]) + tuple(gave[other])
+      pair = (user_pk, getattr(exchange, other + '_id'))
+      for totals, key in [(players, user_pk), (pairs, pair)]:
+        totals[key] = tuple(a + b for a, b in zip(totals.get(key,
+          (0,) * len(delta)), delta))
+
+  for turn, (players, pairs) in sorted(by_turn.items()):
+    for model, deltas in [(PlayerTurnStats, players), (PairStats, pairs)]:
+      keys = sorted(deltas)
+      for i in range(0, len(keys), STATS_CHUNK):
+        model.record({k: deltas[k] for k in keys[i:i + STATS_CHUNK]}, turn)
@@ -0,0 +1,254 @@
+"""
+Order book and matching engine.
+
+`place_many` matches a batch of new `Order`s in memory against the open
+orders of the book that can cross them, best price first and then oldest
+first, at the price of the order waiting in the book.  The `OrderBook` rows
+of the batch's goods are locked first, so concurrent batches of a good are
+matched one after the other; then the players' resources the batch may
+touch and the crossing orders are locked and loaded.  Fills are checked
+against the running balances of the batch like
+`Exchange.objects.accept_many` does, and written back with grouped UPDATEs
+plus one INSERT per new order and per fill.  Each fill is an accepted
+`Exchange` from the seller to the buyer, so it shows in listings, the
+resource ledger and the market statistics like any other exchange.
+
+An order never fills against an order of the same player: the waiting order
+is canceled instead.  An order whose player no longer has what a fill needs
+is canceled too.
+"""
+import heapq
+import itertools
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, Q, Sum, Value, When
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from . import counters, events, versions
+from .models import (Exchange, Order, OrderBook, ResourceLedger,
+  ResourceVector, apply_resource_deltas, lock_users, record_market_stats)
+
+GOODS = [good for good, _name in Order.GOODS]
+OPPOSITE = {Order.BUY: Order.SELL, Order.SELL: Order.BUY}
+
+# Orders per grouped UPDATE, which binds five parameters per order.
+CHUNK_SIZE = 150
+
+class Book(object):
+  """Open orders of one good: a max-heap of bids and a min-heap of asks."""
+  def __init__(self):
+    self._heaps = {Order.BUY: [], Order.SELL: []}
+    self._sequence = itertools.count()
+
+  def add(self, order):
+    """Adds `order`, after the orders already added at its price."""
+    key = -order.price if order.is_buy() else order.price
+    heapq.heappush(self._heaps[order.side],
+      (key, next(self._sequence), order))
+
+  def best(self, side):
+    """Open order of `side` with the best price, oldest first, or None."""
+    heap = self._heaps[side]
+    # Filled and canceled orders are dropped lazily.
+    while heap and not heap[0][2].is_open():
+      heapq.heappop(heap)
+    return heap[0][2] if heap else None
+
+def _check(order):
+  if order.side not in OPPOSITE:
+    raise ValidationError(_("Unknown order side."))
+  if order.good not in GOODS:
+    raise ValidationError(_("Unknown good."))
+  for value in [order.price, order.quantity]:
+    if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+      raise ValidationError(_("Price and quantity must be positive integers."))
+
+def _lock_books(goods):
+  """Locks the `OrderBook` rows of `goods`, creating the missing ones."""
+  goods = sorted(goods)
+  locked = OrderBook.objects.select_for_update().filter(good__in=goods) \
+    .order_by('pk')
+  if len(locked) < len(goods):
+    for good in goods:
+      OrderBook.objects.get_or_create(good=good)
+    # Rows created concurrently by another batch are not locked yet.
+    list(locked.all())
+
+def _crossing(orders):
+  """Open orders of the book that may fill against `orders`."""
+  conditions = list()
+  for good in set(order.good for order in orders):
+    bids = [o.price for o in orders if o.good == good and o.is_buy()]
+    asks = [o.price for o in orders if o.good == good and not o.is_buy()]
+    if bids:
+      conditions.append(Q(good=good, side=Order.SELL, price__lte=max(bids)))
+    if asks:
+      conditions.append(Q(good=good, side=Order.BUY, price__gte=min(asks)))
+  return Order.objects.filter(reduce(or_, conditions), state=Order.OPEN)
+
+class _Settlement(object):
+  """Running balances and pending writes of a batch."""
+  def __init__(self, users):
+    self.users = users
+    self.balances = {pk: user.player.resources.vector()
+      for pk, user in users.items()}
+    self.fills = list()
+    self.entries = list()
+    self.deltas = dict()
+    self.now = timezone.now()
+
+  def _move(self, user_pk, vector, exchange):
+    self.balances[user_pk] += vector
+    resources = self.users[user_pk].player.resources
+    self.deltas[resources.pk] = self.deltas.get(resources.pk,
+      ResourceVector.ZERO) + vector
+    self.entries.append((resources, exchange, vector))
+
+  def fill(self, buy, sell, quantity, goods, currency):
+    """`sell` gives `quantity` units (`goods`) to `buy` for `currency`."""
+    exchange = Exchange(offeror_id=sell.user_id, offeree_id=buy.user_id,
+      state=Exchange.ACCEPTED, offer_date=self.now, answer_date=self.now,
+      offeror_resources=goods.to_resources(),
+      offeree_resources=currency.to_resources())
+    self._move(sell.user_id, currency - goods, exchange)
+    self._move(buy.user_id, goods - currency, exchange)
+    self.fills.append(exchange)
+    for order in [buy, sell]:
+      order.remaining -= quantity
+      if order.remaining == 0:
+        order.state = Order.FILLED
+
+def _match(order, book, settlement, changed):
+  """Fills `order` against `book` while prices cross."""
+  while order.is_open():
+    other = book.best(OPPOSITE[order.side])
+    if other is None or not order.crosses(other):
+      return
+    # Unsaved orders of the batch are not hashable.
+    changed[id(other)] = other
+    if other.user_id == order.user_id:
+      other.state = Order.CANCELED
+      continue
+    quantity = min(order.remaining, other.remaining)
+    buy, sell = (order, other) if order.is_buy() else (other, order)
+    goods = ResourceVector(**{order.good: quantity})
+    currency = ResourceVector(currency=other.price * quantity)
+    for gives, needs in [(sell, goods), (buy, currency)]:
+      if not settlement.balances[gives.user_id].covers(needs):
+        gives.state = Order.CANCELED
+    if buy.is_open() and sell.is_open():
+      settlement.fill(buy, sell, quantity, goods, currency)
+
+def _update(orders):
+  """Writes the remaining quantity and state of saved `orders`."""
+  for i in range(0, len(orders), CHUNK_SIZE):
+    chunk = orders[i:i + CHUNK_SIZE]
+    Order.objects.filter(pk__in=[o.pk for o in chunk]).update(
+      remaining=Case(*[When(pk=o.pk, then=Value(o.remaining))
+        for o in chunk]),
+      state=Case(*[When(pk=o.pk, then=Value(o.state)) for o in chunk]))
+
+@transaction.atomic
+def place_many(orders):
+  """
+  Places many unsaved `orders`, one after the other in list order, each one
+  filled as far as the book allows before the next is placed; what is left
+  of an order waits in the book.
+
+  Returns `(placed, failures)`: the saved orders and a dictionary mapping
+  the index of each refused order to its `ValidationError`.  An order is
+  refused when invalid or when its player does not have what it needs for
+  all of its quantity.
+  """
+  orders = list(orders)
+  failures = dict()
+  for i, order in enumerate(orders):
+    try:
+      _check(order)
+    except ValidationError as e:
+      failures[i] = e
+  valid = [order for i, order in enumerate(orders) if i not in failures]
+  if not valid:
+    return [], failures
+
+  # With the books locked, open orders of these goods can only be canceled,
+  # so the players read here cover every crossing order.  Then the same lock
+  # order as exchanges: resources first, then orders.
+  _lock_books(set(order.good for order in valid))
+  crossing = _crossing(valid)
+  users = lock_users(set(order.user_id for order in valid) | set(
+    crossing.values_list('user_id', flat=True)))
+  resting = [order for order in crossing.select_for_update().order_by('pk')
+    if order.user_id in users]
+
+  books = {good: Book() for good in GOODS}
+  for order in resting:
+    books[order.good].add(order)
+  settlement = _Settlement(users)
+  changed = dict()
+  placed = list()
+  for i, order in enumerate(orders):
+    if i in failures:
+      continue
+    if order.user_id not in users:
+      failures[i] = ValidationError(_("Unknown player."))
+      continue
+    order.remaining = order.quantity
+    order.state = Order.OPEN
+    order.date = settlement.now
+    if not settlement.balances[order.user_id].covers(order.needs()):
+      failures[i] = ValidationError(
+        _("“%(player)s” does not have enough resources for this order."),
+        params={'player': users[order.user_id].username})
+      continue
+    _match(order, books[order.good], settlement, changed)
+    if order.is_open():
+      books[order.good].add(order)
+    placed.append(order)
+
+  # Orders of the batch are saved with their final state.
+  changed = sorted((order for order in changed.values() if order.pk),
+    key=lambda order: order.pk)
+  for order in placed:
+    order.save()
+  for exchange in settlement.fills:
+    exchange.save()
+  if settlement.deltas:
+    apply_resource_deltas(settlement.deltas)
+    # Built once the exchanges have a pk.
+    ResourceLedger.objects.bulk_create([ResourceLedger(resources=resources,
+      exchange=exchange, **vector.as_dict())
+      for resources, exchange, vector in settlement.entries])
+  _update(changed)
+  record_market_stats(settlement.fills)
+
+  traders = set(order.user_id for order in placed) | set(
+    order.user_id for order in changed)
+  counters.invalidate(*[users[pk] for pk in set(pk for exchange in
+    settlement.fills for pk in (exchange.offeror_id, exchange.offeree_id))])
+  versions.changed(*traders)
+  events.orders_changed(placed + changed)
+  events.exchanges_changed(settlement.fills)
+  return placed, failures
+
+def place(order):
+  """Places one unsaved `order` (see `place_many`), raising if refused."""
+  placed, failures = place_many([order])
+  if failures:
+    raise failures[0]
+  return placed[0]
+
+def depth(good, levels=10):
+  """
+  `(bids, asks)`: lists of (price, open quantity) of the `levels` best
+  prices to buy and to sell `good`.
+  """
+  def side(side, order_by):
+    return [(row['price'], row['quantity']) for row in Order.objects.filter(
+      good=good, side=side, state=Order.OPEN).values('price').annotate(
+      quantity=Sum('remaining')).order_by(order_by)[:levels]]
+  return side(Order.BUY, '-price'), side(Order.SELL, 'price')
@@ -0,0 +1,117 @@
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+PAGE_SIZE = 25
+
+class KeysetPage(object):
+  """
+  One page of a keyset (seek) paginated listing.
+
+  Pages are addressed by a cursor holding the key values of the last row of
+  the previous page, so fetching any page costs the same regardless of how
+  many rows come before it.
+  """
+  def __init__(self, object_list, cursor, next_cursor, param, query):
+    self.object_list = object_list
+    self.cursor = cursor
+    self.next_cursor = next_cursor
+    self.param = param
+    self.query = query
+
+  def __iter__(self):
+    return iter(self.object_list)
+
+  def __len__(self):
+    return len(self.object_list)
+
+  def has_next(self):
+    return self.next_cursor is not None
+
+  def next_query(self):
+    """Query string for the next page, keeping other parameters."""
+    query = self.query.copy()
+    query[self.param] = self.next_cursor
+    return query.urlencode()
+
+  def newest_query(self):
+    """Query string for the first page, keeping other parameters."""
+    query = self.query.copy()
+    query.pop(self.param, None)
+    return query.urlencode()
+
+def _field(model, key):
+  if key == 'pk':
+    return model._meta.pk
+  return model._meta.get_field(key)
+
+def encode(obj, keys):
+  """Cursor of the page after `obj`."""
+  return '_'.join(_field(type(obj), key).value_to_string(obj) for key in keys)
+
+def _decode(model, keys, cursor):
+  values = cursor.split('_')
+  if len(values) != len(keys):
+    raise ValidationError("Invalid cursor.")
+  values = [_field(model, key).to_python(value)
+    for key, value in zip(keys, values)]
+  if None in values:
+    raise ValidationError("Invalid cursor.")
+  return values
+
+def _seek(keys, values):
+  """
+  Rows strictly after `values` in descending `keys` order:
+  k1 <= v1 AND (k1 < v1 OR (k1 = v1 AND k2 < v2) OR ...)
+
+  The first, redundant, bound lets the database seek the index on the
+  leading key; SQLite does not use the OR-expanded condition as a range.
+  """
+  after = Q()
+  for i, key in enumerate(keys):
+    condition = Q(**{key + '__lt': values[i]})
+    for previous_key, previous_value in zip(keys[:i], values[:i]):
+      condition &= Q(**{previous_key: previous_value})
+    after |= condition
+  return Q(**{keys[0] + '__lte': values[0]}) & after
+
+def seek(queryset, keys, cursor=None):
+  """
+  `queryset` ordered by descending `keys`, without the rows with a NULL key
+  (e.g. exchanges never offered, without `offer_date`), which have no place
+  in that order, and starting after `cursor` if given.  Raises
+  ValidationError for an invalid cursor.
+  """
+  for key in keys:
+    if _field(queryset.model, key).null:
+      queryset = queryset.exclude(**{key + '__isnull': True})
+  queryset = queryset.order_by(*['-' + key for key in keys])
+  if cursor:
+    queryset = queryset.filter(_seek(keys, _decode(queryset.model, keys,
+      cursor)))
+  return queryset
+
+def paginate(request, queryset, keys, param='cursor', size=PAGE_SIZE):
+  """
+  Returns a `KeysetPage` of `queryset` ordered by descending `keys`.
+
+  The cursor is read from the `param` GET parameter (see `seek`).  `keys`
+  must end with a unique field (usually 'pk') so the order is total.  An
+  invalid cursor falls back to the first page.
+
+  A page costs the same at any depth when an index starts with the
+  listing's equality filters followed by `keys`.  A filter on several
+  values of an indexed column (e.g. exchanges in several states) breaks
+  that order: the database then sorts every matching row on each page.
+  """
+  cursor = request.GET.get(param)
+  try:
+    queryset = seek(queryset, keys, cursor)
+  except ValidationError:
+    cursor = None
+    queryset = seek(queryset, keys)
+  rows = list(queryset[:size + 1])
+  next_cursor = None
+  if len(rows) > size:
+    rows = rows[:size]
+    next_cursor = encode(rows[-1], keys)
+  return KeysetPage(rows, cursor, next_cursor, param, request.GET)
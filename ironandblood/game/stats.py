@@ -0,0 +1,107 @@
+"""
+Player market statistics.
+
+`PlayerTurnStats` keeps cumulative totals per player and turn and
+`PairStats` totals per pair of players; both are updated by
+`record_market_stats` when exchanges are accepted.  The activity of a player
+over the last turns is the difference of two cumulative rows, so reading it
+takes two index lookups whatever the length of the history.
+"""
+from django.db import transaction
+
+from .config import Config
+from .models import (Exchange, MarketStatsMixin, PairStats, PlayerTurnStats,
+  record_market_stats)
+
+CHUNK_SIZE = 500
+
+ZERO = (0,) * len(MarketStatsMixin._stats)
+
+def _totals_at(user, turn):
+  """Cumulative values of `user` up to and including `turn`."""
+  row = PlayerTurnStats.objects.filter(user=user, turn__lte=turn) \
+    .order_by('-turn').first()
+  return ZERO if row is None else row.as_tuple()
+
+def _ratio(a, b):
+  return a / b if b else None
+
+def _summary(values):
+  """Activity dictionary of values in `MarketStatsMixin._stats` order."""
+  summary = PlayerTurnStats(**dict(zip(MarketStatsMixin._stats, values)))
+  given, received = summary.given(), summary.received()
+  volume = given + received
+  return {
+    'exchanges': summary.exchanges,
+    'given': given,
+    'received': received,
+    'volume': volume,
+    # Units of the first resource traded per unit of the second one.
+    'ratios': {
+      'currency_per_manufactured': _ratio(volume.currency,
+        volume.manufactured),
+      'currency_per_agricultural': _ratio(volume.currency,
+        volume.agricultural),
+      'manufactured_per_agricultural': _ratio(volume.manufactured,
+        volume.agricultural),
+    },
+  }
+
+def activity(user, turns, turn=None):
+  """
+  Activity of `user` over the `turns` turns up to `turn` (default: the
+  current turn): dictionary with the number of `exchanges`, the resources
+  `given`, `received` and their sum (`volume`) as `ResourceVector`s, and the
+  price `ratios` between resources in that volume.
+  """
+  if turn is None:
+    turn = Config.current_turn()
+  end = _totals_at(user, turn)
+  start = _totals_at(user, turn - turns)
+  return _summary([a - b for a, b in zip(end, start)])
+
+def history(user, turns, turn=None):
+  """
+  Activity of `user` in each of the `turns` turns up to `turn` (default: the
+  current turn), as a list of (turn, activity) from the oldest turn.
+  """
+  if turn is None:
+    turn = Config.current_turn()
+  first = turn - turns + 1
+  rows = {row.turn: row.as_tuple() for row in PlayerTurnStats.objects.filter(
+    user=user, turn__gte=first, turn__lte=turn)}
+  previous = _totals_at(user, first - 1)
+  result = list()
+  for number in range(first, turn + 1):
+    current = rows.get(number, previous)
+    result.append((number,
+      _summary([a - b for a, b in zip(current, previous)])))
+    previous = current
+  return result
+
+def top_partners(user, limit=5):
+  """
+  `PairStats` of the `limit` players `user` traded with most, by number of
+  exchanges, with `partner` loaded.
+  """
+  return list(PairStats.objects.filter(user=user).select_related('partner')
+    .order_by('-exchanges', 'partner_id')[:limit])
+
+@transaction.atomic
+def rebuild(chunk_size=CHUNK_SIZE):
+  """
+  Recomputes both tables from the accepted exchanges, `chunk_size` at a
+  time.  Returns the number of exchanges replayed.
+  """
+  PlayerTurnStats.objects.all().delete()
+  PairStats.objects.all().delete()
+  replayed = 0
+  after = 0
+  while True:
+    chunk = list(Exchange.objects.filter(state=Exchange.ACCEPTED,
+      answer_date__isnull=False, pk__gt=after).order_by('pk')[:chunk_size])
+    if not chunk:
+      return replayed
+    record_market_stats(chunk)
+    replayed += len(chunk)
+    after = chunk[-1].pk
@@ -1,9 +1,33 @@
 # vim: ai ts=2 sts=2 et sw=2
+import asyncio
+import datetime
+import json
+import random
+import re
+import threading
+import time
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.test import TestCase
-
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.urlresolvers import reverse
+from django.db import OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from game import counters, events, ledger, map_colors, orderbook, stats
+from game import turns
+from game import validation, versions
+from game.asgi import GameApplication
+from game.benchmarks import connections, engine, query_plans
+from game.benchmarks import views as benchmark_views
+from game.config import Config
+from game.forms import ExchangeForm
 from game.models import Bond, Charter, Exchange, Player, Territory, Resources
+from game.models import Order, OrderBook, PairStats, PlayerTurnStats
+from game.models import ResourceLedger, ResourceSnapshot, ResourceVector, Turn
 
 def create_test_game():
   usernames = ['arthur', 'brian', 'blacknight', 'caesar', 'dickens', 'eric',
@@ -18,6 +42,67 @@ def create_test_game():
   for territory_name in territories:
     Territory.objects.create(name=territory_name, land_area=10)
 
+def statements(queries):
+  """SQL of captured `queries`, leaving out savepoints."""
+  return [q['sql'] for q in queries.captured_queries
+    if not q['sql'].startswith(('SAVEPOINT', 'RELEASE SAVEPOINT'))]
+
+class ResourcesTestCase(TestCase):
+  def test_apply_delta(self):
+    res = Resources.objects.create(currency=100, agricultural=5)
+    with CaptureQueriesContext(connection) as queries:
+      self.assertTrue(res.apply_delta(Resources(currency=30)))
+    self.assertEqual(len(queries), 1)
+    self.assertIn('UPDATE', queries[0]['sql'])
+    self.assertNotIn('manufactured', queries[0]['sql'])
+    self.assertEqual(res.currency, 130)
+    self.assertEqual(Resources.objects.get(pk=res.pk).currency, 130)
+
+    self.assertTrue(res.apply_delta(Resources(currency=30, agricultural=5),
+      sign=-1, guard=True))
+    res = Resources.objects.get(pk=res.pk)
+    self.assertEqual(res.as_list(), [100, 0, 0])
+
+  def test_apply_delta_guard(self):
+    res = Resources.objects.create(currency=100, agricultural=5)
+    # Another request spends the resources behind our back.
+    Resources.objects.filter(pk=res.pk).update(currency=10)
+    self.assertFalse(res.apply_delta(Resources(currency=50), sign=-1,
+      guard=True))
+    self.assertEqual(res.currency, 100)
+    self.assertEqual(Resources.objects.get(pk=res.pk).currency, 10)
+
+    # Without guard the row may become negative.
+    self.assertTrue(res.apply_delta(Resources(currency=50), sign=-1))
+    self.assertEqual(Resources.objects.get(pk=res.pk).currency, -40)
+
+  def test_vector(self):
+    a = ResourceVector(currency=10, agricultural=2)
+    b = ResourceVector.of(Resources(currency=4, manufactured=1))
+    self.assertEqual(a + b, (14, 1, 2))
+    self.assertEqual(a - b, (6, -1, 2))
+    self.assertEqual(-a, (-10, 0, -2))
+    self.assertEqual(2 * a, (20, 0, 4))
+    self.assertIsInstance(a + b, ResourceVector)
+    self.assertEqual((a - b).manufactured, -1)
+    self.assertFalse((a - b).is_zero_or_positive())
+    self.assertTrue(a.covers(ResourceVector(currency=10)))
+    self.assertFalse(a.covers(b))
+    self.assertTrue(ResourceVector.of(None).is_empty())
+    self.assertEqual(str(a), 'currency=10, agricultural=2')
+    with self.assertRaises(AttributeError):
+      a.currency = 0
+
+    res = a.to_resources()
+    self.assertIsNone(res.pk)
+    self.assertEqual(res.vector(), a)
+    res.subtract(b)
+    self.assertEqual(res.as_list(), [6, -1, 2])
+
+    res = Resources.objects.create(currency=100, agricultural=5)
+    self.assertTrue(res.apply_delta(a, sign=-1, guard=True))
+    self.assertEqual(Resources.objects.get(pk=res.pk).as_list(), [90, 0, 3])
+
 class PlayerTestCase(TestCase):
   def setUp(self):
     create_test_game()
@@ -49,6 +134,53 @@ class PlayerTestCase(TestCase):
     self.assertTrue(dickens.player.is_chartered_company())
     self.assertFalse(dickens.player.is_head_of_state())
 
+  def test_player_role_costs_no_queries(self):
+    player = Player.objects.get(user__username='dickens')
+    with self.assertNumQueries(0):
+      self.assertTrue(player.is_chartered_company())
+    self.assertEqual((player.territory_count, player.charter_count), (0, 1))
+
+  def test_role_follows_territory_transfer(self):
+    arthur = User.objects.get(username='arthur')
+    brian = User.objects.get(username='brian')
+    aglax = Territory.objects.get(name='Aglax')
+    exchange = Exchange(offeror=arthur, offeror_territory=aglax,
+      offeree=brian)
+    exchange.offer(user=arthur)
+    exchange.accept(user=brian)
+    self.assertTrue(brian.player.is_head_of_state())
+    arthur = Player.objects.get(user__username='arthur')
+    brian = Player.objects.get(user__username='brian')
+    self.assertEqual((arthur.role, arthur.territory_count), ('P', 0))
+    self.assertEqual((brian.role, brian.territory_count), ('H', 1))
+
+  def test_role_follows_charter_deletion(self):
+    Charter.objects.get(member__username='dickens').delete()
+    self.assertTrue(Player.objects.get(user__username='dickens') \
+      .is_privateer())
+
+    # Deleting the territory drops its owner's and members' counts
+    dickens = User.objects.get(username='dickens')
+    aglax = Territory.objects.get(name='Aglax')
+    Charter.objects.create(territory=aglax, member=dickens, size=10)
+    aglax.delete()
+    for name in ['arthur', 'dickens']:
+      self.assertTrue(Player.objects.get(user__username=name).is_privateer())
+
+  def test_recompute_counts(self):
+    self.assertEqual(Player.recompute_counts(), 0)
+    # Queryset updates bypass the counters
+    Territory.objects.filter(name='Brierhiel').update(
+      owner=User.objects.get(username='brian'))
+    Player.objects.filter(user__username='dickens').update(charter_count=5,
+      role=Player.PRIVATEER)
+    self.assertEqual(Player.recompute_counts(), 2)
+    brian = Player.objects.get(user__username='brian')
+    dickens = Player.objects.get(user__username='dickens')
+    self.assertEqual((brian.role, brian.territory_count), ('H', 1))
+    self.assertEqual((dickens.role, dickens.charter_count), ('C', 1))
+    self.assertEqual(Player.recompute_counts(), 0)
+
 class CharterTestCase(TestCase):
   def setUp(self):
     create_test_game()
@@ -107,6 +239,98 @@ class CharterTestCase(TestCase):
     self.assertTrue(dickens.player.is_chartered_company())
     self.assertTrue(lancelot.player.is_privateer())
 
+  def test_concurrent_grants_are_guarded(self):
+    arthur = User.objects.get(username='arthur')
+    dickens = User.objects.get(username='dickens')
+    lancelot = User.objects.get(username='lancelot')
+
+    # Both grants are checked against the same, empty, territory
+    first = Territory.objects.get(name='Aglax')
+    second = Territory.objects.get(name='Aglax')
+    c1 = Charter.grant(leaser=arthur, territory=first, member=dickens, size=60)
+    c2 = Charter.grant(leaser=arthur, territory=second, member=lancelot,
+      size=60)
+    c3 = Charter.grant(leaser=arthur, territory=second, member=dickens, size=5)
+    with CaptureQueriesContext(connection) as queries:
+      c1.save()
+    # Guarded allotment, insert and counter update
+    self.assertEqual(len(statements(queries)), 3)
+    with self.assertRaisesRegexp(ValidationError,
+      ("“Aglax” has 40% of its land area available. "
+       "Trying to grant 60% of land.")):
+      c2.save()
+    with self.assertRaisesRegexp(ValidationError,
+      "dickens already has a charter in “Aglax”\."):
+      c3.save()
+    self.assertEqual(Territory.objects.get(name='Aglax').allotted, 60)
+    self.assertEqual(Charter.objects.count(), 1)
+
+    c1.delete()
+    self.assertEqual(Territory.objects.get(name='Aglax').allotted, 0)
+    self.assertTrue(Player.objects.get(user=dickens).is_privateer())
+
+  def test_moving_charter_moves_allotment(self):
+    arthur = User.objects.get(username='arthur')
+    efea = Territory.objects.get(name='Efea')
+    efea.owner = arthur
+    efea.save()
+    charter = Charter.grant(leaser=arthur,
+      territory=Territory.objects.get(name='Aglax'),
+      member=User.objects.get(username='dickens'), size=30)
+    charter.save()
+    charter.territory = efea
+    charter.size = 40
+    charter.save()
+    self.assertEqual(Territory.objects.get(name='Aglax').allotted, 0)
+    self.assertEqual(Territory.objects.get(name='Efea').allotted, 40)
+
+    # A move refused by the new territory keeps the old allotment
+    Territory.objects.filter(name='Aglax').update(allotted=90)
+    charter.territory = Territory.objects.get(name='Aglax')
+    with self.assertRaises(ValidationError):
+      charter.save()
+    self.assertEqual(Territory.objects.get(name='Efea').allotted, 40)
+
+  def test_saving_territory_keeps_allotment(self):
+    arthur = User.objects.get(username='arthur')
+    stale = Territory.objects.get(name='Aglax')
+    Charter.grant(leaser=arthur, territory=Territory.objects.get(name='Aglax'),
+      member=User.objects.get(username='dickens'), size=30).save()
+    stale.land_area = 20
+    stale.save()
+    aglax = Territory.objects.get(name='Aglax')
+    self.assertEqual((aglax.land_area, aglax.allotted), (20, 30))
+
+  def test_grant_many(self):
+    arthur = User.objects.get(username='arthur')
+    brierhiel = Territory.objects.get(name='Brierhiel')
+    brierhiel.owner = arthur
+    brierhiel.save()
+    territories = list(Territory.objects.filter(owner=arthur))
+    members = list(User.objects.exclude(pk=arthur.pk).order_by('pk')[:10])
+    charters = [Charter(territory=t, member=m, size=10)
+      for t in territories for m in members]
+    with CaptureQueriesContext(connection) as queries:
+      Charter.grant_many(charters)
+    # Lock, existing charters, allotment, insert and one counter update
+    self.assertEqual(len(statements(queries)), 5)
+    self.assertEqual(Charter.objects.count(), 20)
+    self.assertEqual(list(Territory.objects.filter(owner=arthur)
+      .values_list('allotted', flat=True)), [100, 100])
+    for player in Player.objects.filter(user__in=members):
+      self.assertEqual((player.role, player.charter_count), ('C', 2))
+
+    with self.assertRaisesRegexp(ValidationError,
+      ("“Aglax” has 0% of its land area available. "
+       "Trying to grant 1% of land.")):
+      Charter.grant_many([Charter(territory=territories[0], member=arthur,
+        size=1)])
+    with self.assertRaisesRegexp(ValidationError,
+      "Nobody controls “Cesta”\."):
+      Charter.grant_many([Charter(territory=Territory.objects.get(
+        name='Cesta'), member=arthur, size=1)])
+    self.assertEqual(Charter.objects.count(), 20)
+
 class ExchangeTestCase(TestCase):
   def setUp(self):
     create_test_game()
@@ -814,6 +1038,55 @@ class ExchangeTestCase(TestCase):
 
     exchange = Exchange(offeror=arthur, offeror_resources=offeror_r,
                                         offeree_resources=offeree_r)
+    self.assertTrue(exchange.is_public())
+    exchange.offer(user=arthur)
+    self.assertEqual(arthur.player.resources.currency, 501)
+    self.assertEqual(list(Exchange.objects.public_offers()), [exchange])
+    stale = Exchange.objects.get(pk=exchange.pk)
+
+    with self.assertRaises(ValidationError):
+      exchange.reject(user=brian)
+    # Arthur cannot take his own offer
+    with self.assertRaises(ValidationError):
+      exchange.accept(user=arthur)
+    # Patsy has no agricultural resources: the offer stays public
+    with self.assertRaises(ValidationError):
+      exchange.accept(user=patsy)
+    self.assertTrue(exchange.is_public())
+    self.assertIsNone(Exchange.objects.get(pk=exchange.pk).offeree)
+
+    exchange.accept(user=brian)
+    self.assertEqual(exchange.state, exchange.ACCEPTED)
+    self.assertEqual(Exchange.objects.get(pk=exchange.pk).offeree, brian)
+    self.assertEqual(list(Exchange.objects.public_offers()), [])
+    brian_r = Resources.objects.get(player__user=brian)
+    self.assertEqual((brian_r.currency, brian_r.agricultural), (499, 10))
+    self.assertEqual(Resources.objects.get(player__user=arthur).agricultural, 1)
+
+    # First accept wins
+    with self.assertRaisesMessage(ValidationError, 'already taken'):
+      stale.accept(user=patsy)
+    self.assertEqual(Resources.objects.get(player__user=patsy).currency, 0)
+
+  def test_public_exchange_canceled(self):
+    arthur = User.objects.get(username='arthur')
+    efea = Territory.objects.get(name='Efea')
+
+    exchange = Exchange(offeror=arthur, offeree_territory=efea,
+      offeror_resources=Resources.objects.create(currency=10))
+    with self.assertRaises(ValidationError):
+      exchange.offer(user=arthur)
+
+    exchange = Exchange(offeror=arthur,
+      offeror_resources=Resources.objects.create(currency=10))
+    exchange.offer(user=arthur)
+    before = versions.get(versions.PUBLIC)
+    exchange.cancel(user=arthur)
+    self.assertEqual(exchange.state, exchange.CANCELED)
+    self.assertEqual(arthur.player.resources.currency, 1000)
+    self.assertNotEqual(versions.get(versions.PUBLIC), before)
+    with self.assertRaises(ValidationError):
+      exchange.accept(user=User.objects.get(username='brian'))
 
   def test_fail_bond_of_bond(self):
     arthur = User.objects.get(username='arthur')
@@ -1220,3 +1493,1482 @@ class ExchangeTestCase(TestCase):
     self.assertEqual(bond.state, bond.PENDING)
     bond.forgive(user=arthur)
     self.assertEqual(bond.state, bond.FORGIVEN)
+
+class ExchangeListingTestCase(TestCase):
+  def setUp(self):
+    create_test_game()
+    arthur = User.objects.get(username='arthur')
+    brian = User.objects.get(username='brian')
+
+    aglax = Territory.objects.get(name='Aglax')
+    aglax.owner = arthur
+    aglax.save()
+
+    efea = Territory.objects.get(name='Efea')
+    efea.owner = brian
+    efea.save()
+
+    self.client.force_login(arthur)
+
+  def create_exchanges(self, count, offer_date=None):
+    """
+    Creates `count` waiting exchanges in both directions between Arthur and
+    Brian, each one with resources, territories and a bond.
+    """
+    arthur = User.objects.get(username='arthur')
+    brian = User.objects.get(username='brian')
+    gumby = User.objects.get(username='gumby')
+    aglax = Territory.objects.get(name='Aglax')
+    efea = Territory.objects.get(name='Efea')
+    for i in range(count):
+      for offeror, offeree, territory in [(brian, arthur, efea),
+                                          (arthur, brian, aglax)]:
+        bond = Bond.objects.create(holder=gumby, borrower=offeror,
+          resources=Resources.objects.create(currency=10),
+          territory=territory)
+        Exchange.objects.create(offeror=offeror, offeree=offeree,
+          offeror_resources=Resources.objects.create(currency=i + 1),
+          offeror_territory=territory,
+          offeror_bond=bond,
+          offeree_resources=Resources.objects.create(agricultural=1),
+          state=Exchange.WAITING,
+          offer_date=offer_date or timezone.now())
+
+  def count_queries(self, url):
+    counters.cache().clear()
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    return len(queries)
+
+  def test_exchanges_constant_queries(self):
+    url = reverse('game:exchanges')
+    self.create_exchanges(2)
+    few = self.count_queries(url)
+    self.create_exchanges(20)
+    self.assertEqual(self.count_queries(url), few)
+
+  def test_new_exchange_constant_queries(self):
+    url = reverse('game:exchange', args=['brian'])
+    self.create_exchanges(2)
+    few = self.count_queries(url)
+    self.create_exchanges(20)
+    self.assertEqual(self.count_queries(url), few)
+
+  def walk_pages(self, url, param):
+    """Follows the cursors of a listing, returning pks of every page."""
+    pages = list()
+    query = {}
+    while True:
+      response = self.client.get(url, query)
+      page = response.context[param]
+      pages.append([e.pk for e in page])
+      if not page.has_next():
+        return pages
+      self.assertLess(len(pages), 100, 'The cursors do not advance.')
+      query = {page.param: page.next_cursor}
+
+  def test_exchanges_keyset_pagination(self):
+    arthur = User.objects.get(username='arthur')
+    # Same offer date for every exchange: order must fall back to pk.
+    self.create_exchanges(30, offer_date=timezone.now())
+    self.create_exchanges(30)
+    pages = self.walk_pages(reverse('game:exchanges'), 'received_exchanges')
+    self.assertEqual([len(p) for p in pages], [25, 25, 10])
+    expected = Exchange.objects.filter(offeree=arthur)
+    expected = expected.order_by('-offer_date', '-pk')
+    self.assertEqual(sum(pages, []), [e.pk for e in expected])
+
+  def test_keyset_pagination_skips_null_offer_dates(self):
+    arthur = User.objects.get(username='arthur')
+    self.create_exchanges(30)
+    received = Exchange.objects.filter(offeree=arthur).order_by('pk')
+    Exchange.objects.filter(pk__in=[e.pk for e in received[:6]]).update(
+      offer_date=None)
+    pages = self.walk_pages(reverse('game:exchanges'), 'received_exchanges')
+    expected = received.exclude(offer_date=None).order_by('-offer_date', '-pk')
+    self.assertEqual(pages, [[e.pk for e in expected]])
+
+  def test_new_exchange_keyset_pagination(self):
+    self.create_exchanges(20)
+    pages = self.walk_pages(reverse('game:exchange', args=['brian']),
+      'exchange_history')
+    self.assertEqual([len(p) for p in pages], [25, 15])
+    expected = Exchange.objects.order_by('-offer_date', '-pk')
+    self.assertEqual(sum(pages, []), [e.pk for e in expected])
+
+  def test_invalid_cursor_shows_first_page(self):
+    self.create_exchanges(2)
+    url = reverse('game:exchanges')
+    response = self.client.get(url, {'received_cursor': 'nonsense'})
+    page = response.context['received_exchanges']
+    self.assertIsNone(page.cursor)
+    self.assertEqual(len(page), 2)
+
+  def test_for_listing_loads_relations(self):
+    self.create_exchanges(3)
+    exchanges = list(Exchange.objects.for_listing())
+    with self.assertNumQueries(0):
+      for e in exchanges:
+        e.offeror.player.resources.currency
+        e.offeree.player.resources.currency
+        e.offeror_resources.currency
+        e.offeree_resources.agricultural
+        e.offeror_territory.owner.username
+        e.offeror_bond.resources.currency
+        e.offeror_bond.holder.username
+        e.offeror_bond.territory.owner.username
+        self.assertIsNone(e.offeree_bond)
+        e.is_acceptable()
+
+  def test_validation_engine(self):
+    self.create_exchanges(3)
+    exchanges = list(Exchange.objects.all())
+    # The offeree lacks agricultural goods, the rest is fine.
+    with self.assertNumQueries(3):
+      state = validation.GameState.load(exchanges)
+    with self.assertNumQueries(0):
+      self.assertEqual(validation.acceptable(exchanges, state),
+        {e.pk: False for e in exchanges})
+      problems = validation.acceptance_problems(exchanges[0], state)
+    self.assertEqual(len(problems), 1)
+    self.assertIn('lack resources', problems[0].messages[0])
+
+    Resources.objects.filter(player__isnull=False).update(agricultural=1)
+    Territory.objects.filter(name='Efea').update(owner=None)
+    Bond.objects.filter(pk=exchanges[0].offeror_bond_id).update(
+      state=Bond.PAID)
+    state = validation.GameState.load(exchanges)
+    problems = validation.acceptance_problems(exchanges[0], state)
+    self.assertEqual([p.messages[0] for p in problems], [
+      'This Bond is not pending.',
+      'Offeror “brian” does not control “Efea”.'])
+    self.assertTrue(validation.acceptable(exchanges, state)[exchanges[1].pk])
+
+    # The same checks run on loaded objects.
+    exchanges = list(Exchange.objects.for_listing())
+    self.assertEqual(validation.acceptable(exchanges),
+      validation.acceptable(exchanges, validation.GameState.load(exchanges)))
+    exchanges[0].state = Exchange.CANCELED
+    self.assertFalse(exchanges[0].is_acceptable())
+
+  def assertFlagsMatch(self):
+    with self.assertNumQueries(1):
+      exchanges = list(Exchange.objects.with_flags())
+    for e in exchanges:
+      self.assertEqual(e.acceptable, e.is_acceptable(), e)
+      if e.offeree_bond_id is not None:
+        self.assertEqual(e.offeror_can_pay_offeree_bond,
+          e.could_offeror_pay_offeree_bond(), e)
+      if e.offeror_bond_id is not None:
+        self.assertEqual(e.offeree_can_pay_offeror_bond,
+          e.could_offeree_pay_offeror_bond(), e)
+    for b in Bond.objects.with_flags():
+      self.assertEqual(b.payable, b.is_payable(), b)
+    return {e.pk: e.acceptable for e in exchanges}
+
+  def test_flags(self):
+    arthur = User.objects.get(username='arthur')
+    brian = User.objects.get(username='brian')
+    self.create_exchanges(2)
+    Exchange.objects.create(offeror=arthur, offeree=brian,
+      offeree_bond=Bond.objects.filter(borrower=brian).first(),
+      state=Exchange.WAITING, offer_date=timezone.now())
+    Exchange.objects.create(offeror=arthur, offeree=brian,
+      offeror_resources=Resources(currency=1), offeror_as_bond=True,
+      state=Exchange.WAITING, offer_date=timezone.now())
+    self.assertEqual(sum(self.assertFlagsMatch().values()), 2)
+
+    Resources.objects.filter(player__isnull=False).update(agricultural=1)
+    self.assertEqual(sum(self.assertFlagsMatch().values()), 6)
+    Territory.objects.filter(name='Efea').update(owner=arthur)
+    Bond.objects.filter(borrower=arthur).update(state=Bond.PAID)
+    self.assertEqual(sum(self.assertFlagsMatch().values()), 2)
+    Exchange.objects.update(state=Exchange.CANCELED)
+    self.assertEqual(sum(self.assertFlagsMatch().values()), 0)
+
+class BondListingTestCase(TestCase):
+  def setUp(self):
+    create_test_game()
+    arthur = User.objects.get(username='arthur')
+    brian = User.objects.get(username='brian')
+
+    efea = Territory.objects.get(name='Efea')
+    efea.owner = brian
+    efea.save()
+
+    self.client.force_login(arthur)
+
+  def create_bonds(self, count, state=Bond.PENDING):
+    """
+    Creates `count` bonds in `state` in each direction between Arthur and
+    Brian, all of them with resources, a territory and an origin exchange
+    (and a payment exchange when paid).
+    """
+    arthur = User.objects.get(username='arthur')
+    brian = User.objects.get(username='brian')
+    efea = Territory.objects.get(name='Efea')
+    resources = Resources.objects.create(currency=10, agricultural=1)
+    origin = Exchange.objects.create(offeror=brian, offeree=arthur,
+      state=Exchange.ACCEPTED, offer_date=timezone.now(),
+      answer_date=timezone.now())
+    payment = None
+    if state == Bond.PAID:
+      payment = Exchange.objects.create(offeror=arthur, offeree=brian,
+        state=Exchange.ACCEPTED, offer_date=timezone.now(),
+        answer_date=timezone.now())
+    bonds = list()
+    for i in range(count):
+      for holder, borrower in [(arthur, brian), (brian, arthur)]:
+        bonds.append(Bond(holder=holder, borrower=borrower,
+          resources=resources, territory=efea, origin_exchange=origin,
+          state=state, payment_exchange=payment))
+    Bond.objects.bulk_create(bonds)
+
+  def assertPageQueries(self, url, num):
+    counters.cache().clear()
+    with self.assertNumQueries(num):
+      response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+
+  def test_bonds_constant_queries(self):
+    url = reverse('game:bonds')
+    self.create_bonds(10)
+    self.assertPageQueries(url, 8)
+    self.create_bonds(990)
+    self.assertPageQueries(url, 8)
+
+  def test_paid_bonds_constant_queries(self):
+    url = reverse('game:filter_bonds', args=[Bond.PAID])
+    self.create_bonds(1, state=Bond.PAID)
+    self.assertPageQueries(url, 8)
+    self.create_bonds(20, state=Bond.PAID)
+    self.assertPageQueries(url, 8)
+    url = reverse('game:filter_bonds_offer', args=['brian', Bond.PAID])
+    self.assertPageQueries(url, 7)
+
+  def test_bond_by_user_constant_queries(self):
+    url = reverse('game:bond', args=['brian'])
+    self.create_bonds(10)
+    self.assertPageQueries(url, 7)
+    self.create_bonds(990)
+    self.assertPageQueries(url, 7)
+
+  def test_bonds_keyset_pagination(self):
+    arthur = User.objects.get(username='arthur')
+    self.create_bonds(60)
+    pages = list()
+    query = {}
+    while True:
+      response = self.client.get(reverse('game:bonds'), query)
+      page = response.context['as_holder_bonds']
+      pages.append([b.pk for b in page])
+      if not page.has_next():
+        break
+      query = {'holder_cursor': page.next_cursor}
+    self.assertEqual([len(p) for p in pages], [25, 25, 10])
+    expected = Bond.objects.filter(holder=arthur).order_by('-pk')
+    self.assertEqual(sum(pages, []), [b.pk for b in expected])
+
+class QueryPlanTestCase(TestCase):
+  def test_hot_paths_use_composite_indexes(self):
+    if connection.vendor != 'sqlite':
+      self.skipTest('EXPLAIN QUERY PLAN is SQLite specific.')
+    for result in query_plans.run(rows=2000, players=20):
+      self.assertTrue(result['uses_index'],
+        '{}: {}'.format(result['label'], result['plan']))
+      self.assertTrue(result['bounded'],
+        '{}: {}'.format(result['label'], result['plan']))
+
+class BenchmarkSuiteTestCase(TestCase):
+  def test_engine_suite(self):
+    results = engine.run(players=5, territories=5, rows=20, operations=3)
+    self.assertEqual([result['label'] for result in results],
+      ['Exchange.offer', 'Exchange.accept', 'Exchange.objects.accept_many',
+      'Bond.pay', 'Charter.grant', 'Charter.grant_many', 'orderbook.place',
+      'orderbook.place_many'])
+    for result in results:
+      self.assertEqual(result['operations'], 3)
+      self.assertGreater(result['queries'], 0)
+    self.assertEqual(Bond.objects.filter(state=Bond.PAID).exclude(currency=0,
+      manufactured=0, agricultural=0).count(), 3)
+
+  def test_views_suite(self):
+    results = benchmark_views.run(players=5, territories=5, rows=20,
+      operations=2)
+    users = list(User.objects.order_by('pk'))
+    self.assertEqual([result['label'] for result in results],
+      [name for name, args in benchmark_views.pages(users)])
+    for result in results:
+      self.assertEqual(result['status_code'], 200, result['url'])
+
+class HeaderCountersTestCase(TestCase):
+  def setUp(self):
+    counters.cache().clear()
+    create_test_game()
+    arthur = User.objects.get(username='arthur')
+    arthur.player.resources.currency = 1000
+    arthur.player.resources.save()
+
+  def test_warm_header_costs_no_queries(self):
+    arthur = User.objects.get(username='arthur')
+    self.client.force_login(arthur)
+    url = reverse('game:bonds')
+    self.client.get(url)
+    with CaptureQueriesContext(connection) as cold:
+      counters.cache().clear()
+      self.client.get(url)
+    with CaptureQueriesContext(connection) as warm:
+      self.client.get(url)
+    self.assertEqual(len(cold) - len(warm), 3)
+    with self.assertNumQueries(0):
+      self.assertEqual(counters.header(arthur)['currency'], 1000)
+
+  def test_exchange_transitions_invalidate(self):
+    arthur = User.objects.get(username='arthur')
+    brian = User.objects.get(username='brian')
+    self.assertEqual(counters.header(arthur)['currency'], 1000)
+    self.assertEqual(counters.header(brian)['waiting_exchanges'], 0)
+
+    exchange = Exchange(offeror=arthur,
+      offeror_resources=Resources.objects.create(currency=100), offeree=brian)
+    exchange.offer(user=arthur)
+    self.assertEqual(counters.header(brian)['waiting_exchanges'], 1)
+
+    exchange.reject(user=brian)
+    self.assertEqual(counters.header(brian)['waiting_exchanges'], 0)
+
+    exchange = Exchange(offeror=arthur,
+      offeror_resources=Resources.objects.create(currency=100),
+      offeror_as_bond=True, offeree=brian)
+    exchange.offer(user=arthur)
+    self.assertEqual(counters.header(brian)['waiting_exchanges'], 1)
+    exchange.accept(user=brian)
+    self.assertEqual(counters.header(brian)['waiting_exchanges'], 0)
+    self.assertEqual(counters.header(arthur)['pending_bonds'], 1)
+
+    bond = Bond.objects.get(borrower=arthur)
+    bond.pay(user=arthur)
+    self.assertEqual(counters.header(arthur)['pending_bonds'], 0)
+    self.assertEqual(counters.header(arthur)['currency'], 900)
+    self.assertEqual(counters.header(brian)['currency'], 100)
+
+  def test_user_without_player(self):
+    admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+    self.assertEqual(counters.header(admin), {'waiting_exchanges': 0,
+      'pending_bonds': 0, 'currency': 0, 'manufactured': 0,
+      'agricultural': 0})
+    self.client.force_login(admin)
+    for name in ['home', 'exchanges', 'bonds']:
+      self.assertEqual(self.client.get(reverse('game:' + name)).status_code,
+        200)
+
+  def test_bond_forgive_invalidates(self):
+    arthur = User.objects.get(username='arthur')
+    brian = User.objects.get(username='brian')
+    bond = Bond.objects.create(holder=brian, borrower=arthur,
+      resources=Resources.objects.create(currency=10))
+    self.assertEqual(counters.header(arthur)['pending_bonds'], 1)
+    bond.forgive(user=brian)
+    self.assertEqual(counters.header(arthur)['pending_bonds'], 0)
+
+class MapColorsTestCase(TestCase):
+  def setUp(self):
+    counters.cache().clear()
+    create_test_game()
+    arthur = User.objects.get(username='arthur')
+    brian = User.objects.get(username='brian')
+    for name, code, owner in [('Aglax', 'AG', arthur), ('Efea', 'EF', brian)]:
+      territory = Territory.objects.get(name=name)
+      territory.code = code
+      territory.owner = owner
+      territory.save()
+    self.client.force_login(arthur)
+
+  def test_snapshot_built_once(self):
+    arthur = User.objects.get(username='arthur')
+    brian = User.objects.get(username='brian')
+    with self.assertNumQueries(1):
+      colors = map_colors.snapshot()['colors']
+    self.assertEqual(colors, {'AG': map_colors.player_color(arthur.pk),
+      'EF': map_colors.player_color(brian.pk)})
+    with self.assertNumQueries(0):
+      self.assertEqual(map_colors.snapshot()['colors'], colors)
+
+  def test_territory_transfer_rebuilds_snapshot(self):
+    arthur = User.objects.get(username='arthur')
+    brian = User.objects.get(username='brian')
+    before = map_colors.snapshot()
+
+    exchange = Exchange(offeror=arthur,
+      offeror_territory=Territory.objects.get(name='Aglax'), offeree=brian)
+    exchange.offer(user=arthur)
+    self.assertEqual(map_colors.snapshot(), before)
+    exchange.accept(user=brian)
+
+    after = map_colors.snapshot()
+    self.assertNotEqual(after['version'], before['version'])
+    self.assertEqual(after['colors']['AG'], map_colors.player_color(brian.pk))
+
+  def test_home_and_json_endpoint(self):
+    response = self.client.get(reverse('game:home'))
+    self.assertEqual(response.status_code, 200)
+    snapshot = map_colors.snapshot()
+    self.assertEqual(response.context['colors'], snapshot['colors'])
+
+    response = self.client.get(reverse('game:map_colors'))
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.json(), snapshot)
+
+  def test_profile_renders_map(self):
+    response = self.client.get(reverse('game:profile'))
+    self.assertEqual(response.status_code, 200)
+    self.assertContains(response, 'var colorVersion = {};'.format(
+      map_colors.snapshot()['version']))
+
+class ExchangeConcurrencyTestCase(TransactionTestCase):
+  """
+  Several threads offer, accept, reject and cancel exchanges between the
+  same players at the same time.  Resources must be conserved.
+  """
+  PLAYERS = 6
+  THREADS = 6
+  OPERATIONS = 25
+
+  def setUp(self):
+    if connection.vendor == 'sqlite' and \
+      connection.is_in_memory_db(connection.settings_dict['NAME']):
+      self.skipTest('Threads need a file-backed database.')
+    for i in range(self.PLAYERS):
+      user = User.objects.create_user(username='player{}'.format(i))
+      player = Player.create_player(user=user)
+      player.resources.currency = 1000
+      player.resources.agricultural = 50
+      player.resources.save()
+      player.save()
+
+  def totals(self):
+    """Resources held by players plus resources held by waiting offers."""
+    totals = Resources()
+    for player in Player.objects.select_related('resources'):
+      totals.add(player.resources)
+    waiting = Exchange.objects.filter(state=Exchange.WAITING,
+      offeror_as_bond=False)
+    for exchange in waiting:
+      totals.add(exchange.offeror_resources)
+    return totals.as_list()
+
+  def retry(self, operation):
+    """Runs `operation` again while SQLite reports a locked database."""
+    for attempt in range(50):
+      try:
+        return operation()
+      except OperationalError:
+        time.sleep(random.random() * 0.01)
+      except ValidationError:
+        return None
+
+  def offer(self, rng):
+    offeror, offeree = rng.sample(list(User.objects.all()), 2)
+    exchange = Exchange(offeror=offeror,
+      offeror_resources=Resources.objects.create(
+        currency=rng.randint(1, 400)),
+      offeree=offeree,
+      offeree_resources=Resources.objects.create(
+        agricultural=rng.randint(0, 20)))
+    exchange.offer(user=offeror)
+
+  def answer(self, rng):
+    waiting = list(Exchange.objects.filter(state=Exchange.WAITING))
+    if not waiting:
+      return
+    exchange = rng.choice(waiting)
+    action = rng.choice(['accept', 'accept', 'reject', 'cancel'])
+    if action == 'cancel':
+      exchange.cancel(user=exchange.offeror)
+    else:
+      getattr(exchange, action)(user=exchange.offeree)
+
+  def work(self, seed):
+    rng = random.Random(seed)
+    try:
+      for i in range(self.OPERATIONS):
+        operation = rng.choice([self.offer, self.answer, self.answer])
+        self.retry(lambda: operation(rng))
+    finally:
+      connection.close()
+
+  def test_resources_are_conserved(self):
+    initial = self.totals()
+    threads = [threading.Thread(target=self.work, args=(seed,))
+      for seed in range(self.THREADS)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(self.totals(), initial)
+    self.assertTrue(Exchange.objects.exclude(state=Exchange.WAITING).exists())
+    for player in Player.objects.select_related('resources'):
+      self.assertTrue(player.resources.is_zero_or_positive())
+
+  def test_public_offer_first_accept_wins(self):
+    offeror = User.objects.get(username='player0')
+    exchange = Exchange(offeror=offeror,
+      offeror_resources=Resources.objects.create(currency=100),
+      offeree_resources=Resources.objects.create(agricultural=10))
+    exchange.offer(user=offeror)
+    initial = self.totals()
+    winners = list()
+    def claim(user):
+      try:
+        # Every thread accepts its own copy of the waiting offer.
+        offer = Exchange.objects.get(pk=exchange.pk)
+        if self.retry(lambda: offer.claim(user=user)):
+          winners.append(user.username)
+      finally:
+        connection.close()
+    threads = [threading.Thread(target=claim, args=(user,))
+      for user in User.objects.exclude(pk=offeror.pk)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    exchange = Exchange.objects.get(pk=exchange.pk)
+    self.assertEqual(len(winners), 1)
+    self.assertEqual(exchange.state, Exchange.ACCEPTED)
+    self.assertEqual(exchange.offeree.username, winners[0])
+    self.assertEqual(self.totals(), initial)
+
+class OrderBookConcurrencyTestCase(TransactionTestCase):
+  """
+  Several threads place crossing orders on the same good at the same time.
+  Resources must be conserved and no crossing orders may be left waiting.
+  """
+  PLAYERS = 6
+  THREADS = 6
+  OPERATIONS = 15
+
+  def setUp(self):
+    if connection.vendor == 'sqlite' and \
+      connection.is_in_memory_db(connection.settings_dict['NAME']):
+      self.skipTest('Threads need a file-backed database.')
+    for i in range(self.PLAYERS):
+      user = User.objects.create_user(username='trader{}'.format(i))
+      player = Player.create_player(user=user)
+      player.resources.currency = 1000
+      player.resources.agricultural = 50
+      player.resources.save()
+      player.save()
+
+  def totals(self):
+    totals = Resources()
+    for player in Player.objects.select_related('resources'):
+      totals.add(player.resources)
+    return totals.as_list()
+
+  def work(self, seed):
+    rng = random.Random(seed)
+    users = list(User.objects.all())
+    try:
+      for i in range(self.OPERATIONS):
+        order = Order(user=rng.choice(users),
+          side=rng.choice([Order.BUY, Order.SELL]), good='agricultural',
+          price=rng.randint(8, 12), quantity=rng.randint(1, 5))
+        for attempt in range(50):
+          try:
+            orderbook.place_many([order])
+            break
+          except OperationalError:
+            time.sleep(random.random() * 0.01)
+    finally:
+      connection.close()
+
+  def test_book_is_never_left_crossed(self):
+    initial = self.totals()
+    threads = [threading.Thread(target=self.work, args=(seed,))
+      for seed in range(self.THREADS)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(self.totals(), initial)
+    self.assertTrue(Exchange.objects.filter(state=Exchange.ACCEPTED).exists())
+    bids, asks = orderbook.depth('agricultural', levels=1)
+    if bids and asks:
+      self.assertLess(bids[0][0], asks[0][0])
+    self.assertEqual(list(OrderBook.objects.values_list('good', flat=True)),
+      ['agricultural'])
+
+class AcceptManyTestCase(TestCase):
+  def setUp(self):
+    create_test_game()
+    for name, currency, agricultural in [('arthur', 1000, 0),
+                                         ('brian', 0, 100),
+                                         ('gumby', 500, 0)]:
+      resources = User.objects.get(username=name).player.resources
+      resources.currency = currency
+      resources.agricultural = agricultural
+      resources.save()
+    aglax = Territory.objects.get(name='Aglax')
+    aglax.owner = User.objects.get(username='brian')
+    aglax.save()
+
+  def offer(self, offeror, offeree, currency=0, agricultural=0, **kwargs):
+    offeror = User.objects.get(username=offeror)
+    offeree = User.objects.get(username=offeree)
+    exchange = Exchange(offeror=offeror,
+      offeror_resources=Resources.objects.create(currency=currency),
+      offeree=offeree,
+      offeree_resources=Resources.objects.create(agricultural=agricultural),
+      **kwargs)
+    exchange.offer(user=offeror)
+    return exchange
+
+  def resources(self, name):
+    return User.objects.get(username=name).player.resources.as_list()
+
+  def test_accept_many(self):
+    brian = User.objects.get(username='brian')
+    aglax = Territory.objects.get(name='Aglax')
+    exchanges = [
+      self.offer('arthur', 'brian', currency=100, agricultural=10),
+      self.offer('gumby', 'brian', currency=50, agricultural=60),
+      # Brian runs out of agricultural goods
+      self.offer('arthur', 'brian', currency=10, agricultural=40),
+      # Brian sells Aglax twice
+      self.offer('gumby', 'brian', currency=200, offeree_territory=aglax),
+      self.offer('arthur', 'brian', currency=300, offeree_territory=aglax),
+      # Brian borrows
+      self.offer('gumby', 'brian', currency=5, agricultural=1,
+        offeree_as_bond=True, offeree_as_bond_maturity=3),
+      # Not addressed to Brian
+      self.offer('arthur', 'gumby', currency=1),
+    ]
+    accepted, failures = Exchange.objects.accept_many(exchanges, brian)
+
+    self.assertEqual(sorted(e.pk for e in accepted),
+      [exchanges[i].pk for i in [0, 1, 3, 5]])
+    self.assertEqual(sorted(failures), [exchanges[i].pk for i in [2, 4, 6]])
+    self.assertEqual(failures[exchanges[2].pk].message % \
+      failures[exchanges[2].pk].params,
+      "Offeree “brian” lack resources to accept this exchange.")
+    self.assertEqual(failures[exchanges[4].pk].message % \
+      failures[exchanges[4].pk].params,
+      "Offeree “brian” does not control “Aglax”.")
+
+    states = dict(Exchange.objects.values_list('pk', 'state'))
+    self.assertEqual([states[e.pk] for e in exchanges], ['A', 'A', 'W', 'A',
+      'W', 'A', 'W'])
+    self.assertEqual(self.resources('brian'), [100 + 50 + 200 + 5, 0, 30])
+    self.assertEqual(self.resources('arthur'), [1000 - 100 - 10 - 300 - 1,
+      0, 10])
+    self.assertEqual(self.resources('gumby'), [500 - 50 - 200 - 5, 0, 60])
+    self.assertEqual(Territory.objects.get(name='Aglax').owner.username,
+      'gumby')
+    bond = Bond.objects.get(borrower=brian)
+    self.assertEqual(bond.holder.username, 'gumby')
+    self.assertEqual(bond.origin_exchange.pk, exchanges[5].pk)
+    self.assertEqual(bond.maturity, 3)
+    self.assertEqual(bond.resources.agricultural, 1)
+    self.assertFalse(User.objects.get(username='brian').player \
+      .is_head_of_state())
+    self.assertTrue(User.objects.get(username='gumby').player \
+      .is_head_of_state())
+
+  def test_accept_many_matches_accept(self):
+    brian = User.objects.get(username='brian')
+    one = [self.offer('arthur', 'brian', currency=10, agricultural=2)
+      for i in range(3)]
+    for exchange in one:
+      exchange.accept(user=brian)
+    single = [self.resources(n) for n in ['arthur', 'brian']]
+
+    many = [self.offer('brian', 'arthur', agricultural=2, currency=10)
+      for i in range(3)]
+    # Undo the previous trades by mirroring them through accept_many.
+    arthur = User.objects.get(username='arthur')
+    accepted, failures = Exchange.objects.accept_many(many, arthur)
+    self.assertEqual(failures, {})
+    self.assertEqual(single, [[970, 0, 6], [30, 0, 94]])
+    self.assertEqual(self.resources('arthur'), [1000, 0, 0])
+    self.assertEqual(self.resources('brian'), [0, 0, 100])
+
+  def test_accept_many_constant_queries(self):
+    brian = User.objects.get(username='brian')
+    # Both measured batches update the market stats rows this one creates.
+    Exchange.objects.accept_many([self.offer('arthur', 'brian', currency=1,
+      agricultural=1)], brian)
+    few = [self.offer('arthur', 'brian', currency=1, agricultural=1)
+      for i in range(2)]
+    with CaptureQueriesContext(connection) as queries:
+      Exchange.objects.accept_many(few, brian)
+    many = [self.offer('arthur', 'brian', currency=1, agricultural=1)
+      for i in range(30)]
+    with self.assertNumQueries(len(queries)):
+      accepted, failures = Exchange.objects.accept_many(many, brian)
+    self.assertEqual(len(accepted), 30)
+
+  def test_accept_many_refuses_public_offers(self):
+    brian = User.objects.get(username='brian')
+    arthur = User.objects.get(username='arthur')
+    public = Exchange(offeror=arthur,
+      offeror_resources=Resources.objects.create(currency=10))
+    public.offer(user=arthur)
+    private = self.offer('arthur', 'brian', currency=10)
+    accepted, failures = Exchange.objects.accept_many([public, private],
+      brian)
+    self.assertEqual([e.pk for e in accepted], [private.pk])
+    self.assertEqual(list(failures), [public.pk])
+    self.assertIsNone(Exchange.objects.get(pk=public.pk).offeree)
+
+class TurnTestCase(TestCase):
+  def setUp(self):
+    create_test_game()
+    self.turn = Config.current_turn()
+    self.arthur = User.objects.get(username='arthur')
+    self.brian = User.objects.get(username='brian')
+    self.gumby = User.objects.get(username='gumby')
+    Resources.objects.filter(player__isnull=False).update(currency=100)
+
+  def lend(self, borrower, holder, maturity):
+    """`borrower` owes 1 currency to `holder` in `maturity` turns."""
+    exchange = Exchange(offeror=borrower, offeree=holder,
+      offeror_resources=Resources.objects.create(currency=1),
+      offeror_as_bond=True, offeror_as_bond_maturity=maturity)
+    exchange.offer(user=borrower)
+    exchange.accept(user=holder)
+    return Bond.objects.get(origin_exchange=exchange)
+
+  def delinquency(self, user):
+    return Player.objects.get(user=user).delinquency
+
+  def test_bonds_are_scheduled(self):
+    self.assertEqual(self.lend(self.brian, self.arthur, 3).due_turn,
+      self.turn + 3)
+    # Perpetual bonds are never due
+    self.assertIsNone(self.lend(self.brian, self.arthur, 0).due_turn)
+
+  def test_process_turn(self):
+    due = [self.lend(self.brian, self.arthur, 1) for i in range(3)]
+    due.append(self.lend(self.gumby, self.arthur, 2))
+    later = self.lend(self.gumby, self.arthur, 5)
+    perpetual = self.lend(self.gumby, self.arthur, 0)
+    paid = self.lend(self.brian, self.arthur, 1)
+    paid.pay(user=self.brian)
+
+    # Nothing is due yet
+    self.assertEqual(turns.process_turn(self.turn).delinquent_bonds, 0)
+
+    log = turns.process_turn(self.turn + 2, chunk_size=2)
+    self.assertEqual((log.number, log.delinquent_bonds,
+      log.delinquent_players), (self.turn + 2, 4, 2))
+    self.assertEqual(sorted(Bond.objects.filter(delinquent=True)
+      .values_list('pk', flat=True)), [bond.pk for bond in due])
+    for bond in [later, perpetual, paid]:
+      self.assertFalse(Bond.objects.get(pk=bond.pk).delinquent)
+    self.assertEqual(self.delinquency(self.brian), 3)
+    self.assertEqual(self.delinquency(self.gumby), 1)
+    self.assertEqual(self.delinquency(self.arthur), 0)
+
+    # A turn is only processed once
+    self.assertEqual(turns.process_turn(self.turn + 2).pk, log.pk)
+    self.assertEqual(self.delinquency(self.brian), 3)
+
+    # Delinquent bonds can still be paid, and are not counted again
+    Bond.objects.get(pk=due[0].pk).pay(user=self.brian)
+    self.assertEqual(turns.process_turn(self.turn + 10).delinquent_bonds, 1)
+    self.assertEqual(self.delinquency(self.gumby), 2)
+    self.assertEqual(Turn.objects.count(), 3)
+
+  def test_accept_many_schedules_bonds(self):
+    exchange = Exchange(offeror=self.arthur, offeree=self.brian,
+      offeror_resources=Resources.objects.create(currency=1),
+      offeree_resources=Resources.objects.create(currency=1),
+      offeree_as_bond=True, offeree_as_bond_maturity=4)
+    exchange.offer(user=self.arthur)
+    Exchange.objects.accept_many([exchange], self.brian)
+    self.assertEqual(Bond.objects.get(borrower=self.brian).due_turn,
+      self.turn + 4)
+
+class ResourceLedgerTestCase(TestCase):
+  def setUp(self):
+    create_test_game()
+    self.arthur = User.objects.get(username='arthur')
+    self.brian = User.objects.get(username='brian')
+    self.gumby = User.objects.get(username='gumby')
+    for user in [self.arthur, self.brian, self.gumby]:
+      Resources.objects.filter(player__user=user).update(currency=100,
+        agricultural=10)
+    # Balances seeded outside of exchanges are the opening snapshot
+    ledger.take_snapshot()
+
+  def trade(self, offeror, offeree, currency, agricultural, accept=True):
+    exchange = Exchange(offeror=offeror,
+      offeror_resources=Resources.objects.create(currency=currency),
+      offeree=offeree,
+      offeree_resources=Resources.objects.create(agricultural=agricultural))
+    exchange.offer(user=offeror)
+    if accept:
+      exchange.accept(user=offeree)
+    return exchange
+
+  def entries(self, user):
+    return list(ResourceLedger.objects.filter(
+      resources=user.player.resources).order_by('pk').values_list(
+      'exchange', 'currency', 'agricultural'))
+
+  def test_exchanges_are_recorded(self):
+    accepted = self.trade(self.arthur, self.brian, 30, 2)
+    canceled = self.trade(self.arthur, self.brian, 5, 0, accept=False)
+    canceled.cancel(user=self.arthur)
+    self.assertEqual(self.entries(self.arthur), [(accepted.pk, -30, 0),
+      (accepted.pk, 0, 2), (canceled.pk, -5, 0), (canceled.pk, 5, 0)])
+    self.assertEqual(self.entries(self.brian), [(accepted.pk, 30, 0),
+      (accepted.pk, 0, -2)])
+    self.assertEqual(list(ledger.verify()), [])
+
+  def test_accept_many_is_recorded(self):
+    exchanges = [self.trade(self.arthur, self.brian, 10, 1, accept=False),
+      self.trade(self.gumby, self.brian, 20, 3, accept=False)]
+    Exchange.objects.accept_many(exchanges, self.brian)
+    self.assertEqual(self.entries(self.brian), [(exchanges[0].pk, 10, 0),
+      (exchanges[0].pk, 0, -1), (exchanges[1].pk, 20, 0),
+      (exchanges[1].pk, 0, -3)])
+    self.assertEqual(list(ledger.verify()), [])
+
+  def test_balance_at(self):
+    resources = self.arthur.player.resources
+    self.trade(self.arthur, self.brian, 30, 2)
+    middle = timezone.now()
+    ledger.take_snapshot()
+    self.trade(self.arthur, self.gumby, 10, 1)
+    self.assertEqual(ledger.balance_at(resources, middle).as_list(),
+      [70, 0, 12])
+    self.assertEqual(ledger.balance_at(resources, timezone.now()).as_list(),
+      [60, 0, 13])
+    # Before the opening snapshot only the ledger is known
+    self.assertEqual(ledger.balance_at(resources,
+      ResourceSnapshot.objects.earliest('date').date -
+      datetime.timedelta(seconds=1)).as_list(), [0, 0, 0])
+
+  def test_verify_reports_drift(self):
+    self.trade(self.arthur, self.brian, 30, 2)
+    Resources.objects.filter(player__user=self.brian).update(currency=1)
+    brian = self.brian.player.resources.pk
+    drift = [(brian, [130, 0, 8], [1, 0, 8])]
+    self.assertEqual(list(ledger.verify(chunk_size=2)), drift)
+    # Snapshots follow the ledger, so the next one does not hide the drift
+    ledger.take_snapshot(chunk_size=2)
+    self.assertEqual(list(ledger.verify()), drift)
+    self.assertEqual(ResourceSnapshot.objects.filter(resources=brian)
+      .latest('pk').currency, 130)
+    self.trade(self.arthur, self.gumby, 10, 1)
+    ledger.take_snapshot()
+    self.assertEqual(list(ledger.verify()), drift)
+
+class ResourcesCompactionTestCase(TestCase):
+  def setUp(self):
+    create_test_game()
+    self.arthur = User.objects.get(username='arthur')
+    self.brian = User.objects.get(username='brian')
+    Resources.objects.filter(player__user=self.arthur).update(currency=100)
+
+  def offer_with_form(self, **data):
+    fields = dict()
+    for side in ['offeror', 'offeree']:
+      for name in Resources._list:
+        fields['{}_{}'.format(side, name)] = 0
+    fields.update(data)
+    form = ExchangeForm(self.arthur, self.brian, fields)
+    self.assertTrue(form.is_valid(), form.errors)
+    form.build_and_offer(self.arthur, self.brian, id_offeror_territory='',
+      id_offeree_territory='')
+
+  def test_offers_allocate_no_rows(self):
+    before = Resources.objects.count()
+    self.offer_with_form(offeror_currency=10)
+    exchange = Exchange.objects.get()
+    self.assertEqual(exchange.offeror_resources.currency, 10)
+    self.assertTrue(exchange.offeree_resources.is_empty())
+    self.assertEqual(Resources.objects.count(), before)
+
+    # A failed offer leaves nothing behind
+    with self.assertRaises(ValidationError):
+      self.offer_with_form(offeror_currency=1000)
+    self.assertEqual(Exchange.objects.count(), 1)
+    self.assertEqual(Resources.objects.count(), before)
+
+  def test_compact(self):
+    players = Resources.objects.count()
+    # Rows left behind by exchanges before resources were embedded
+    orphans = [Resources.objects.create(currency=i) for i in range(5)]
+    exchange = Exchange(offeror=self.arthur, offeror_resources=orphans[1],
+      offeree=self.brian, offeree_resources=orphans[0])
+    exchange.offer(user=self.arthur)
+    exchange.cancel(user=self.arthur)
+
+    self.assertEqual(Resources.unreferenced().count(), len(orphans))
+    self.assertEqual(Resources.compact(batch_size=2), len(orphans))
+    exchange = Exchange.objects.get(pk=exchange.pk)
+    self.assertTrue(exchange.offeree_resources.is_empty())
+    self.assertEqual(exchange.offeror_resources.currency, 1)
+    # Players' resources are kept, even if they are all zero
+    self.assertEqual(Resources.objects.count(), players)
+    self.assertEqual(Resources.compact(), 0)
+
+class MarketStatsTestCase(TestCase):
+  def setUp(self):
+    create_test_game()
+    self.turn = Config.current_turn()
+    self.arthur = User.objects.get(username='arthur')
+    self.brian = User.objects.get(username='brian')
+    self.gumby = User.objects.get(username='gumby')
+    Resources.objects.filter(player__isnull=False).update(currency=100,
+      agricultural=100)
+
+  def trade(self, offeror, offeree, currency, agricultural, turn=None):
+    """`offeror` buys `agricultural` goods for `currency`."""
+    exchange = Exchange(offeror=offeror, offeree=offeree,
+      offeror_resources=Resources(currency=currency),
+      offeree_resources=Resources(agricultural=agricultural))
+    exchange.offer(user=offeror)
+    exchange.accept(user=offeree)
+    if turn is not None:
+      # Move the exchange to another turn, as if accepted then.
+      exchange.answer_date = Config.start_date + \
+        datetime.timedelta(days=turn, hours=1)
+      exchange.save()
+    return exchange
+
+  def test_accept_records_stats(self):
+    self.trade(self.arthur, self.brian, 10, 2)
+    self.trade(self.arthur, self.gumby, 6, 3)
+    activity = stats.activity(self.arthur, 1)
+    self.assertEqual(activity['exchanges'], 2)
+    self.assertEqual(activity['given'], (16, 0, 0))
+    self.assertEqual(activity['received'], (0, 0, 5))
+    self.assertAlmostEqual(activity['ratios']['currency_per_agricultural'],
+      16 / 5)
+    self.assertIsNone(activity['ratios']['currency_per_manufactured'])
+    self.assertEqual(stats.activity(self.brian, 1)['received'], (10, 0, 0))
+
+    partners = stats.top_partners(self.arthur)
+    self.assertEqual([p.partner for p in partners], [self.brian, self.gumby])
+    self.assertEqual(partners[0].given(), (10, 0, 0))
+    self.assertEqual(partners[0].last_turn, self.turn)
+
+    # Bonds count when paid, with accept_many too
+    exchange = Exchange(offeror=self.brian, offeree=self.arthur,
+      offeror_resources=Resources(currency=4), offeror_as_bond=True)
+    exchange.offer(user=self.brian)
+    Exchange.objects.accept_many([exchange], self.arthur)
+    self.assertEqual(stats.activity(self.brian, 1)['given'], (0, 0, 2))
+    Bond.objects.get(borrower=self.brian).pay(user=self.brian)
+    self.assertEqual(stats.activity(self.brian, 1)['given'], (4, 0, 2))
+    self.assertEqual(stats.top_partners(self.arthur)[0].exchanges, 3)
+
+  def test_activity_over_turns(self):
+    # Recorded out of order: later turns must include earlier ones.
+    for turn in [5, 2, 9, 5]:
+      self.trade(self.arthur, self.brian, turn, 1, turn=turn)
+    stats.rebuild(chunk_size=3)
+    self.assertEqual(PlayerTurnStats.objects.filter(
+      user=self.arthur).count(), 3)
+
+    with self.assertNumQueries(2):
+      activity = stats.activity(self.arthur, 5, turn=9)
+    self.assertEqual((activity['exchanges'], activity['given']),
+      (3, (19, 0, 0)))
+    self.assertEqual(stats.activity(self.arthur, 100, turn=9)['exchanges'], 4)
+    self.assertEqual(stats.activity(self.arthur, 3, turn=4)['exchanges'], 1)
+    self.assertEqual(stats.activity(self.arthur, 1, turn=20)['exchanges'], 0)
+
+    history = stats.history(self.arthur, 5, turn=6)
+    self.assertEqual([turn for turn, _a in history], [2, 3, 4, 5, 6])
+    self.assertEqual([a['exchanges'] for _t, a in history], [1, 0, 0, 2, 0])
+    self.assertEqual(history[3][1]['volume'], (10, 0, 2))
+
+  def test_rebuild_matches_live_stats(self):
+    self.trade(self.arthur, self.brian, 10, 2)
+    self.trade(self.gumby, self.arthur, 1, 1)
+    self.trade(self.brian, self.arthur, 3, 3)
+    def rows():
+      return sorted((s.user_id, s.turn) + s.as_tuple()
+        for s in PlayerTurnStats.objects.all()), sorted(
+        (s.user_id, s.partner_id, s.last_turn) + s.as_tuple()
+        for s in PairStats.objects.all())
+    live = rows()
+    self.assertEqual(stats.rebuild(), 3)
+    self.assertEqual(rows(), live)
+
+  def test_market_view(self):
+    self.trade(self.arthur, self.brian, 10, 2)
+    self.client.force_login(self.arthur)
+    response = self.client.get(reverse('game:market'), {'turns': 'x'})
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.context['turns'], 10)
+    self.assertContains(response, 'brian')
+
+class ApiTestCase(TestCase):
+  def setUp(self):
+    counters.cache().clear()
+    create_test_game()
+    self.arthur = User.objects.get(username='arthur')
+    self.brian = User.objects.get(username='brian')
+    Resources.objects.filter(player__isnull=False).update(currency=100)
+
+  def post(self, url, data=None):
+    return self.client.post(url, json.dumps(data or {}),
+      content_type='application/json')
+
+  def offer(self, currency=10):
+    self.client.force_login(self.arthur)
+    response = self.post(reverse('game:api_exchanges'), {
+      'offeree': 'brian',
+      'offeror_resources': {'currency': currency},
+      'offeror_as_bond': True,
+    })
+    self.assertEqual(response.status_code, 201)
+    return response.json()
+
+  def test_requires_login(self):
+    response = self.client.get(reverse('game:api_exchanges'))
+    self.assertEqual(response.status_code, 401)
+    response = self.post(reverse('game:api_update_bond', args=[1, 'pay']))
+    self.assertEqual(response.status_code, 401)
+
+  def test_offer_and_answer(self):
+    data = self.offer()
+    self.assertEqual(data['state'], Exchange.WAITING)
+    self.assertEqual(data['offeror_resources']['currency'], 10)
+
+    self.client.force_login(self.brian)
+    listing = self.client.get(reverse('game:api_exchanges'),
+      {'role': 'offeree'}).json()
+    self.assertEqual([e['id'] for e in listing['results']], [data['id']])
+    self.assertIsNone(listing['next'])
+    response = self.post(reverse('game:api_update_exchange',
+      args=[data['id'], 'accept']))
+    self.assertEqual(response.json()['state'], Exchange.ACCEPTED)
+
+    bonds = self.client.get(reverse('game:api_bonds'),
+      {'role': 'holder'}).json()['results']
+    self.assertEqual(len(bonds), 1)
+    self.assertEqual(bonds[0]['borrower'], 'arthur')
+    self.client.force_login(self.arthur)
+    response = self.post(reverse('game:api_update_bond',
+      args=[bonds[0]['id'], 'pay']))
+    self.assertEqual(response.json()['state'], Bond.PAID)
+    self.assertEqual(Resources.objects.get(player__user=self.brian).currency,
+      110)
+
+    data = self.offer()
+    response = self.post(reverse('game:api_update_exchange',
+      args=[data['id'], 'cancel']))
+    self.assertEqual(response.json()['state'], Exchange.CANCELED)
+
+  def test_refusals(self):
+    data = self.offer(currency=1000)
+    # Arthur cannot accept his own offer
+    response = self.post(reverse('game:api_update_exchange',
+      args=[data['id'], 'accept']))
+    self.assertEqual(response.status_code, 400)
+    self.assertIn('error', response.json())
+    response = self.post(reverse('game:api_exchanges'), {'offeree': 'nobody'})
+    self.assertEqual(response.status_code, 400)
+    response = self.client.post(reverse('game:api_exchanges'), 'nope',
+      content_type='application/json')
+    self.assertEqual(response.status_code, 400)
+
+    # Other players' exchanges do not exist for Gumby
+    self.client.force_login(User.objects.get(username='gumby'))
+    response = self.client.get(reverse('game:api_exchange',
+      args=[data['id']]))
+    self.assertEqual(response.status_code, 404)
+    response = self.post(reverse('game:api_update_exchange',
+      args=[data['id'], 'reject']))
+    self.assertEqual(response.status_code, 404)
+
+  def test_conditional_get(self):
+    data = self.offer()
+    self.client.force_login(self.brian)
+    url = reverse('game:api_exchanges')
+    response = self.client.get(url)
+    etag = response['ETag']
+    # HTTP dates cannot tell changes within the same second apart
+    self.assertFalse(response.has_header('Last-Modified'))
+
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 304)
+    self.assertFalse([sql for sql in statements(queries)
+      if 'game_exchange' in sql or 'game_bond' in sql])
+
+    # Changes of other players leave Brian's version alone
+    gumby = User.objects.get(username='gumby')
+    Exchange(offeror=self.arthur, offeree=gumby,
+      offeror_resources=Resources(currency=1)).offer(user=self.arthur)
+    self.assertEqual(self.client.get(url,
+      HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    self.post(reverse('game:api_update_exchange', args=[data['id'], 'reject']))
+    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.json()['results'], [])
+    self.assertNotEqual(response['ETag'], etag)
+
+  def test_public_offers(self):
+    self.client.force_login(self.arthur)
+    response = self.post(reverse('game:api_exchanges'), {
+      'public': True,
+      'offeror_resources': {'currency': 10},
+      'offeree_resources': {'currency': 1},
+    })
+    self.assertEqual(response.status_code, 201)
+    data = response.json()
+    self.assertIsNone(data['offeree'])
+
+    self.client.force_login(self.brian)
+    url = reverse('game:api_offers')
+    response = self.client.get(url)
+    self.assertEqual([e['id'] for e in response.json()['results']],
+      [data['id']])
+    etag = response['ETag']
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 304)
+    self.assertFalse([sql for sql in statements(queries)
+      if 'game_exchange' in sql])
+
+    claim = reverse('game:api_claim_offer', args=[data['id']])
+    response = self.post(claim)
+    self.assertEqual(response.json()['offeree'], 'brian')
+    self.assertEqual(response.json()['state'], Exchange.ACCEPTED)
+    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.json()['results'], [])
+
+    self.client.force_login(User.objects.get(username='gumby'))
+    self.assertEqual(self.post(claim).status_code, 404)
+
+  def test_bond_transfer_changes_holder_version(self):
+    gumby = User.objects.get(username='gumby')
+    bond = Bond.objects.create(holder=gumby, borrower=self.arthur,
+      resources=Resources(currency=5))
+    exchange = Exchange(offeror=self.arthur, offeree=self.brian,
+      offeror_bond=bond)
+    exchange.offer(user=self.arthur)
+    before = versions.get(gumby.pk)
+    exchange.accept(user=self.brian)
+    self.assertEqual(Bond.objects.get(pk=bond.pk).borrower, self.brian)
+    self.assertNotEqual(versions.get(gumby.pk), before)
+
+class LocalBrokerTestCase(TestCase):
+  def test_publish_and_wait(self):
+    broker = events.LocalBroker(backlog=2)
+    self.assertEqual(broker.wait(1, 0, 0), [])
+    broker.publish([([1, 2], {'type': 'exchange'}), ([2], {'type': 'bond'})])
+    self.assertEqual(broker.last(), 2)
+    self.assertEqual([e['id'] for e in broker.wait(1, 0, 0)], [1])
+    self.assertEqual([e['type'] for e in broker.wait(2, 1, 0)], ['bond'])
+    broker.publish([([2], {'type': 'bond'})])
+    # Only the last two events of each player are kept
+    self.assertEqual([e['id'] for e in broker.wait(2, 0, 0)], [2, 3])
+    # Ids the broker never issued wait for the next event
+    self.assertEqual(broker.wait(1, 50, 0), [])
+
+  def test_wait_wakes_up(self):
+    broker = events.LocalBroker()
+    found = []
+    waiter = threading.Thread(target=lambda: found.extend(
+      broker.wait(1, 0, 10)))
+    waiter.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    broker.publish([([1], {'type': 'exchange'})])
+    waiter.join()
+    self.assertLess(time.monotonic() - start, 5)
+    self.assertEqual(len(found), 1)
+
+class EventsTestCase(TransactionTestCase):
+  def setUp(self):
+    events._broker = events.LocalBroker()
+    create_test_game()
+    self.arthur = User.objects.get(username='arthur')
+    self.brian = User.objects.get(username='brian')
+    Resources.objects.filter(player__isnull=False).update(currency=100)
+
+  def tearDown(self):
+    events._broker = None
+
+  def received(self, user, after=0):
+    return [(e['type'], e['state'])
+      for e in events.broker().wait(user.pk, after, 0)]
+
+  def test_transitions_publish_on_commit(self):
+    exchange = Exchange(offeror=self.arthur, offeree=self.brian,
+      offeror_resources=Resources(currency=10), offeror_as_bond=True)
+    with transaction.atomic():
+      exchange.offer(user=self.arthur)
+      self.assertEqual(events.broker().last(), 0)
+    self.assertEqual(self.received(self.brian), [('exchange', Exchange.WAITING)])
+    exchange.accept(user=self.brian)
+    bond = Bond.objects.get(origin_exchange=exchange)
+    bond.pay(user=self.arthur)
+    self.assertEqual(self.received(self.arthur, after=1), [
+      ('exchange', Exchange.ACCEPTED),
+      # The payment exchange
+      ('exchange', Exchange.WAITING),
+      ('exchange', Exchange.ACCEPTED),
+      ('bond', Bond.PAID),
+    ])
+    self.assertEqual(self.received(User.objects.get(username='gumby')), [])
+
+    # Nothing is published when the transition fails
+    last = events.broker().last()
+    with self.assertRaises(ValidationError):
+      bond.forgive(user=self.brian)
+    self.assertEqual(events.broker().last(), last)
+
+  @override_settings(GAME_EVENT_TIMEOUT=0)
+  def test_poll_events(self):
+    url = reverse('game:api_events')
+    self.assertEqual(self.client.get(url).status_code, 401)
+    self.client.force_login(self.brian)
+    self.assertEqual(self.client.get(url).json(), {'events': [], 'last': 0})
+    exchange = Exchange(offeror=self.arthur, offeree=self.brian,
+      offeror_resources=Resources(currency=10))
+    exchange.offer(user=self.arthur)
+    data = self.client.get(url, {'after': 0}).json()
+    self.assertEqual(data['events'], [{'id': 1, 'type': 'exchange',
+      'object': exchange.pk, 'state': Exchange.WAITING}])
+    self.assertEqual(data['last'], 1)
+    self.assertEqual(self.client.get(url, {'after': 1}).json(),
+      {'events': [], 'last': 1})
+
+class AsgiTestCase(TransactionTestCase):
+  def setUp(self):
+    events._broker = events.LocalBroker()
+    create_test_game()
+    self.arthur = User.objects.get(username='arthur')
+    self.application = GameApplication(WSGIHandler(), threads=2)
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+
+  def tearDown(self):
+    self.application.executor.shutdown()
+    self.loop.close()
+    asyncio.set_event_loop(None)
+    events._broker = None
+
+  def request(self, path, query=b'', cookie=None):
+    """(status, headers, body) of a GET to the ASGI application."""
+    headers = [(b'host', b'testserver')]
+    if cookie:
+      headers.append((b'cookie', cookie.encode('latin-1')))
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET',
+      'scheme': 'http', 'path': path, 'query_string': query,
+      'root_path': '', 'headers': headers, 'server': ('testserver', 80)}
+    sent = list()
+    async def receive():
+      return {'type': 'http.request', 'body': b''}
+    async def send(message):
+      sent.append(message)
+    self.loop.run_until_complete(self.application(scope, receive, send))
+    return sent[0]['status'], dict(sent[0]['headers']), sent[1]['body']
+
+  def login(self):
+    self.client.force_login(self.arthur)
+    return '{}={}'.format(settings.SESSION_COOKIE_NAME,
+      self.client.cookies[settings.SESSION_COOKIE_NAME].value)
+
+  def test_pages_go_through_wsgi(self):
+    status, headers, _body = self.request(reverse('game:home'))
+    self.assertEqual(status, 302)
+    status, headers, body = self.request(reverse('game:home'),
+      cookie=self.login())
+    self.assertEqual(status, 200)
+    self.assertIn(b'arthur', body)
+
+  @override_settings(GAME_EVENT_TIMEOUT=10)
+  def test_events_wait_on_the_loop(self):
+    url = reverse('game:api_events')
+    status, _headers, body = self.request(url)
+    self.assertEqual(status, 401)
+
+    cookie = self.login()
+    def offer():
+      time.sleep(0.1)
+      events.broker().publish([([self.arthur.pk], {'type': 'exchange',
+        'object': 1, 'state': Exchange.WAITING})])
+    offering = threading.Thread(target=offer)
+    offering.start()
+    start = time.monotonic()
+    status, headers, body = self.request(url, query=b'after=0', cookie=cookie)
+    offering.join()
+    self.assertLess(time.monotonic() - start, 5)
+    self.assertEqual(headers[b'Content-Type'], b'application/json')
+    data = json.loads(body.decode('utf-8'))
+    self.assertEqual([(e['type'], e['state']) for e in data['events']],
+      [('exchange', Exchange.WAITING)])
+    self.assertEqual(data['last'], 1)
+
+  def test_connections_suite(self):
+    results = connections.run(players=3, territories=3, rows=5, workers=1,
+      held=1, hold=1)
+    self.assertEqual([(r['label'], r['probe_status'], r['served_while_held'])
+      for r in results], [('wsgi', 200, False), ('asgi', 200, True)])
+
+class OrderBookTestCase(TestCase):
+  def setUp(self):
+    counters.cache().clear()
+    create_test_game()
+    self.arthur = User.objects.get(username='arthur')
+    self.brian = User.objects.get(username='brian')
+    self.gumby = User.objects.get(username='gumby')
+    Resources.objects.filter(player__isnull=False).update(currency=1000,
+      manufactured=100, agricultural=100)
+
+  def order(self, user, side, price, quantity, good='agricultural'):
+    return Order(user=user, side=side, good=good, price=price,
+      quantity=quantity)
+
+  def place(self, *args, **kwargs):
+    return orderbook.place(self.order(*args, **kwargs))
+
+  def balance(self, user):
+    return Resources.objects.get(player__user=user).vector()
+
+  def test_fill_at_book_price(self):
+    sell = self.place(self.arthur, Order.SELL, 10, 5)
+    self.assertTrue(sell.is_open())
+    buy = self.place(self.brian, Order.BUY, 12, 3)
+    self.assertEqual((buy.state, buy.remaining), (Order.FILLED, 0))
+    sell.refresh_from_db()
+    self.assertEqual((sell.state, sell.remaining), (Order.OPEN, 2))
+    self.assertEqual(self.balance(self.arthur), (1030, 100, 97))
+    self.assertEqual(self.balance(self.brian), (970, 100, 103))
+
+    exchange = Exchange.objects.get(state=Exchange.ACCEPTED)
+    self.assertEqual((exchange.offeror, exchange.offeree),
+      (self.arthur, self.brian))
+    self.assertEqual(exchange.offeror_resources.vector(), (0, 0, 3))
+    self.assertEqual(exchange.offeree_resources.vector(), (30, 0, 0))
+    self.assertEqual(ResourceLedger.objects.filter(exchange=exchange).count(),
+      2)
+    self.assertEqual(stats.activity(self.brian, 1)['received'], (0, 0, 3))
+    self.assertEqual(counters.header(self.brian)['currency'], 970)
+
+  def test_price_then_time_priority(self):
+    first = self.place(self.arthur, Order.SELL, 10, 4)
+    second = self.place(self.gumby, Order.SELL, 10, 4)
+    cheap = self.place(self.gumby, Order.SELL, 9, 2)
+    # Other goods and prices out of reach are left alone
+    self.place(self.arthur, Order.SELL, 1, 5, good='manufactured')
+    self.place(self.arthur, Order.SELL, 20, 5)
+    self.place(self.brian, Order.BUY, 10, 8)
+    for order, state, remaining in [(cheap, Order.FILLED, 0),
+      (first, Order.FILLED, 0), (second, Order.OPEN, 2)]:
+      order.refresh_from_db()
+      self.assertEqual((order.state, order.remaining), (state, remaining))
+    self.assertEqual(self.balance(self.brian), (1000 - 18 - 40 - 20, 100,
+      108))
+    self.assertEqual(orderbook.depth('agricultural'), ([], [(10, 2),
+      (20, 5)]))
+    self.assertEqual(orderbook.depth('manufactured'), ([], [(1, 5)]))
+
+  def test_refusals_and_cancellations(self):
+    with self.assertRaises(ValidationError):
+      self.place(self.arthur, Order.BUY, 10, 101)
+    with self.assertRaises(ValidationError):
+      self.place(self.arthur, Order.SELL, 0, 1)
+    with self.assertRaises(ValidationError):
+      self.place(self.arthur, 'X', 1, 1)
+
+    # Crossing one's own order cancels the waiting one
+    own = self.place(self.arthur, Order.SELL, 5, 1)
+    self.place(self.arthur, Order.BUY, 5, 1)
+    own.refresh_from_db()
+    self.assertEqual(own.state, Order.CANCELED)
+    self.assertEqual(self.balance(self.arthur), (1000, 100, 100))
+
+    # A seller who no longer has the goods loses the order
+    sell = self.place(self.gumby, Order.SELL, 6, 10)
+    Resources.objects.filter(player__user=self.gumby).update(agricultural=0)
+    buy = self.place(self.brian, Order.BUY, 6, 10)
+    sell.refresh_from_db()
+    self.assertEqual(sell.state, Order.CANCELED)
+    self.assertTrue(buy.is_open())
+    self.assertFalse(Exchange.objects.exists())
+
+    with self.assertRaises(ValidationError):
+      buy.cancel(user=self.arthur)
+    buy.cancel(user=self.brian)
+    self.assertEqual(Order.objects.get(pk=buy.pk).state, Order.CANCELED)
+    with self.assertRaises(ValidationError):
+      buy.cancel(user=self.brian)
+
+  def test_place_many(self):
+    placed, failures = orderbook.place_many([
+      self.order(self.arthur, Order.SELL, 10, 5),
+      self.order(self.brian, Order.BUY, 10, 1000),
+      self.order(self.brian, Order.BUY, 11, 2),
+      self.order(self.gumby, Order.BUY, 10, 5),
+    ])
+    self.assertEqual(list(failures), [1])
+    self.assertEqual([(o.user, o.state, o.remaining) for o in placed], [
+      (self.arthur, Order.FILLED, 0), (self.brian, Order.FILLED, 0),
+      (self.gumby, Order.OPEN, 2)])
+    self.assertEqual([(e.offeree, e.offeree_currency) for e in
+      Exchange.objects.order_by('pk')], [(self.brian, 20),
+      (self.gumby, 30)])
+    self.assertEqual(self.balance(self.arthur), (1050, 100, 95))
+
+  def test_place_many_over_parameter_limit(self):
+    # A full API batch from as many players, above SQLite's 999 parameters.
+    buyers = list()
+    for i in range(1000):
+      user = User.objects.create_user(username='buyer{}'.format(i))
+      Player.create_player(user=user).save()
+      buyers.append(user)
+    Resources.objects.filter(player__isnull=False).update(currency=1000)
+    self.place(self.arthur, Order.SELL, 10, 100)
+    with CaptureQueriesContext(connection) as queries:
+      placed, failures = orderbook.place_many([
+        self.order(buyer, Order.BUY, 10, 1) for buyer in buyers])
+    self.assertEqual(failures, {})
+    self.assertEqual(sum(1 for o in placed if o.state == Order.FILLED), 100)
+    self.assertEqual(self.balance(self.arthur), (2000, 100, 0))
+    in_lists = [match.count(',') + 1 for sql in statements(queries)
+      for match in re.findall(r' IN \(([^()]*)\)', sql)]
+    self.assertLessEqual(max(in_lists), 999)
+
+  def test_api(self):
+    self.client.force_login(self.arthur)
+    url = reverse('game:api_orders')
+    response = self.client.post(url, json.dumps({'side': 'S',
+      'good': 'agricultural', 'price': 7, 'quantity': 3}),
+      content_type='application/json')
+    self.assertEqual(response.status_code, 201)
+    sell = response.json()
+    response = self.client.post(url, json.dumps([{'side': 'B',
+      'good': 'manufactured', 'price': 1, 'quantity': 1}, {'side': 'B',
+      'good': 'agricultural', 'price': 'x', 'quantity': 1}]),
+      content_type='application/json')
+    self.assertEqual(len(response.json()['results']), 1)
+    self.assertEqual(list(response.json()['errors']), ['1'])
+    self.assertEqual(len(self.client.get(url).json()['results']), 2)
+
+    book = self.client.get(reverse('game:api_book',
+      args=['agricultural'])).json()
+    self.assertEqual(book['asks'], [{'price': 7, 'quantity': 3}])
+    self.assertEqual(self.client.get(reverse('game:api_book',
+      args=['gold'])).status_code, 404)
+
+    response = self.client.post(reverse('game:api_cancel_order',
+      args=[sell['id']]))
+    self.assertEqual(response.json()['state'], Order.CANCELED)
+    self.client.force_login(self.brian)
+    response = self.client.post(reverse('game:api_cancel_order',
+      args=[sell['id']]))
+    self.assertEqual(response.status_code, 404)
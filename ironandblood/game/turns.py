@@ -0,0 +1,79 @@
+"""
+Turn engine.
+
+Each turn, pending bonds past their due turn are marked delinquent and the
+delinquency of their borrowers is increased, and a snapshot of every
+player's resources is taken for the resource ledger.  Bonds are processed in
+chunks of `CHUNK_SIZE`, each in its own transaction with set-based queries,
+so a turn holds at most one chunk in memory however many bonds are due.
+"""
+import time
+
+from django.db import transaction
+from django.db.models import F
+
+from . import ledger, versions
+from .config import Config
+from .models import MAX_IN, Bond, Player, Turn
+
+CHUNK_SIZE = 10000
+
+def _due_bonds(turn):
+  return Bond.objects.filter(state=Bond.PENDING, delinquent=False,
+    due_turn__lte=turn)
+
+@transaction.atomic
+def _process_chunk(turn, after, chunk_size):
+  """
+  Marks the next `chunk_size` due bonds with pk greater than `after` as
+  delinquent.  Returns the last pk processed (None when there are no more
+  due bonds) and the number of bonds marked per borrower.
+  """
+  rows = list(_due_bonds(turn).select_for_update().filter(pk__gt=after)
+    .order_by('pk').values_list('pk', 'borrower_id', 'holder_id')
+    [:chunk_size])
+  if not rows:
+    return None, dict()
+  # The selected rows are locked, so the pk range holds exactly them.
+  _due_bonds(turn).filter(pk__gt=after, pk__lte=rows[-1][0]).update(
+    delinquent=True)
+
+  by_borrower = dict()
+  for _pk, borrower_pk, _holder_pk in rows:
+    by_borrower[borrower_pk] = by_borrower.get(borrower_pk, 0) + 1
+  by_count = dict()
+  for borrower_pk, count in by_borrower.items():
+    by_count.setdefault(count, []).append(borrower_pk)
+  for count, borrower_pks in by_count.items():
+    for i in range(0, len(borrower_pks), MAX_IN):
+      Player.objects.filter(user_id__in=borrower_pks[i:i + MAX_IN]).update(
+        delinquency=F('delinquency') + count)
+  versions.changed(*[pk for row in rows for pk in row[1:]])
+  return rows[-1][0], by_borrower
+
+def process_turn(turn=None, chunk_size=CHUNK_SIZE):
+  """
+  Processes `turn` (default: the current turn) and returns its `Turn` log.
+
+  A turn is processed once; processing an already logged turn returns its
+  log untouched.  Bonds due in earlier turns that were never processed are
+  caught up.  If processing is interrupted, committed chunks stay
+  delinquent and running it again finishes the remaining bonds.
+  """
+  if turn is None:
+    turn = Config.current_turn()
+  log = Turn.objects.filter(number=turn).first()
+  if log is not None:
+    return log
+
+  start = time.perf_counter()
+  bonds = 0
+  players = set()
+  after = 0
+  while after is not None:
+    after, by_borrower = _process_chunk(turn, after, chunk_size)
+    bonds += sum(by_borrower.values())
+    players.update(by_borrower)
+  ledger.take_snapshot()
+  return Turn.objects.create(number=turn, delinquent_bonds=bonds,
+    delinquent_players=len(players), seconds=time.perf_counter() - start)
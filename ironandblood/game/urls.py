@@ -1,12 +1,13 @@
 from django.conf.urls import url
 
-from . import views
+from . import api, views
 
 USERNAME_REGEX = '[a-zA-Z0-9._]+'
 
 app_name = 'game'
 urlpatterns = [
     url(r'^$', views.home, name='home'),
+    url(r'^map\.json$', views.map_colors_json, name='map_colors'),
     # Exchanges page
     url(r'^exchanges$', views.exchanges, name='exchanges'),
     url(r'^exchanges/0/(?P<state>[WARC]+)', views.exchanges, name='filter_exchanges'),
@@ -27,6 +28,21 @@ urlpatterns = [
     url(r'^bonds/(?P<username>'+USERNAME_REGEX+')/$', views.bond_by_user, name='bond'),
     url(r'^bonds/(?P<username>.+)/0/(?P<state>[WPF]+)', views.bond_by_user, name='filter_bonds_offer'),
     url(r'^bonds/(?P<username>.+)/0/$', views.bond_by_user, name='filter_bonds_offer_without_opts'),
+    # Market statistics page
+    url(r'^market$', views.market, name='market'),
+    # JSON API
+    url(r'^api/exchanges$', api.exchanges, name='api_exchanges'),
+    url(r'^api/exchanges/(?P<exchange_pk>[0-9]+)$', api.exchange_detail, name='api_exchange'),
+    url(r'^api/exchanges/(?P<exchange_pk>[0-9]+)/(?P<action>accept|reject|cancel)$', api.update_exchange, name='api_update_exchange'),
+    url(r'^api/offers$', api.public_offers, name='api_offers'),
+    url(r'^api/offers/(?P<exchange_pk>[0-9]+)/claim$', api.claim_offer, name='api_claim_offer'),
+    url(r'^api/events$', api.poll_events, name='api_events'),
+    url(r'^api/orders$', api.orders, name='api_orders'),
+    url(r'^api/orders/(?P<order_pk>[0-9]+)/cancel$', api.cancel_order, name='api_cancel_order'),
+    url(r'^api/book/(?P<good>[a-z]+)$', api.book, name='api_book'),
+    url(r'^api/bonds$', api.bond_list, name='api_bonds'),
+    url(r'^api/bonds/(?P<bond_pk>[0-9]+)$', api.bond_detail, name='api_bond'),
+    url(r'^api/bonds/(?P<bond_pk>[0-9]+)/(?P<action>pay|forgive)$', api.update_bond, name='api_update_bond'),
     # Login/Logout
     url(r'^login$', views.login_view, name='login'),
     url(r'^logout$', views.logout_view, name='logout'),
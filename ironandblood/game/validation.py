@@ -0,0 +1,261 @@
+"""
+Exchange validation without side effects.
+
+The checks read the columns of an exchange and a `GameState` of preloaded
+facts (usernames, player balances, territory owners and bond parties), and
+return the problems found as `ValidationError`s instead of raising them.
+They never query the database, so a listing can check hundreds of exchanges
+against one state built from what it already loaded (`GameState.of`) or with
+a constant number of queries (`GameState.load`).
+
+The state transitions of `Exchange` run the same checks on the rows they
+locked and raise the first problem.  `acceptable_q` and `payable_q` express
+the same rules as SQL conditions, so querysets can annotate whole listings
+with their flags (see `ExchangeQuerySet.with_flags`).
+"""
+from django.core.exceptions import ValidationError
+from django.db.models import BooleanField, Case, F, Q, Value, When
+from django.utils.translation import ugettext as _
+
+class GameState(object):
+  """
+  Facts the validations read:
+
+  - `usernames`: user pk -> username;
+  - `balances`: user pk -> `ResourceVector` of the player's resources;
+  - `territories`: territory pk -> (name, owner pk);
+  - `bonds`: bond pk -> (borrower pk, holder pk, whether it is pending).
+  """
+  def __init__(self, usernames=None, balances=None, territories=None,
+               bonds=None):
+    self.usernames = usernames or dict()
+    self.balances = balances or dict()
+    self.territories = territories or dict()
+    self.bonds = bonds or dict()
+
+  def _add_user(self, user, balance=False):
+    self.usernames[user.pk] = user.username
+    if balance:
+      self.balances[user.pk] = user.player.resources.vector()
+
+  def _add_territory(self, territory):
+    self.territories[territory.pk] = (territory.name, territory.owner_id)
+
+  def _add_bond(self, bond):
+    self.bonds[bond.pk] = (bond.borrower_id, bond.holder_id,
+      bond.state == bond.PENDING)
+
+  @classmethod
+  def of(cls, exchanges):
+    """
+    State read from the related objects of `exchanges`.  Only the objects
+    the checks need are read; those not loaded yet are fetched as usual, so
+    load them beforehand (e.g. `Exchange.objects.for_listing()`).
+    """
+    state = cls()
+    for exchange in exchanges:
+      state._add_user(exchange.offeror)
+      if exchange.offeree_id is not None:
+        state._add_user(exchange.offeree,
+          balance=not exchange.offeree_as_bond
+          and not exchange.offeree_resources.is_empty())
+      for side in ['offeror', 'offeree']:
+        if getattr(exchange, side + '_territory_id') is not None:
+          state._add_territory(getattr(exchange, side + '_territory'))
+        if getattr(exchange, side + '_bond_id') is not None:
+          state._add_bond(getattr(exchange, side + '_bond'))
+    return state
+
+  @classmethod
+  def load(cls, exchanges):
+    """
+    State of the users, territories and bonds `exchanges` refer to by
+    foreign key, loaded with three queries however many exchanges there are.
+    """
+    from django.contrib.auth.models import User
+    from .models import Bond, ResourceVector, Territory
+
+    user_pks, territory_pks, bond_pks = set(), set(), set()
+    for exchange in exchanges:
+      user_pks.update([exchange.offeror_id, exchange.offeree_id])
+      for side in ['offeror', 'offeree']:
+        territory_pks.add(getattr(exchange, side + '_territory_id'))
+        bond_pks.add(getattr(exchange, side + '_bond_id'))
+    user_pks.discard(None)
+    territory_pks.discard(None)
+    bond_pks.discard(None)
+
+    state = cls()
+    for pk, username, *balance in User.objects.filter(
+      pk__in=user_pks).values_list('pk', 'username',
+      'player__resources__currency', 'player__resources__manufactured',
+      'player__resources__agricultural'):
+      state.usernames[pk] = username
+      state.balances[pk] = ResourceVector(*balance)
+    if territory_pks:
+      for pk, name, owner_pk in Territory.objects.filter(
+        pk__in=territory_pks).values_list('pk', 'name', 'owner_id'):
+        state.territories[pk] = (name, owner_pk)
+    if bond_pks:
+      for pk, borrower_pk, holder_pk, bond_state in Bond.objects.filter(
+        pk__in=bond_pks).values_list('pk', 'borrower_id', 'holder_id',
+        'state'):
+        state.bonds[pk] = (borrower_pk, holder_pk,
+          bond_state == Bond.PENDING)
+    return state
+
+def raise_first(problems):
+  """Raises the first of `problems`, if any."""
+  if problems:
+    raise problems[0]
+
+def not_waiting():
+  return ValidationError(_("This exchange is not waiting for response."))
+
+def public_offer():
+  return ValidationError(_("Public offers must be accepted one at a time."))
+
+def offeree_lacks_resources(username):
+  return ValidationError(
+    _("Offeree “%(player)s” lack resources to accept this exchange."),
+    params={
+    'player': username
+    })
+
+def offeror_lacks_resources(username):
+  return ValidationError(
+    _("Offeror “%(player)s” lack resources to offer this exchange."),
+    params={
+    'player': username
+    })
+
+def bond_problems(exchange, state):
+  # We must refuse Bond exchanges with their holders, because currently
+  # there is no way to perform a safe transaction.
+  # Example: offeror Bond payment would be ok, but if offeree Bond, then
+  # we would have to undo the first payment.
+  problems = list()
+  if (exchange.offeror_bond_id is not None and exchange.offeror_as_bond) or \
+    (exchange.offeree_bond_id is not None and exchange.offeree_as_bond):
+    problems.append(ValidationError(_("Cannot build a Bond of Bond.")))
+
+  if exchange.offeror_bond_id is not None:
+    borrower_pk, holder_pk, pending = state.bonds[exchange.offeror_bond_id]
+    if borrower_pk != exchange.offeror_id:
+      problems.append(ValidationError(
+        _("“%(player)s” is not the borrower of this Bond."),
+        params={
+        'player': state.usernames[exchange.offeror_id]
+        }))
+    elif holder_pk == exchange.offeree_id:
+      problems.append(ValidationError(
+        _("Cannot exchange a Bond with its holder. "
+          "To pay the bond, use the payment section.")))
+    elif not pending:
+      problems.append(ValidationError(_("This Bond is not pending.")))
+
+  if exchange.offeree_bond_id is not None:
+    borrower_pk, holder_pk, pending = state.bonds[exchange.offeree_bond_id]
+    if borrower_pk != exchange.offeree_id:
+      problems.append(ValidationError(
+        _("“%(player)s” is not the holder of this Bond."),
+        params={
+        'player': state.usernames[exchange.offeree_id]
+        }))
+    elif holder_pk == exchange.offeror_id:
+      problems.append(ValidationError(
+        _("Cannot exchange a Bond with its holder.")))
+    elif not pending:
+      problems.append(ValidationError(_("This Bond is not pending.")))
+  return problems
+
+def territory_problems(exchange, state):
+  """Applicable before accept"""
+  problems = list()
+  for side, message in [
+    ('offeror', _("Offeror “%(player)s” does not control “%(territory)s”.")),
+    ('offeree', _("Offeree “%(player)s” does not control “%(territory)s”."))]:
+    territory_pk = getattr(exchange, side + '_territory_id')
+    if getattr(exchange, side + '_as_bond') or territory_pk is None:
+      continue
+    name, owner_pk = state.territories[territory_pk]
+    user_pk = getattr(exchange, side + '_id')
+    if owner_pk != user_pk:
+      problems.append(ValidationError(message, params={
+        'player': state.usernames[user_pk],
+        'territory': name
+        }))
+  return problems
+
+def resource_problems(exchange, state):
+  """
+  Offeree sufficiency.  Offeror resources are checked when collected by
+  `Exchange.offer`, with a guarded update.  Public offers have no offeree
+  to check until claimed.
+  """
+  if exchange.offeree_id is None or exchange.offeree_as_bond or \
+    exchange.offeree_resources.is_empty():
+    return []
+  balance = state.balances[exchange.offeree_id]
+  if balance.covers(exchange.offeree_resources.vector()):
+    return []
+  return [offeree_lacks_resources(state.usernames[exchange.offeree_id])]
+
+def acceptance_problems(exchange, state):
+  """Problems that would make `Exchange.accept` refuse `exchange`."""
+  problems = list()
+  if exchange.state != exchange.WAITING:
+    problems.append(not_waiting())
+  return problems + bond_problems(exchange, state) + \
+    territory_problems(exchange, state) + resource_problems(exchange, state)
+
+def acceptable(exchanges, state=None):
+  """
+  Dictionary mapping the pk of each of `exchanges` to whether it is
+  acceptable.  Without `state`, it is read from their related objects.
+  """
+  if state is None:
+    state = GameState.of(exchanges)
+  return {exchange.pk: not acceptance_problems(exchange, state)
+    for exchange in exchanges}
+
+def flag(condition):
+  """Boolean annotation that is True where the `condition` Q holds."""
+  return Case(When(condition, then=Value(True)), default=Value(False),
+    output_field=BooleanField())
+
+def payable_q(bond='', borrower='borrower'):
+  """
+  SQL counterpart of `Bond.is_payable`, for the bond at lookup path `bond`
+  (the queried bond itself by default) paid by the user at `borrower`.
+  """
+  return Q(**{bond + 'territory__isnull': True}) | \
+    Q(**{bond + 'territory__owner': F(borrower)})
+
+def _bond_q(side, other):
+  from .models import Bond
+
+  bond = side + '_bond__'
+  return Q(**{side + '_bond__isnull': True}) | (
+    Q(**{bond + 'borrower': F(side), bond + 'state': Bond.PENDING}) &
+    ~Q(**{bond + 'holder': F(other)}))
+
+def _territory_q(side):
+  return Q(**{side + '_as_bond': True}) | \
+    Q(**{side + '_territory__isnull': True}) | \
+    Q(**{side + '_territory__owner': F(side)})
+
+def acceptable_q():
+  """SQL counterpart of `acceptance_problems` being empty."""
+  from .models import Exchange, Resources
+
+  names = Resources._list
+  return Q(state=Exchange.WAITING) & \
+    (Q(offeror_bond__isnull=True) | Q(offeror_as_bond=False)) & \
+    (Q(offeree_bond__isnull=True) | Q(offeree_as_bond=False)) & \
+    _bond_q('offeror', 'offeree') & _bond_q('offeree', 'offeror') & \
+    _territory_q('offeror') & _territory_q('offeree') & (
+      Q(offeree__isnull=True) | Q(offeree_as_bond=True) |
+      Q(**{'offeree_' + name: 0 for name in names}) |
+      Q(**{'offeree__player__resources__{}__gte'.format(name):
+        F('offeree_' + name) for name in names}))
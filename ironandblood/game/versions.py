@@ -0,0 +1,60 @@
+"""
+Per-user change versions.
+
+Each user has a version in the game cache that changes whenever one of the
+exchanges or bonds the user takes part in changes (state transitions, bonds
+changing borrower or becoming delinquent).  The JSON API derives its ETag
+from it, so a client polling an unchanged listing gets a 304 without the
+exchange and bond tables being read.  There is no Last-Modified: HTTP dates
+only have a precision of one second, so a change in the same second as the
+previous fetch would still be answered with a 304.
+
+The feed of public offers, shared by every user, has its own version under
+the key `PUBLIC`.
+"""
+import time
+
+from django.db import transaction
+
+from .counters import cache
+
+# Version of the public offers feed, changed by `changed(PUBLIC)`.
+PUBLIC = 'public'
+
+def _key(user_pk):
+  return 'game:version:{}'.format(user_pk)
+
+def _init(user_pk):
+  # Start from the clock so a lost version never reuses an old value.
+  cache().add(_key(user_pk), int(time.time() * 1000), None)
+
+def get(user_pk):
+  """Version of the user with pk `user_pk`."""
+  version = cache().get(_key(user_pk))
+  if version is None:
+    _init(user_pk)
+    version = cache().get(_key(user_pk))
+  return version
+
+def _bump(user_pks):
+  for user_pk in user_pks:
+    try:
+      cache().incr(_key(user_pk))
+    except ValueError:
+      _init(user_pk)
+
+def changed(*user_pks):
+  """
+  Changes the versions of `user_pks`.  Inside a transaction they are changed
+  again on commit, so that a concurrent request cannot tag a response read
+  before the commit with the new version.
+  """
+  user_pks = set(user_pks) - set([None])
+  if not user_pks:
+    return
+  _bump(user_pks)
+  if transaction.get_connection().in_atomic_block:
+    transaction.on_commit(lambda: _bump(user_pks))
+
+def etag(user_pk):
+  return '{}-{}'.format(user_pk, get(user_pk))
@@ -5,25 +5,29 @@ from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.db.models import Q
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, render_to_response, redirect
 from django.template import RequestContext
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import csrf_protect
 
+from . import counters, map_colors, stats
 from .models import Player, Resources, Territory, Exchange, Bond
 
 from .forms import ExchangeForm
+from .pagination import paginate
+
+EXCHANGE_KEYS = ('offer_date', 'pk')
+BOND_KEYS = ('pk',)
+MARKET_TURNS = 10
+MAX_MARKET_TURNS = 100
 
 def build_context(request, context = {}):
   """
   Build a context dictionary with information for the base html page.
   """
   ctx = {
-    'waiting_exchanges': Exchange.objects.filter(offeree = request.user,
-      state = Exchange.WAITING),
-    'pending_bonds': Bond.objects.filter(borrower = request.user,
-      state = Bond.PENDING),
+    'header': counters.header(request.user),
   }
   ctx.update(context)
   return ctx
@@ -31,12 +35,15 @@ def build_context(request, context = {}):
 @login_required(login_url='game:login')
 @csrf_protect
 def bonds(request, state=Bond.PENDING):
-  rb = Bond.objects.filter(holder = request.user).order_by('-pk')
-  sb = Bond.objects.filter(borrower = request.user).order_by('-pk')
+  listing = Bond.objects.for_listing()
+  rb = listing.filter(holder = request.user)
+  sb = listing.filter(borrower = request.user)
 
   states = list(state)
-  rb = rb.filter(state__in = states)
-  sb = sb.filter(state__in = states)
+  rb = paginate(request, rb.filter(state__in = states), BOND_KEYS,
+    param = 'holder_cursor')
+  sb = paginate(request, sb.filter(state__in = states), BOND_KEYS,
+    param = 'borrower_cursor')
 
   return render(request, 'game/bonds.html', build_context(request, {
     'users': User.objects.all(),
@@ -73,11 +80,12 @@ def update_bond(request, bond_pk):
 def bond_by_user(request, username, state=Bond.PENDING):
   user = User.objects.get(username = username)
   users = [request.user, user]
-  bonds_history = Bond.objects.filter(holder__in = users,
+  bonds_history = Bond.objects.for_listing().filter(holder__in = users,
     borrower__in = users)
 
   states = list(state)
-  bonds_history = bonds_history.filter(state__in = states)
+  bonds_history = paginate(request, bonds_history.filter(state__in = states),
+    BOND_KEYS)
 
   return render(request, 'game/bond_by_user.html', build_context(request, {
     'user': user,
@@ -88,12 +96,15 @@ def bond_by_user(request, username, state=Bond.PENDING):
 @login_required(login_url='game:login')
 @csrf_protect
 def exchanges(request, state=Exchange.WAITING):
-  re = Exchange.objects.filter(offeree = request.user).order_by('-offer_date')
-  se = Exchange.objects.filter(offeror = request.user).order_by('-offer_date')
+  listing = Exchange.objects.for_listing()
+  re = listing.filter(offeree = request.user)
+  se = listing.filter(offeror = request.user)
 
   states = list(state)
-  re = re.filter(state__in = states)
-  se = se.filter(state__in = states)
+  re = paginate(request, re.filter(state__in = states), EXCHANGE_KEYS,
+    param = 'received_cursor')
+  se = paginate(request, se.filter(state__in = states), EXCHANGE_KEYS,
+    param = 'sent_cursor')
 
   return render(request, 'game/exchanges.html', build_context(request, {
     'users': User.objects.all(),
@@ -151,36 +162,56 @@ def new_exchange(request, offeree, state=Exchange.WAITING):
       messages.success(request, _('Exchange offer sent!'))
       return HttpResponseRedirect(reverse('game:exchanges'))
   users = [request.user, offeree_obj]
-  exchange_history = Exchange.objects.filter(offeror__in = users,
-    offeree__in = users)
+  exchange_history = Exchange.objects.for_listing().filter(
+    offeror__in = users, offeree__in = users)
 
   states = list(state)
-  exchange_history = exchange_history.filter(state__in = states)
+  exchange_history = paginate(request,
+    exchange_history.filter(state__in = states), EXCHANGE_KEYS)
 
   return render(request, 'game/new_exchange.html', build_context(request, {
     'form': form,
     'offeree': offeree_obj,
-    'territories': Territory.objects.all(),
+    'territories': Territory.objects.select_related('owner'),
     'exchange_history': exchange_history,
     'states': states
     }))
 
-@login_required(login_url='game:login')
-def home(request):
-  territories = Territory.objects.all()
-  users = User.objects.all()
-  colors = ['#659BA3', '#725E54', '#FFEBB5', '#996982', '#01704B']
-  dct = dict()
-  for t in territories:
-    dct[t.code] = colors[t.owner.pk % len(colors)]
+def _map_context():
+  """Territory colors and legend of the map in `game/home.html`."""
+  snapshot = map_colors.snapshot()
   user_legend = dict()
-  for u in users:
-    user_legend[u.username] = colors[u.pk % len(colors)]
-  return render(request, 'game/home.html', build_context(request, {
-    'colors': dct,
+  for pk, username in User.objects.values_list('pk', 'username'):
+    user_legend[username] = map_colors.player_color(pk)
+  return {
+    'colors': snapshot['colors'],
+    'colors_version': snapshot['version'],
     'colors_legend': user_legend
+  }
+
+@login_required(login_url='game:login')
+def home(request):
+  return render(request, 'game/home.html', build_context(request,
+    _map_context()))
+
+@login_required(login_url='game:login')
+def market(request):
+  try:
+    turns = int(request.GET.get('turns', MARKET_TURNS))
+  except ValueError:
+    turns = MARKET_TURNS
+  turns = min(max(turns, 1), MAX_MARKET_TURNS)
+  return render(request, 'game/market.html', build_context(request, {
+    'turns': turns,
+    'activity': stats.activity(request.user, turns),
+    'history': stats.history(request.user, turns),
+    'partners': stats.top_partners(request.user),
   }))
 
+@login_required(login_url='game:login')
+def map_colors_json(request):
+  return JsonResponse(map_colors.snapshot())
+
 @login_required(login_url='game:login')
 def logout_view(request):
   logout(request)
@@ -209,5 +240,6 @@ def login_view(request):
 
 @login_required(login_url='game:login')
 def profile(request):
-  return render(request, 'game/home.html', {})
+  return render(request, 'game/home.html', build_context(request,
+    _map_context()))
 
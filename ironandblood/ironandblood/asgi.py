@@ -0,0 +1,18 @@
+"""
+ASGI config for ironandblood project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+to be served by any ASGI 3 server (see ``game.asgi``).
+"""
+
+import os
+
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+
+from game.asgi import GameApplication
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ironandblood.settings")
+
+application = GameApplication(get_wsgi_application(),
+    threads=settings.GAME_ASGI_THREADS)
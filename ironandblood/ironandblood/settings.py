@@ -96,6 +96,28 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# Cache alias holding the per-player header counters, and their lifetime in
+# seconds.
+GAME_CACHE = 'default'
+GAME_HEADER_TIMEOUT = 300
+
+# Broker of exchange and bond events (see game.events), and the seconds a
+# long-poll request waits for them.
+GAME_EVENT_BROKER = 'game.events.LocalBroker'
+GAME_EVENT_TIMEOUT = 25
+
+# Threads rendering pages under ironandblood.asgi.
+GAME_ASGI_THREADS = 8
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 